@@ -0,0 +1,153 @@
+'''
+Authentication classes for API endpoints are defined here.
+'''
+import json
+import hashlib
+import redis
+from django.contrib.auth import get_user_model
+from rest_framework import authentication
+from rest_framework.authtoken.models import Token
+from cachemanager.lru import LRUCache
+from cachemanager.redisconn import get_redis
+
+class PrincipalCache:
+    '''
+    Maps token keys to principals (a few fields of their users) in a bounded in-process
+    LRU (L1) in front of Redis (L2). Invalidation reaches L1 of other workers only when
+    their records expire, so L1 records live for a few seconds only.
+    Token keys are stored hashed, so the cache does not hold credentials.
+    Every invalidation bumps a generation of the token in Redis and principals loaded from
+    database are only stored if their generation did not change since before they were
+    loaded, so a principal read before an invalidation is not cached after it.
+    '''
+    memory_config = {
+        'maxmemory': 1024*1024,
+        'ttl': 10,
+        'redis_ttl': 300,
+    }
+    KEY_PREFIX = "auth_principal_"
+    GENERATION_KEY_PREFIX = "auth_generation_"
+    FIELDS = ['id', 'username', 'email', 'is_active', 'is_staff', 'is_superuser']
+
+    def __init__(self, **kwargs):
+        config = dict(self.memory_config, **kwargs)
+        self.ttl = config['ttl']
+        self.redis_ttl = config['redis_ttl']
+        self._l1 = LRUCache(config['maxmemory'])
+        self._redis = None
+
+    @property
+    def redis(self):
+        '''
+        Redis client created on first use on the shared connection pool.
+        '''
+        if self._redis is None:
+            self._redis = get_redis()
+        return self._redis
+
+    def generate_key(self, token_key):
+        return self.KEY_PREFIX + hashlib.sha256(token_key.encode()).hexdigest()
+
+    def generate_generation_key(self, token_key):
+        return self.GENERATION_KEY_PREFIX + hashlib.sha256(token_key.encode()).hexdigest()
+
+    def generation(self, token_key):
+        '''
+        Returns current generation of token_key's principal, or None if Redis could not be reached.
+        It should be read before the principal is loaded from database and passed to put.
+        '''
+        try:
+            return self.redis.get(self.generate_generation_key(token_key)) or b'0'
+        except redis.RedisError:
+            return None
+
+    def get(self, token_key):
+        '''
+        Returns user of token_key or None if it is not cached.
+        Users are built from cached fields, other fields are loaded from database on access.
+        '''
+        key = self.generate_key(token_key)
+        principal = self._l1.get(key)
+        if principal is None:
+            try:
+                principal = self.redis.get(key)
+            except redis.RedisError:
+                return None
+            if principal is None:
+                return None
+            self._l1.put(key, principal, ttl=self.ttl)
+        principal = json.loads(principal)
+        user_model = get_user_model()
+        # from_db expects values in order of model fields.
+        fields = [field.attname for field in user_model._meta.concrete_fields if field.attname in principal]
+        return user_model.from_db('default', fields, [principal[field] for field in fields])
+
+    def put(self, token_key, user, generation):
+        '''
+        Caches user as principal of token_key, given generation of the principal read before
+        user was loaded. Returns False if principal was invalidated since then, in which case
+        nothing is cached. If Redis could not be reached, user is cached in L1 only.
+        '''
+        key = self.generate_key(token_key)
+        generation_key = self.generate_generation_key(token_key)
+        principal = json.dumps({field: getattr(user, field) for field in self.FIELDS}).encode()
+        if generation is not None:
+            try:
+                with self.redis.pipeline() as pipeline:
+                    # Transaction fails if generation is bumped after it is watched.
+                    pipeline.watch(generation_key)
+                    if (pipeline.get(generation_key) or b'0') != generation:
+                        return False
+                    pipeline.multi()
+                    pipeline.set(key, principal, ex=self.redis_ttl)
+                    pipeline.execute()
+            except redis.WatchError:
+                return False
+            except redis.RedisError:
+                pass
+        self._l1.put(key, principal, ttl=self.ttl)
+        return True
+
+    def delete(self, token_key):
+        '''
+        Removes principal of token_key and bumps its generation. Returns False if Redis
+        could not be reached, in which case its record expires after redis_ttl seconds.
+        '''
+        key = self.generate_key(token_key)
+        generation_key = self.generate_generation_key(token_key)
+        self._l1.delete(key)
+        pipeline = self.redis.pipeline()
+        pipeline.incr(generation_key)
+        # Principals cached before are gone when generation expires.
+        pipeline.expire(generation_key, self.redis_ttl)
+        pipeline.delete(key)
+        try:
+            pipeline.execute()
+        except redis.RedisError:
+            return False
+        return True
+
+class CachedTokenAuthentication(authentication.TokenAuthentication):
+    '''
+    TokenAuthentication resolving tokens through PrincipalCache, so authenticated
+    requests do not query the database. Principals are invalidated when tokens or
+    users are saved or deleted (see account.signals).
+    Users it returns are partially loaded, so views saving users should not use it.
+    '''
+    principals = PrincipalCache()
+
+    def authenticate_credentials(self, key):
+        user = self.principals.get(key)
+        if user is not None:
+            return (user, Token(key=key, user=user))
+        generation = self.principals.generation(key)
+        user, token = super().authenticate_credentials(key)
+        self.principals.put(key, user, generation)
+        return (user, token)
+
+    @classmethod
+    def invalidate(cls, key):
+        '''
+        Removes cached principal of token key.
+        '''
+        return cls.principals.delete(key)
@@ -0,0 +1,53 @@
+'''
+Microbenchmark comparing per request cost of TokenAuthentication and CachedTokenAuthentication.
+'''
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from account.authentication import CachedTokenAuthentication
+
+class Command(BaseCommand):
+    help = "Times token authentication from database, Redis (L2) and in-process cache (L1)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help="Owner of the token used, defaults to any user having a token.")
+        parser.add_argument('--requests', type=int, default=2000, help="Number of timed authentications per mode.")
+
+    def time_authentication(self, authenticate, key, requests, before=None):
+        '''
+        Returns (average seconds, database queries) per authentication.
+        before runs ahead of each authentication, outside the timed section.
+        '''
+        elapsed = 0
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(requests):
+                if before is not None:
+                    before()
+                start_time = time.perf_counter()
+                authenticate(key)
+                elapsed = elapsed + time.perf_counter() - start_time
+        return elapsed / requests, len(queries) / requests
+
+    def handle(self, *args, **options):
+        tokens = Token.objects.all()
+        if options['username']:
+            tokens = tokens.filter(user__username=options['username'])
+        token = tokens.first()
+        if token is None:
+            raise CommandError("No token to authenticate with.")
+        principals = CachedTokenAuthentication.principals
+        cached = CachedTokenAuthentication()
+        cached.authenticate_credentials(token.key)
+        modes = [
+            ('database', TokenAuthentication().authenticate_credentials, None),
+            ('redis', cached.authenticate_credentials,
+                lambda: principals._l1.delete(principals.generate_key(token.key))),
+            ('in-process', cached.authenticate_credentials, None),
+        ]
+        self.stdout.write(f"{'mode':>10} {'per request (us)':>17} {'queries':>8}")
+        for name, authenticate, before in modes:
+            cost, queries = self.time_authentication(authenticate, token.key, options['requests'], before)
+            self.stdout.write(f"{name:>10} {cost*1e6:>17.2f} {queries:>8.2f}")
@@ -0,0 +1,27 @@
+'''
+Signal handlers keeping cached token principals in sync with tokens and users.
+'''
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .authentication import CachedTokenAuthentication
+
+@receiver([post_save, post_delete], sender=Token)
+def invalidate_token_principal(sender, instance, **kwargs):
+    '''
+    Drops principal of a rotated or deleted token.
+    Principal is dropped once transaction commits; dropped earlier, a concurrent request
+    could cache it again from the row as it was before the commit.
+    '''
+    key = instance.key
+    transaction.on_commit(lambda: CachedTokenAuthentication.invalidate(key))
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def invalidate_user_principals(sender, instance, **kwargs):
+    '''
+    Drops principals of an updated or deleted user, so they are loaded again with new details.
+    '''
+    keys = list(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+    transaction.on_commit(lambda: [CachedTokenAuthentication.invalidate(key) for key in keys])
@@ -1,3 +1,107 @@
+import unittest
+import importlib.util
+from unittest import mock
+import redis
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from account.authentication import CachedTokenAuthentication, PrincipalCache
 
-# Create your tests here.
+FAKE_REDIS = importlib.util.find_spec('fakeredis') is not None
+
+@unittest.skipUnless(FAKE_REDIS, "fakeredis is not installed")
+class PrincipalCacheTests(TestCase):
+    '''
+    Caching and invalidation of token principals, on fakeredis.
+    '''
+    def setUp(self):
+        import fakeredis
+        self.server = fakeredis.FakeServer()
+        self.cache = self.make_cache()
+        self.user = get_user_model().objects.create_user(username='owner', email='owner@example.com', password=None)
+        self.token = Token.objects.create(user=self.user)
+
+    def make_cache(self):
+        '''
+        Returns a principal cache of another worker process, sharing Redis with the others.
+        '''
+        import fakeredis
+        cache = PrincipalCache()
+        cache._redis = fakeredis.FakeRedis(server=self.server)
+        return cache
+
+    def load(self, cache):
+        '''
+        Loads principal like CachedTokenAuthentication does: generation is read first.
+        '''
+        generation = cache.generation(self.token.key)
+        return get_user_model().objects.get(pk=self.user.pk), generation
+
+    def test_cached_principal(self):
+        self.assertIsNone(self.cache.get(self.token.key))
+        user, generation = self.load(self.cache)
+        self.assertTrue(self.cache.put(self.token.key, user, generation))
+        cached = self.cache.get(self.token.key)
+        self.assertEqual((cached.pk, cached.username, cached.email), (self.user.pk, 'owner', 'owner@example.com'))
+        # Other workers find it in Redis.
+        self.assertEqual(self.make_cache().get(self.token.key).pk, self.user.pk)
+        # Token keys are not stored in clear.
+        self.assertFalse(any(self.token.key.encode() in key for key in self.cache.redis.keys()))
+
+    def test_invalidation_drops_principal(self):
+        user, generation = self.load(self.cache)
+        self.cache.put(self.token.key, user, generation)
+        other = self.make_cache()
+        other.get(self.token.key)
+        self.assertTrue(other.delete(self.token.key))
+        self.assertIsNone(other.get(self.token.key))
+        self.assertIsNone(self.cache.redis.get(self.cache.generate_key(self.token.key)))
+
+    def test_principal_loaded_before_invalidation_is_not_cached(self):
+        user, generation = self.load(self.cache)
+        # Token is invalidated by another worker after principal was loaded.
+        self.make_cache().delete(self.token.key)
+        self.assertFalse(self.cache.put(self.token.key, user, generation))
+        self.assertIsNone(self.cache.get(self.token.key))
+        self.assertIsNone(self.make_cache().get(self.token.key))
+        # Loaded again after invalidation, it is cached.
+        user, generation = self.load(self.cache)
+        self.assertTrue(self.cache.put(self.token.key, user, generation))
+        self.assertIsNotNone(self.make_cache().get(self.token.key))
+
+    def test_invalidation_racing_put_is_not_lost(self):
+        user, generation = self.load(self.cache)
+        other = self.make_cache()
+        create_pipeline = self.cache.redis.pipeline
+        def racing_pipeline(*args, **kwargs):
+            # Generation is bumped after put checked it, before its transaction runs.
+            pipeline = create_pipeline(*args, **kwargs)
+            multi = pipeline.multi
+            def invalidate_then_multi():
+                other.delete(self.token.key)
+                multi()
+            pipeline.multi = invalidate_then_multi
+            return pipeline
+        with mock.patch.object(self.cache.redis, 'pipeline', racing_pipeline):
+            self.assertFalse(self.cache.put(self.token.key, user, generation))
+        self.assertIsNone(self.cache.get(self.token.key))
+
+    def test_principal_is_kept_in_process_without_redis(self):
+        with mock.patch.object(self.cache.redis, 'get', side_effect=redis.ConnectionError):
+            user, generation = self.load(self.cache)
+            self.assertIsNone(generation)
+            self.assertTrue(self.cache.put(self.token.key, user, generation))
+            self.assertEqual(self.cache.get(self.token.key).pk, self.user.pk)
+        self.assertIsNone(self.make_cache().get(self.token.key))
+
+    def test_saving_user_invalidates_principal(self):
+        with mock.patch.object(CachedTokenAuthentication, 'principals', self.cache):
+            user, _ = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+            self.assertIsNotNone(self.cache.get(self.token.key))
+            with self.captureOnCommitCallbacks(execute=True):
+                user = get_user_model().objects.get(pk=self.user.pk)
+                user.email = 'new@example.com'
+                user.save()
+            self.assertIsNone(self.cache.get(self.token.key))
+            user, _ = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+            self.assertEqual(self.cache.get(self.token.key).email, 'new@example.com')
@@ -4,7 +4,7 @@ API endpoints for account app are defined here.
 from django.contrib.auth import get_user_model
 from rest_framework import status, authentication
 from rest_framework.decorators import api_view, throttle_classes
-from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+from cachemanager.throttling import RedisAnonRateThrottle, RedisUserRateThrottle
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
@@ -12,7 +12,7 @@ from .serializers import UserSerializer
 from .permissions import UnauthenticatedForPostAuthenticatedForOther
 
 @api_view(['POST'])
-@throttle_classes([AnonRateThrottle])
+@throttle_classes([RedisAnonRateThrottle])
 def register(request):
     '''
     API endpoint responsible for registering new users via username, password
@@ -39,7 +39,7 @@ class AccountManager(APIView):
         authentication.TokenAuthentication,
         authentication.SessionAuthentication]
     permission_classes = [UnauthenticatedForPostAuthenticatedForOther,]
-    throttle_classes = [UserRateThrottle, AnonRateThrottle]
+    throttle_classes = [RedisUserRateThrottle, RedisAnonRateThrottle]
 
     def get(self, request):
         '''
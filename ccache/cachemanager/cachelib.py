@@ -1,26 +1,46 @@
 '''
 Utility classes to work with caching system.
 '''
-import sys
+import io
 import os
-import time
-import pathlib
+import hashlib
+import collections
+import functools
+import itertools
+import zlib
+import uuid
 import threading
+import mimetypes
+import urllib.parse
 import rcssmin
 import rjsmin
 import magic
 import redis
 from PIL import Image
-from memory_profiler import memory_usage
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.utils.text import slugify
-from cachemanager.models import BaseFile, ImageFile, TextFile
+from django.utils.module_loading import import_string
+from cachemanager.models import BaseFile, Blob, ImageFile, ImageVariant, TextFile, TextVariant, TransformJob
+from cachemanager.lru import LRUCache
+from cachemanager.shmcache import SharedMemoryArena
+from cachemanager.redisconn import get_redis
+from cachemanager.storage import get_storage_backend
+from cachemanager.jobs import JobQueue
+from cachemanager.imaging import ImageTranscoder
+from cachemanager.instrumentation import TransformProfile
+from cachemanager import compression
+from cachemanager import metrics
 
 class FileMan:
     '''
     Responsible for working with files.
+    Uploads are read once into memory, transformed there and written to the
+    storage backend in a single pass.
     '''
-    TMP_STORAGE_PATH = "./tmp/"
-
     def sanitize_filename(self, filename):
         '''
         Sanitizes filename.
@@ -30,132 +50,103 @@ class FileMan:
         filename[1] = slugify(filename[1])
         return '.'.join(filename)
 
-    def path_exists(self, path):
-        '''
-        Checks if directory set in path exists or not.
-        '''
-        return os.path.exists(path)
-
-    def save_file_in_tmp_path(self, file, filename):
+    def read_file(self, file):
         '''
-        Saves file in temporary path.
+        Returns whole content of an uploaded file as bytes.
         '''
-        with open(self.TMP_STORAGE_PATH+filename, 'wb') as destination:
-            for chunk in file.chunks():
-                destination.write(chunk)
-            destination.seek(0)
+        file.seek(0)
+        if file.multiple_chunks():
+            return b''.join(file.chunks())
+        return file.read()
 
-    def minify(self, filename):
+    def minify(self, content, filename):
         '''
-        Minifies a text file inplace.
+        Returns minified content of a text file or None if filename's type can not be minified.
         '''
         extension = filename.rsplit('.', maxsplit=1)[-1]
         if extension == 'css':
-            with open(self.TMP_STORAGE_PATH+filename, 'rt') as old_file:
-                style_str = old_file.read()
-            new_style = rcssmin.cssmin(style_str)
-            with open(self.TMP_STORAGE_PATH+filename, 'wt') as new_file:
-                new_file.write(new_style)
-            return True
+            return rcssmin.cssmin(content)
         elif extension == 'js':
-            with open(self.TMP_STORAGE_PATH+filename, 'rt') as old_file:
-                js_str = old_file.read()
-            new_js= rjsmin.jsmin(js_str)
-            with open(self.TMP_STORAGE_PATH+filename, 'wt') as new_file:
-                new_file.write(new_js)
-            return True
-        return False
+            return rjsmin.jsmin(content)
+        return None
 
-    def convert_to_webp(self, filename):
+    def convert_to_webp(self, content, filename):
         '''
-        Converts image file to webp.
+        Returns content of image file converted to webp or None if it is already webp.
         '''
         if filename.rsplit('.', maxsplit=1)[-1] == 'webp':
-            return False
-        source = pathlib.Path(self.TMP_STORAGE_PATH+filename)
-        destination = source.with_suffix('.webp')
-        image = Image.open(source)
-        image.save(destination, format='webp')
-        #os.remove(source)
-        return destination.name
+            return None
+        destination = io.BytesIO()
+        with Image.open(io.BytesIO(content)) as image:
+            image.save(destination, format='webp')
+        return destination.getvalue()
 
-    def file_exists(self, path, filename):
+    def hash_content(self, content):
         '''
-        Checks if a fie named filename exsits inside specified path.
+        Returns sha256 hex digest of content.
         '''
-        return os.path.exists(path+'/'+filename)
+        return hashlib.sha256(content).hexdigest()
 
-    def move_tmp_file_to_destination_path(self, path, tmp_filename, destination_filename):
+    @classmethod
+    def transform(cls, content, filename, minify=False, convert=False):
         '''
-        Moves file from temporary storage to designated storage.
+        Applies minification or convertion to content of filename.
+        Returns (result, final content). Result holds operation details, final filename, size and digest.
         '''
-        os.system(f"sudo mv {self.TMP_STORAGE_PATH+tmp_filename} {path+'/'+destination_filename}")
+        result = {}
+        if minify:
+            with TransformProfile() as profile:
+                minified = cls.minify(cls, content, filename)
+            result['minification'] = profile.as_dict()
+            metrics.TRANSFORM_LATENCY.observe(profile.wall_time, operation='minify')
+            if minified is not None:
+                content = minified
+        elif convert:
+            with TransformProfile() as profile:
+                converted = cls.convert_to_webp(cls, content, filename)
+            result['convertion'] = profile.as_dict()
+            metrics.TRANSFORM_LATENCY.observe(profile.wall_time, operation='convert')
+            if converted is not None:
+                content = converted
+                filename = filename.rsplit('.', maxsplit=1)[0]+'.webp'
+        result['filesize'] = len(content)
+        result['digest'] = cls.hash_content(cls, content)
+        result['filename'] = filename
+        return result, content
 
-    def remove_tmpfile(self, filename):
+    @classmethod
+    def prepare_file(cls, uploaded_file, minify=False, convert=False):
         '''
-        Removes file named filename from temporary storage.
+        Reads and transforms uploaded_file without storing it.
+        Returns (result, final content). Result holds final filename of the file.
         '''
-        return os.remove(self.TMP_STORAGE_PATH+filename)
+        result = {"overwritten": False}
+        transform_result, content = cls.transform(
+            cls.read_file(cls, uploaded_file),
+            cls.sanitize_filename(cls, str(uploaded_file)),
+            minify=minify,
+            convert=convert)
+        result.update(transform_result)
+        return result, content
 
-    @classmethod
-    def store_file(cls, path, uploaded_file, minify=False, convert=False):
+    def write_file(self, storage, namespace, result, content):
         '''
-        Store uploaded_file in specified path.
+        Writes final content of a file prepared by prepare_file in namespace of storage backend.
         '''
-        result = {"overwritten": False}
-        filename = cls.sanitize_filename(cls, str(uploaded_file))
-        if not cls.path_exists(cls, path):
-            os.system(f"sudo mkdir {path}")
-        tmp_filename = path.rsplit('/', maxsplit=1)[-1]+'.'+filename
-        cls.save_file_in_tmp_path(cls, uploaded_file, tmp_filename)
-        if minify:
-            start_time = time.process_time()
-            minify_profile = memory_usage(
-                (cls.minify, (cls, tmp_filename)),
-                max_usage=True,
-                retval=True,
-                max_iterations=1)
-            end_time = time.process_time()
-            time_spent = end_time - start_time
-            result['minification'] = {
-                'memory_usage': minify_profile[0]*1024*1024,
-                'cpu_time': time_spent
-                }
-        elif convert:
-            start_time = time.process_time()
-            convert_profile = memory_usage(
-                (cls.convert_to_webp, (cls, tmp_filename)),
-                max_usage=True,
-                retval=True,
-                max_iterations=1)
-            end_time = time.process_time()
-            time_spent = end_time - start_time
-            result['convertion'] = {
-                'memory_usage': convert_profile[0] * 1024 * 1024,
-                'cpu_time': time_spent
-            }
-            if convert_profile[1]:
-                cls.remove_tmpfile(cls, tmp_filename)
-                tmp_filename = convert_profile[1]
-                filename = tmp_filename.split('.', maxsplit=1)[1]
-        result['filesize'] = os.path.getsize(cls.TMP_STORAGE_PATH+tmp_filename)
-        if cls.file_exists(cls, path, filename):
+        if storage.stat(namespace, result['filename']) is not None:
             result['overwritten'] = True
-        cls.move_tmp_file_to_destination_path(cls, path, tmp_filename, filename)
-        result['filename'] = filename
+        storage.put(namespace, result['filename'], content, digest=result['digest'])
         return result
 
     @classmethod
-    def retrieve_file(cls, path, filename):
+    def store_file(cls, storage, namespace, uploaded_file, minify=False, convert=False):
         '''
-        Returns content of the file filename in path directory as bytes.
+        Store uploaded_file in namespace of storage backend.
+        Returns (result, final content of stored file).
         '''
-        try:
-            with open(path+filename, 'rb') as file_handler:
-                file_data = file_handler.read()
-        except:
-            return False
-        return file_data
+        result, content = cls.prepare_file(uploaded_file, minify=minify, convert=convert)
+        cls.write_file(cls, storage, namespace, result, content)
+        return result, content
 
 class SingletonMeta(type):
     """
@@ -163,14 +154,14 @@ class SingletonMeta(type):
     """
 
     _instance = None
-    _lock = threading.Lock()
+    _lock = threading.RLock()
 
     def __call__(cls, *args, **kwargs):
         """
         Makes changing __init__ definition in subclasses possible.
         """
         with cls._lock:
-            if not cls._instance:
+            if not cls.__dict__.get('_instance'):
                 cls._instance = super().__call__(*args, **kwargs)
         return cls._instance
 
@@ -178,6 +169,8 @@ class BaseCacheBackend(metaclass=SingletonMeta):
     '''
     Interface class for all cache backends.
     '''
+    LINK_SEPARATOR = '|'
+
     def add_record(self, key, value):
         '''
         adds key value pair to the cached records.
@@ -202,6 +195,143 @@ class BaseCacheBackend(metaclass=SingletonMeta):
         '''
         raise NotImplementedError("Not implemented by concrete cache backend in use.")
 
+    def delete_record(self, key):
+        '''
+        Removes key from the cached records.
+        '''
+        raise NotImplementedError("Not implemented by concrete cache backend in use.")
+
+    def split_link(self, link):
+        '''
+        Splits a link value into (target key, modification time in epoch seconds or None,
+        content type or None). Links are the target key, optionally followed by LINK_SEPARATOR
+        and modification time, and by LINK_SEPARATOR and content type of the target.
+        '''
+        if isinstance(link, bytes):
+            link = link.decode()
+        target, _, rest = link.partition(self.LINK_SEPARATOR)
+        modified, _, content_type = rest.partition(self.LINK_SEPARATOR)
+        return target, int(modified) if modified else None, content_type or None
+
+    def get_linked_record(self, key):
+        '''
+        Returns value of the record whose key is stored as value of key.
+        Backends should override this to resolve the link in a single round trip.
+        '''
+        link = self.get_record(key)
+        if not link:
+            return False
+        return self.get_record(self.split_link(link)[0])
+
+    def get_linked_record_if_changed(self, key, known_targets=(), known_since=None, max_size=None):
+        '''
+        Conditional version of get_linked_record. Returns False if key does not exist,
+        otherwise (link, value of linked record). value is None when the caller's copy is
+        current: link target is one of known_targets ('*' matches any), or known_targets is
+        empty and link is not modified after known_since. value is False if target is missing
+        and its size instead of value if it is larger than max_size (see get_record_up_to).
+        Backends should override this to answer in a single round trip.
+        '''
+        link = self.get_record(key)
+        if not link:
+            return False
+        if self.link_is_current(link, known_targets, known_since):
+            return link, None
+        return link, self.get_record_up_to(self.split_link(link)[0], max_size)
+
+    def link_is_current(self, link, known_targets=(), known_since=None):
+        '''
+        Returns True if the caller's copy of link's target is current (see get_linked_record_if_changed).
+        '''
+        target, modified, _ = self.split_link(link)
+        if known_targets:
+            return target in known_targets or '*' in known_targets
+        return known_since is not None and modified is not None and modified <= known_since
+
+    def get_record_up_to(self, key, max_size=None):
+        '''
+        Returns value of key, or its size if it is larger than max_size so it is to be read
+        with stream_record, or False if key does not exist.
+        In-process backends hold values in memory anyway, so they always return the value.
+        '''
+        return self.get_record(key) or False
+
+    def stream_record(self, key, start=0, stop=None, chunk_size=64*1024):
+        '''
+        Returns an iterator over chunks of value[start:stop] of key. Chunks of in-process
+        backends are memoryview slices, so the value is not copied.
+        Raises KeyError if key does not exist.
+        '''
+        value = self.get_record(key)
+        if not value:
+            raise KeyError(key)
+        return self._iter_slices(memoryview(value)[start:stop], chunk_size)
+
+    def _iter_slices(self, view, chunk_size):
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset+chunk_size]
+
+    def add_record_chunks(self, key, chunks):
+        '''
+        Sets value of key to concatenation of chunks. Returns length of value written.
+        Backends storing values out of process should override this to send chunks one at a time.
+        '''
+        value = b''.join(chunks)
+        return len(value) if self.add_record(key, value) else 0
+
+    def rename_record(self, key, new_key):
+        '''
+        Moves value of key to new_key, replacing it. Returns True on success.
+        '''
+        value = self.get_record(key)
+        if not value:
+            return False
+        self.add_record(new_key, value)
+        self.delete_record(key)
+        return True
+
+    def add_records(self, records):
+        '''
+        Adds all key value pairs of records dictionary to the cached records.
+        Backends should override this to write records in a single round trip.
+        '''
+        return [self.add_record(key, value) for key, value in records.items()]
+
+    def delete_records(self, keys):
+        '''
+        Removes several keys. Backends should override this to do it in a single round trip.
+        '''
+        return [self.delete_record(key) for key in keys]
+
+    def memory_used_by_keys(self, keys):
+        '''
+        Returns a list of memory used by each of keys in bytes.
+        Backends should override this to look keys up in a single round trip.
+        '''
+        return [self.memory_used_by_key(key) for key in keys]
+
+    def server_evicted_keys(self):
+        '''
+        Returns number of keys evicted by a cache server the backend uses, or None if it has none.
+        Evictions of in-process caches are counted in metrics as they happen.
+        '''
+        return None
+
+    def publish(self, channel, messages):
+        '''
+        Sends messages (strings) on channel to every process using the same cache server.
+        Returns False if backend has no server to send them through.
+        '''
+        return False
+
+    def subscribe(self, channel, handler, on_error):
+        '''
+        Calls handler(message) from a background thread for every message published on channel.
+        on_error() is called if subscription breaks, as messages may have been missed.
+        Returns False if backend has no server to receive messages from.
+        '''
+        return False
+
 class RedisCacheBackend(BaseCacheBackend):
     '''
     Cache backend based on Redis.
@@ -211,22 +341,362 @@ class RedisCacheBackend(BaseCacheBackend):
         'maxmemory-policy': 'allkeys-lru',
     }
 
+    GET_LINKED_SCRIPT = '''
+        local link = redis.call('GET', KEYS[1])
+        if not link then
+            return false
+        end
+        local separator = string.find(link, '|', 1, true)
+        if separator then
+            link = string.sub(link, 1, separator - 1)
+        end
+        return redis.call('GET', link)
+    '''
+    # ARGV[1] is known_since or an empty string, ARGV[2] is max_size or an empty string and
+    # the rest are known targets. Returns {link} if caller's copy is current, {link, value} if not,
+    # {link, size} if value is larger than max_size and {link, 0} if target is missing.
+    GET_LINKED_IF_CHANGED_SCRIPT = '''
+        local link = redis.call('GET', KEYS[1])
+        if not link then
+            return false
+        end
+        local target, modified = link, nil
+        local separator = string.find(link, '|', 1, true)
+        if separator then
+            target = string.sub(link, 1, separator - 1)
+            modified = tonumber(string.match(link, '^%d+', separator + 1))
+        end
+        if #ARGV > 2 then
+            for i = 3, #ARGV do
+                if ARGV[i] == target or ARGV[i] == '*' then
+                    return {link}
+                end
+            end
+        elseif ARGV[1] ~= '' and modified and modified <= tonumber(ARGV[1]) then
+            return {link}
+        end
+        if ARGV[2] ~= '' then
+            local size = redis.call('STRLEN', target)
+            if size > tonumber(ARGV[2]) then
+                return {link, size}
+            end
+        end
+        return {link, redis.call('GET', target) or 0}
+    '''
+    GET_UP_TO_SCRIPT = '''
+        local size = redis.call('STRLEN', KEYS[1])
+        if size > tonumber(ARGV[1]) then
+            return size
+        end
+        return redis.call('GET', KEYS[1])
+    '''
+
     def __init__(self, connection_info=None):
-        if connection_info is None:
-            self.redis = redis.Redis()
-        else:
-            self.redis = redis.Redis(host=connection_info['host'], port=connection_info['port'], db=connection_info['db'])
+        self.connection_info = connection_info
+        self._redis = None
+        self._get_linked_script = None
+        self._get_linked_if_changed_script = None
+        self._get_up_to_script = None
+
+    @property
+    def redis(self):
+        '''
+        Redis client created on first use on the shared connection pool.
+        '''
+        if self._redis is None:
+            self._redis = get_redis(self.connection_info)
+        return self._redis
+
+    def apply_memory_config(self):
+        '''
+        Applies memory_config to the Redis server. Run once per deployment.
+        '''
         for config in self.memory_config.keys():
             self.redis.config_set(config, self.memory_config[config])
 
     def add_record(self, key, value):
         return self.redis.set(key, value)
+    def add_records(self, records):
+        # Records are written in one MULTI/EXEC block, so readers never see a link before its content.
+        pipeline = self.redis.pipeline(transaction=True)
+        for key, value in records.items():
+            pipeline.set(key, value)
+        return pipeline.execute()
     def key_exists(self, key):
         return self.redis.exists(key)
     def get_record(self, key):
         return self.redis.get(key)
     def memory_used_by_key(self, key):
         return self.redis.memory_usage(key)
+    def delete_record(self, key):
+        return self.redis.delete(key)
+    def delete_records(self, keys):
+        return self.redis.delete(*keys) if keys else 0
+    def get_linked_record(self, key):
+        if self._get_linked_script is None:
+            self._get_linked_script = self.redis.register_script(self.GET_LINKED_SCRIPT)
+        return self._get_linked_script(keys=[key]) or False
+    def get_linked_record_if_changed(self, key, known_targets=(), known_since=None, max_size=None):
+        if self._get_linked_if_changed_script is None:
+            self._get_linked_if_changed_script = self.redis.register_script(self.GET_LINKED_IF_CHANGED_SCRIPT)
+        result = self._get_linked_if_changed_script(keys=[key], args=[
+            '' if known_since is None else known_since,
+            '' if max_size is None else max_size,
+            *known_targets])
+        if not result:
+            return False
+        if len(result) == 1:
+            return result[0], None
+        return result[0], result[1] or False
+
+    def get_record_up_to(self, key, max_size=None):
+        if max_size is None:
+            return self.get_record(key) or False
+        if self._get_up_to_script is None:
+            self._get_up_to_script = self.redis.register_script(self.GET_UP_TO_SCRIPT)
+        return self._get_up_to_script(keys=[key], args=[max_size]) or False
+    def stream_record(self, key, start=0, stop=None, chunk_size=64*1024):
+        if stop is None:
+            stop = self.redis.strlen(key)
+        return self._iter_ranges(key, start, stop, chunk_size)
+    def _iter_ranges(self, key, start, stop, chunk_size):
+        # Blob values never change, but they can be evicted between two GETRANGE calls.
+        for offset in range(start, stop, chunk_size):
+            expected = min(chunk_size, stop - offset)
+            chunk = self.redis.getrange(key, offset, offset + expected - 1)
+            if len(chunk) != expected:
+                raise KeyError(key)
+            yield chunk
+    def add_record_chunks(self, key, chunks):
+        self.redis.delete(key)
+        length = 0
+        for chunk in chunks:
+            length = self.redis.append(key, chunk)
+        return length
+    def rename_record(self, key, new_key):
+        try:
+            return self.redis.rename(key, new_key)
+        except redis.ResponseError:
+            return False
+    def memory_used_by_keys(self, keys):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        return pipeline.execute()
+
+    def server_evicted_keys(self):
+        return self.redis.info('stats')['evicted_keys']
+
+    def publish(self, channel, messages):
+        pipeline = self.redis.pipeline(transaction=False)
+        for message in messages:
+            pipeline.publish(channel, message)
+        pipeline.execute()
+        return True
+
+    def subscribe(self, channel, handler, on_error):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: handler(message['data'].decode())})
+        def handle_error(error, pubsub, thread):
+            thread.stop()
+            pubsub.close()
+            on_error()
+        pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=handle_error)
+        return True
+
+class TwoTierCacheBackend(BaseCacheBackend):
+    '''
+    Cache backend keeping a small in-process LRU (L1) in front of Redis (L2).
+    Overwrites are announced over Redis pub/sub so every worker drops its stale L1 copy.
+    L2 is only used through the backend interface; values are not promoted to L1 if L2
+    can not deliver invalidations (see BaseCacheBackend.subscribe).
+    '''
+    memory_config = {
+        'maxmemory': 64*1024*1024,
+        'max_entry_size': 256*1024,
+        'ttl': 30,
+    }
+    INVALIDATION_CHANNEL = 'content-cache:invalidate'
+
+    def __init__(self, backend=None, **kwargs):
+        config = dict(self.memory_config, **kwargs)
+        self.max_entry_size = config['max_entry_size']
+        self.ttl = config['ttl']
+        self._l1 = LRUCache(config['maxmemory'], on_evict=metrics.evictions_counter(type(self).__name__))
+        if isinstance(backend, str):
+            backend = import_string(backend)()
+        self._l2 = backend if backend is not None else RedisCacheBackend()
+        self._origin = uuid.uuid4().hex
+        self._subscribed = False
+        self._subscriber_pid = None
+        self._subscriber_lock = threading.Lock()
+        self._stats = {
+            'l1': {'hits': 0, 'misses': 0, 'promotions': 0},
+            'l2': {'hits': 0, 'misses': 0},
+        }
+        self._stats_lock = threading.Lock()
+
+    def count(self, tier, counter):
+        '''
+        Increments counter of tier.
+        '''
+        with self._stats_lock:
+            self._stats[tier][counter] += 1
+        metrics.CACHE_TIER_EVENTS.inc(tier=tier, event=counter)
+
+    def stats(self):
+        '''
+        Returns hit, miss and promotion counters of each tier.
+        '''
+        with self._stats_lock:
+            return {tier: dict(counters) for tier, counters in self._stats.items()}
+
+    def handle_invalidation(self, message):
+        '''
+        Drops L1 copy of a key overwritten by another worker.
+        '''
+        origin, key = message.split(':', maxsplit=1)
+        if origin != self._origin:
+            self._l1.delete(key)
+
+    def handle_subscription_error(self):
+        '''
+        Invalidations may have been missed, so L1 is flushed and the subscription renewed on next use.
+        '''
+        self._l1.clear()
+        self._subscribed = False
+
+    def ensure_subscriber(self):
+        '''
+        Subscribes current process to invalidations. Returns True if it is subscribed.
+        '''
+        if self._subscribed and self._subscriber_pid == os.getpid():
+            return True
+        with self._subscriber_lock:
+            if self._subscribed and self._subscriber_pid == os.getpid():
+                return True
+            try:
+                subscribed = self._l2.subscribe(
+                    self.INVALIDATION_CHANNEL, self.handle_invalidation, self.handle_subscription_error)
+            except redis.RedisError:
+                return False
+            if not subscribed:
+                return False
+            self._l1.clear()
+            self._subscribed = True
+            self._subscriber_pid = os.getpid()
+        return True
+
+    def invalidate(self, keys):
+        '''
+        Drops L1 copies of keys in this and every other worker.
+        '''
+        for key in keys:
+            self._l1.delete(key)
+        self._l2.publish(self.INVALIDATION_CHANNEL, [f"{self._origin}:{key}" for key in keys])
+
+    def add_record(self, key, value):
+        result = self._l2.add_record(key, value)
+        self.invalidate([key])
+        return result
+
+    def add_records(self, records):
+        result = self._l2.add_records(records)
+        self.invalidate(list(records.keys()))
+        return result
+
+    def delete_record(self, key):
+        result = self._l2.delete_record(key)
+        self.invalidate([key])
+        return result
+
+    def delete_records(self, keys):
+        result = self._l2.delete_records(keys)
+        self.invalidate(keys)
+        return result
+
+    def key_exists(self, key):
+        return key in self._l1 or self._l2.key_exists(key)
+
+    def get_record(self, key):
+        value = self._l1.get(key)
+        if value is not None:
+            self.count('l1', 'hits')
+            return value
+        self.count('l1', 'misses')
+        value = self._l2.get_record(key)
+        if not value:
+            self.count('l2', 'misses')
+            return False
+        self.count('l2', 'hits')
+        self.promote(key, value)
+        return value
+
+    def promote(self, key, value):
+        '''
+        Copies value of key read from L2 into L1, unless it is larger than max_entry_size.
+        '''
+        if len(value) <= self.max_entry_size and self.ensure_subscriber() \
+            and self._l1.put(key, value, ttl=self.ttl):
+            self.count('l1', 'promotions')
+
+    def get_linked_record_if_changed(self, key, known_targets=(), known_since=None, max_size=None):
+        link = self._l1.get(key)
+        if link is not None:
+            self.count('l1', 'hits')
+            if self.link_is_current(link, known_targets, known_since):
+                return link, None
+            return link, self.get_record_up_to(self.split_link(link)[0], max_size)
+        # Link and target are resolved by L2 at once and both promoted.
+        self.count('l1', 'misses')
+        result = self._l2.get_linked_record_if_changed(key, known_targets, known_since, max_size)
+        if not result:
+            self.count('l2', 'misses')
+            return False
+        self.count('l2', 'hits')
+        link, value = result
+        self.promote(key, link)
+        if isinstance(value, bytes):
+            self.promote(self.split_link(link)[0], value)
+        return result
+
+    def get_record_up_to(self, key, max_size=None):
+        value = self._l1.get(key)
+        if value is not None:
+            self.count('l1', 'hits')
+            return value
+        # Values larger than max_size are left in L2 and streamed from there.
+        self.count('l1', 'misses')
+        value = self._l2.get_record_up_to(key, max_size)
+        self.count('l2', 'hits' if value else 'misses')
+        if isinstance(value, bytes):
+            self.promote(key, value)
+        return value
+
+    def stream_record(self, key, start=0, stop=None, chunk_size=64*1024):
+        value = self._l1.get(key)
+        if value is not None:
+            return self._iter_slices(memoryview(value)[start:stop], chunk_size)
+        return self._l2.stream_record(key, start, stop, chunk_size)
+
+    def add_record_chunks(self, key, chunks):
+        result = self._l2.add_record_chunks(key, chunks)
+        self.invalidate([key])
+        return result
+
+    def rename_record(self, key, new_key):
+        result = self._l2.rename_record(key, new_key)
+        self.invalidate([key, new_key])
+        return result
+
+    def memory_used_by_key(self, key):
+        return self._l2.memory_used_by_key(key)
+
+    def memory_used_by_keys(self, keys):
+        return self._l2.memory_used_by_keys(keys)
+
+    def server_evicted_keys(self):
+        return self._l2.server_evicted_keys()
 
 class CustomCacheBackend(BaseCacheBackend):
     '''
@@ -235,65 +705,121 @@ class CustomCacheBackend(BaseCacheBackend):
     memory_config = {
         'maxmemory': 512*1024*1024,
     }
-    _total_memory_used = 0
-    _last_used_key = []
-    _cache = {}
-    _size_cache = {}
 
     def __init__(self, **kwargs):
-        self.called = 0
-        self._cache = {}
-        self._size_cache = {}
+        self._cache = LRUCache(
+            kwargs.get('maxmemory', self.memory_config['maxmemory']),
+            on_evict=metrics.evictions_counter(type(self).__name__))
 
     def clear_space(self, needed_space):
         '''
         Keeps removing records from cache based on last time they were used.
         '''
-        saved_space = 0
-        removed_keys = []
-        for key in self._last_used_key:
-            del self._cache[key]
-            saved_space = saved_space + self._size_cache[key]
-            self._total_memory_used = self._total_memory_used - self._size_cache[key]
-            del self._size_cache[key]
-            removed_keys.append(key)
-            if saved_space >= needed_space:
-                for removed_key in removed_keys:
-                    self._last_used_key.remove(removed_key)
-                return True
-        for removed_key in removed_keys:
-            self._last_used_key.remove(removed_key)
-        return False
+        return self._cache.evict(needed_space)
 
     def add_record(self, key, value):
         '''
         Adds key-value pair to cache records. Returns True on success and False otherwise.
         '''
-        value_size = sys.getsizeof(value)
-        if value_size + self._total_memory_used > self.memory_config['maxmemory'] and not self.clear_space(self._total_memory_used + value_size - self.memory_config['maxmemory']):
-            return False
-        self._cache[key] = value
-        self._total_memory_used = self._total_memory_used + value_size
-        self._last_used_key.append(key)
-        self._size_cache[key] = value_size
-        return True
+        return self._cache.put(key, value)
 
     def key_exists(self, key):
-        return key in self._cache.keys()
+        return key in self._cache
+
+    def delete_record(self, key):
+        return self._cache.delete(key)
 
     def get_record(self, key):
-        if not self.key_exists(key):
-            return False
-        if key in self._last_used_key:
-            self._last_used_key.remove(key)
-            self._last_used_key.append(key)
-        return self._cache[key]
+        return self._cache.get(key, False)
 
     def memory_used_by_key(self, key):
-        if self.key_exists(key):
-            return self._size_cache[key]
-        else:
-            return 0
+        return self._cache.size_of(key)
+
+    def memory_used_by_keys(self, keys):
+        return [self._cache.size_of(key) for key in keys]
+
+class ShardedCacheBackend(BaseCacheBackend):
+    '''
+    In-process cache backend that spreads keys over independent LRU shards.
+    Each shard has its own lock and an equal share of maxmemory, so threads
+    working on different keys do not contend on a single structure.
+    '''
+    memory_config = {
+        'maxmemory': 512*1024*1024,
+    }
+    SHARDS = 16
+
+    def __init__(self, **kwargs):
+        maxmemory = kwargs.get('maxmemory', self.memory_config['maxmemory'])
+        shards = kwargs.get('shards', self.SHARDS)
+        on_evict = metrics.evictions_counter(type(self).__name__)
+        self._shards = [LRUCache(maxmemory // shards, on_evict=on_evict) for _ in range(shards)]
+
+    def get_shard(self, key):
+        '''
+        Returns shard responsible for key.
+        '''
+        return self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+
+    def add_record(self, key, value):
+        return self.get_shard(key).put(key, value)
+
+    def key_exists(self, key):
+        return key in self.get_shard(key)
+
+    def delete_record(self, key):
+        return self.get_shard(key).delete(key)
+
+    def get_record(self, key):
+        return self.get_shard(key).get(key, False)
+
+    def memory_used_by_key(self, key):
+        return self.get_shard(key).size_of(key)
+
+    def memory_used_by_keys(self, keys):
+        return [self.get_shard(key).size_of(key) for key in keys]
+
+class SharedMemoryCacheBackend(BaseCacheBackend):
+    '''
+    Cache backend stored in a memory mapped file shared by all worker processes on a host.
+    '''
+    memory_config = {
+        'maxmemory': 512*1024*1024,
+        'slots': 65536,
+        'path': '/dev/shm/content-cache.arena',
+    }
+
+    def __init__(self, **kwargs):
+        config = dict(self.memory_config, **kwargs)
+        self._arena = SharedMemoryArena(
+            config['path'], config['maxmemory'], config['slots'],
+            on_evict=metrics.evictions_counter(type(self).__name__))
+
+    def add_record(self, key, value):
+        return self._arena.put(key, value)
+
+    def key_exists(self, key):
+        return key in self._arena
+
+    def delete_record(self, key):
+        return self._arena.delete(key)
+
+    def get_record(self, key):
+        return self._arena.get(key, False)
+
+    def memory_used_by_key(self, key):
+        return self._arena.size_of(key)
+
+    def memory_used_by_keys(self, keys):
+        return self._arena.sizes_of(keys)
+
+def get_cache_backend():
+    '''
+    Returns cache backend configured by CONTENT_CACHE_BACKEND setting.
+    '''
+    config = getattr(settings, 'CONTENT_CACHE_BACKEND', {})
+    backend_class = import_string(config.get('BACKEND', 'cachemanager.cachelib.RedisCacheBackend'))
+    return backend_class(**config.get('OPTIONS', {}))
 
 class CacheMan:
     '''
@@ -308,11 +834,22 @@ class CacheMan:
         'image':
             ['jpg', 'jpeg', 'png', 'webp'],
     }
-    BASE_STORAGE_PATH = "/opt/"
+    UPLOAD_WORKERS = 4
+    BLOB_KEY_PREFIX = "blob_"
+    # Cache-Control max-age in seconds by file extension or file type.
+    MAX_AGE = getattr(settings, 'CONTENT_CACHE_MAX_AGE', {'text': 3600, 'image': 86400})
+    TRANSFORM_WORKERS = 2
+    MIME_SNIFF_SIZE = 4096
+    # Larger files are sent in chunks of STREAM_CHUNK_SIZE, rather than read as a whole.
+    STREAM_THRESHOLD = 1024*1024
+    STREAM_CHUNK_SIZE = 256*1024
 
     #Low-level classes
     _file_manager = FileMan
-    _cache_backend = RedisCacheBackend()
+    _storage_backend = get_storage_backend()
+    _cache_backend = get_cache_backend()
+    _transform_queue = JobQueue(TRANSFORM_WORKERS)
+    _image_transcoder = ImageTranscoder.from_settings()
 
     def verify_file_size(self, uploaded_file):
         '''
@@ -324,7 +861,9 @@ class CacheMan:
         '''
         Checks if uploaded_file's type is within allowed file extensions.
         '''
-        mime_type = magic.from_buffer(uploaded_file.read(), mime=True).split('/')
+        uploaded_file.seek(0)
+        with metrics.MIME_SNIFF_LATENCY.time():
+            mime_type = magic.from_buffer(uploaded_file.read(self.MIME_SNIFF_SIZE), mime=True).split('/')
         uploaded_file.seek(0)
         if not mime_type[0] in self.ALLOWED_FILE_TYPES:
             return False
@@ -335,59 +874,466 @@ class CacheMan:
             return mime_type
         return False
     
-    def generate_file_path(self, uploaded_file, owner):
+    def generate_namespace(self, owner):
         '''
-        Returns absoloute path in which uploaded file should be saved
-        according to configuration and uploaded_file.
+        Returns storage namespace in which files of owner are saved.
         '''
-        return self.BASE_STORAGE_PATH+str(owner.username)
+        return str(owner.username)
 
-    def add_file_record_in_database(self, file_info, owner):
+    TEXT_DETAIL_FIELDS = ['minify', 'minification_time', 'minification_memory']
+    IMAGE_DETAIL_FIELDS = ['convert_to_webp', 'convertion_time', 'convertion_memory']
+
+    def set_text_details(self, txt_file, file_info):
         '''
-        Adds or updates database record representing added file.
+        Fills minification details of txt_file from file_info.
         '''
-        try:
-            base_file = BaseFile.objects.get(owner=owner, filename=file_info['filename'])
-            base_file.size = file_info['filesize']
-        except BaseFile.DoesNotExist:
-            base_file = BaseFile.objects.create(owner=owner, filename=file_info['filename'], size=file_info['filesize'])
+        if 'minification' in file_info.keys():
+            txt_file.minify=True
+            txt_file.minification_time = file_info['minification']['cpu_time']
+            txt_file.minification_memory = file_info['minification']['memory_usage']
+        else:
+            txt_file.minify = False
+            txt_file.minification_time = txt_file.minification_memory = None
+
+    def set_image_details(self, image_file, file_info):
+        '''
+        Fills convertion details of image_file from file_info.
+        '''
+        if 'convertion' in file_info.keys():
+            image_file.convert_to_webp = True
+            image_file.convertion_time = file_info['convertion']['cpu_time']
+            image_file.convertion_memory = file_info['convertion']['memory_usage']
+        else:
+            image_file.convert_to_webp = False
+            image_file.convertion_time = image_file.convertion_memory = None
+
+    def reference_blobs(self, blobs):
+        '''
+        Adds one reference to the blob of each (digest, size) pair, creating missing Blob rows.
+        Creation and counting are a single upsert, so a blob released by a concurrent transaction
+        is either kept alive or created again, never counted after it was deleted.
+        Must run inside a transaction, before rows referencing the blobs are saved.
+        '''
+        counts = collections.Counter(digest for digest, _ in blobs)
+        if not counts:
+            return
+        sizes = dict(blobs)
+        table = connection.ops.quote_name(Blob._meta.db_table)
+        # Rows are upserted in digest order, so concurrent uploads lock them in the same order.
+        values = [(digest, sizes[digest], counts[digest]) for digest in sorted(counts)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (digest, size, reference_count) VALUES "
+                + ", ".join(["(%s, %s, %s)"] * len(values))
+                + f" ON CONFLICT (digest) DO UPDATE SET reference_count = {table}.reference_count"
+                " + EXCLUDED.reference_count",
+                [value for row in values for value in row])
+
+    def release_blobs(self, digests):
+        '''
+        Removes one reference from the blob of each digest (None digests are skipped).
+        Blobs that are not referenced anymore are removed from database and,
+        once transaction commits, from cache. Must run inside a transaction.
+        Reference counts only decide lifetime of Blob rows and cached content; stored files
+        are owned by the storage backend (see ContentAddressedStorageBackend.release).
+        '''
+        counts = collections.Counter(digest for digest in digests if digest)
+        for digest in sorted(counts):
+            Blob.objects.filter(digest=digest).update(reference_count=F('reference_count') - counts[digest])
+        removed = list(Blob.objects.filter(
+            digest__in=counts.keys(), reference_count=0).values_list('digest', flat=True))
+        if removed:
+            Blob.objects.filter(digest__in=removed).delete()
+            transaction.on_commit(lambda: [
+                self._cache_backend.delete_record(self.generate_blob_key(self, digest)) for digest in removed])
+        return removed
+
+    def schedule_image_variants(self, base_files, owner):
+        '''
+        Once transaction commits, drops negotiated variant links of base_files owned
+        by owner and queues generation of their image variants.
+        '''
+        if not self._image_transcoder.active:
+            return
+        for base_file in base_files:
+            transaction.on_commit(lambda base_file=base_file: (
+                self.forget_variant_links(self, owner, base_file.filename),
+                self._transform_queue.submit(self.generate_image_variants, base_file.id, base_file.blob_id)))
+
+    def schedule_text_encodings(self, base_files, owner):
+        '''
+        Once transaction commits, drops encoded links of text files base_files owned by owner
+        and queues their precompression.
+        '''
+        for base_file in base_files:
+            transaction.on_commit(lambda base_file=base_file: (
+                self.forget_encoded_links(self, owner, base_file.filename),
+                self._transform_queue.submit(self.generate_text_encodings, base_file.id, base_file.blob_id)))
+
+    def upsert_file_details(self, base_files, files_info):
+        '''
+        Creates or updates TextFile/ImageFile rows of base_files with one upsert per model,
+        filled from files_info (a dictionary mapping filenames to file information).
+        Returns lists of base files having text and image details.
+        '''
+        text_files, image_files = [], []
+        for base_file in base_files:
+            file_info = files_info[base_file.filename]
             if file_info['uploaded_file_type'][0] == 'text':
-                txt_file = TextFile.objects.create(base_file=base_file)
+                txt_file = TextFile(base_file=base_file)
+                self.set_text_details(self, txt_file, file_info)
+                text_files.append(txt_file)
             elif file_info['uploaded_file_type'][0] == 'image':
-                image_file = ImageFile.objects.create(base_file=base_file)
-        try:
-            txt_file = base_file.txtdetails
-            if 'minification' in file_info.keys():
-                txt_file.minify=True
-                txt_file.minification_time = file_info['minification']['cpu_time']
-                txt_file.minification_memory = int(file_info['minification']['memory_usage'])
-            else:
-                txt_file.minify = False
-                txt_file.minification_time = txt_file.minification_memory = None
-            txt_file.save()
-        except:
-            pass
-        try:
-            image_file = base_file.imgdetails
-            if 'convertion' in file_info.keys():
-                image_file.convert_to_webp = True
-                image_file.convertion_time = file_info['convertion']['cpu_time']
-                image_file.convertion_memory = file_info['convertion']['memory_usage']
-            else:
-                image_file.convert_to_webp = False
-                image_file.convertion_time = image_file.convertion_memory = None
-            image_file.save()
-        except:
-            pass        
+                image_file = ImageFile(base_file=base_file)
+                self.set_image_details(self, image_file, file_info)
+                image_files.append(image_file)
+        if text_files:
+            TextFile.objects.bulk_create(
+                text_files, update_conflicts=True, unique_fields=['base_file'], update_fields=self.TEXT_DETAIL_FIELDS)
+        if image_files:
+            ImageFile.objects.bulk_create(
+                image_files, update_conflicts=True, unique_fields=['base_file'], update_fields=self.IMAGE_DETAIL_FIELDS)
+        return (
+            [txt_file.base_file for txt_file in text_files],
+            [image_file.base_file for image_file in image_files],
+            )
+
+    def save_base_files(self, files_info, owner):
+        '''
+        Updates BaseFile rows of files owned by owner and creates the missing ones, given
+        files_info (a dictionary mapping filenames to file information). Must run inside a transaction.
+        Returns (dictionary mapping filenames to BaseFile objects, (old digest, new digest) pairs).
+        '''
+        now = timezone.now()
+        base_files, blob_changes = {}, []
+        pending = dict(files_info)
+        conflict = None
+        while pending:
+            # Rows are locked before they are updated, so their previous blobs are known for reference counting.
+            locked = list(BaseFile.objects.select_for_update().filter(owner=owner, filename__in=pending.keys()))
+            if conflict is not None and not locked:
+                # No concurrent upload created these filenames, so the error (e.g. a missing
+                # foreign key) would be raised by every round.
+                raise conflict
+            for base_file in locked:
+                file_info = pending.pop(base_file.filename)
+                blob_changes.append((base_file.blob_id, file_info['digest']))
+                base_file.size = file_info['filesize']
+                base_file.blob_id = file_info['digest']
+                base_file.last_update_time = now
+                base_files[base_file.filename] = base_file
+            BaseFile.objects.bulk_update(locked, ['size', 'blob', 'last_update_time'])
+            try:
+                with transaction.atomic():
+                    new_files = BaseFile.objects.bulk_create([
+                        BaseFile(owner=owner, filename=filename, size=file_info['filesize'], blob_id=file_info['digest'])
+                        for filename, file_info in pending.items()
+                        ])
+            except IntegrityError as error:
+                # A concurrent upload created some of these filenames first, they are locked
+                # and updated by the next round.
+                conflict = error
+                continue
+            for base_file in new_files:
+                blob_changes.append((None, base_file.blob_id))
+                base_files[base_file.filename] = base_file
+            pending = {}
+        return base_files, blob_changes
+
+    def add_file_records_in_database(self, files_info, owner):
+        '''
+        Adds or updates database records of several files in one transaction
+        using bulk queries. Returns a dictionary mapping filenames to BaseFile objects.
+        '''
+        files_info = {file_info['filename']: file_info for file_info in files_info}
+        with transaction.atomic():
+            self.reference_blobs(self, [
+                (file_info['digest'], file_info['filesize']) for file_info in files_info.values()])
+            base_files, blob_changes = self.save_base_files(self, files_info, owner)
+            # New blobs were referenced above, so a file keeping its content releases and references it.
+            self.release_blobs(self, [old_digest for old_digest, _ in blob_changes])
+            text_files, image_files = self.upsert_file_details(self, base_files.values(), files_info)
+            self.schedule_text_encodings(self, text_files, owner)
+            self.schedule_image_variants(self, image_files, owner)
+        return base_files
+
+    def add_file_record_in_database(self, file_info, owner):
+        '''
+        Adds or updates database record representing added file.
+        '''
+        with transaction.atomic():
+            self.reference_blobs(self, [(file_info['digest'], file_info['filesize'])])
+            # Row is locked before it is updated, so its previous blob is known for reference counting.
+            # Concurrent creation of the same row is resolved by unique (owner, filename) constraint.
+            base_file, created = BaseFile.objects.select_for_update().get_or_create(
+                owner=owner,
+                filename=file_info['filename'],
+                defaults={'size': file_info['filesize'], 'blob_id': file_info['digest']})
+            old_digest = None if created else base_file.blob_id
+            if not created:
+                base_file.size = file_info['filesize']
+                base_file.blob_id = file_info['digest']
+                base_file.save(update_fields=['size', 'blob', 'last_update_time'])
+            text_files, image_files = self.upsert_file_details(self, [base_file], {base_file.filename: file_info})
+            self.schedule_text_encodings(self, text_files, owner)
+            self.schedule_image_variants(self, image_files, owner)
+            self.release_blobs(self, [old_digest])
         return base_file
 
+    def time_cache_backend(self, operation):
+        '''
+        Returns a context manager observing latency of a cache backend operation ('get' or 'set').
+        '''
+        return metrics.BACKEND_LATENCY.time(backend=type(self._cache_backend).__name__, operation=operation)
+
+    def count_cache_lookup(self, result):
+        '''
+        Counts a cache lookup of cache backend as 'hit' or 'miss'.
+        '''
+        metrics.CACHE_REQUESTS.inc(backend=type(self._cache_backend).__name__, result=result)
+
     def generate_key(self, owner_username, filename):
         return f"{owner_username}_{filename}"
 
+    def generate_variant_link_key(self, owner_username, filename, formats):
+        '''
+        Returns key linking to the smallest of filename and its variants encoded in one of formats.
+        '''
+        return f"{self.generate_key(self, owner_username, filename)}?{','.join(sorted(formats))}"
+
+    def forget_variant_links(self, owner, filename):
+        '''
+        Removes negotiated variant links of filename, so they are rebuilt from current variants.
+        '''
+        formats = self._image_transcoder.formats
+        keys = [
+            self.generate_variant_link_key(self, owner.username, filename, subset)
+            for size in range(1, len(formats) + 1)
+            for subset in itertools.combinations(formats, size)
+            ]
+        return self._cache_backend.delete_records(keys)
+
+    def accepted_variant_formats(self, filename, accept):
+        '''
+        Returns variant formats of image filename allowed by Accept header value accept,
+        or None if filename has no variants to negotiate.
+        Only explicitly listed media types count, as */* and image/* do not promise support of newer formats.
+        '''
+        if not self._image_transcoder.active \
+                or filename.rsplit('.', maxsplit=1)[-1] not in self.ALLOWED_FILE_TYPES['image']:
+            return None
+        accepted = set()
+        for media_range in accept.split(','):
+            media_type, _, parameters = media_range.partition(';')
+            quality = 1.0
+            for parameter in parameters.split(';'):
+                name, _, value = parameter.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                accepted.add(media_type.strip().lower())
+        return [
+            image_format for image_format in self._image_transcoder.formats
+            if f"image/{image_format}" in accepted
+            ]
+
+    def generate_encoded_link_key(self, owner_username, filename, encoding):
+        '''
+        Returns key linking to content of filename compressed with encoding.
+        '''
+        return f"{self.generate_key(self, owner_username, filename)};{encoding}"
+
+    def forget_encoded_links(self, owner, filename):
+        '''
+        Removes encoded links of filename, so they are rebuilt from current text variants.
+        '''
+        return self._cache_backend.delete_records([
+            self.generate_encoded_link_key(self, owner.username, filename, encoding)
+            for encoding in compression.ENCODINGS
+            ])
+
+    def max_age(self, filename):
+        '''
+        Returns Cache-Control max-age of filename from MAX_AGE, looked up by extension, then by file type.
+        '''
+        extension = filename.rsplit('.', maxsplit=1)[-1]
+        if extension in self.MAX_AGE:
+            return self.MAX_AGE[extension]
+        for file_type, extensions in self.ALLOWED_FILE_TYPES.items():
+            if extension in extensions:
+                return self.MAX_AGE.get(file_type, 0)
+        return 0
+
+    def accepted_encodings(self, filename, accept_encoding):
+        '''
+        Returns encodings allowed by Accept-Encoding header value accept_encoding, most preferred
+        first, or None if filename is not a text file having precompressed variants.
+        '''
+        if filename.rsplit('.', maxsplit=1)[-1] not in self.ALLOWED_FILE_TYPES['text']:
+            return None
+        return compression.accepted_encodings(accept_encoding)
+
+    def generate_blob_key(self, digest):
+        return f"{self.BLOB_KEY_PREFIX}{digest}"
+
+    def accel_redirect_location(self):
+        '''
+        Returns internal nginx location serving storage root (CONTENT_CACHE_X_ACCEL_REDIRECT setting),
+        or None if downloads are not sent by nginx.
+        '''
+        return getattr(settings, 'CONTENT_CACHE_X_ACCEL_REDIRECT', None)
+
+    def generate_link(self, blob_key, last_modified, content_type=None):
+        '''
+        Returns link to blob_key. The link also carries last_modified, so conditional
+        requests are answered from the link alone, and content_type of blob if it is given.
+        '''
+        separator = self._cache_backend.LINK_SEPARATOR
+        link = f"{blob_key}{separator}{int(last_modified.timestamp())}"
+        if content_type is not None:
+            link = f"{link}{separator}{content_type}"
+        return link
+
+    def link_records(self, key, file_data, digest, last_modified, content_type=None):
+        '''
+        Returns cache records storing file_data once under its content digest and a link to it under key.
+        '''
+        blob_key = self.generate_blob_key(self, digest)
+        return {blob_key: file_data, key: self.generate_link(self, blob_key, last_modified, content_type)}
+
+    def cache_records(self, owner, filename, file_data, last_modified, digest=None):
+        '''
+        Returns cache records storing file_data once under its content digest and
+        a link to it under owner's filename.
+        '''
+        if digest is None:
+            digest = self._file_manager.hash_content(self._file_manager, file_data)
+        return self.link_records(
+            self, self.generate_key(self, owner.username, filename), file_data, digest, last_modified)
+
+    def content_stream(self, content):
+        '''
+        Returns stream function (see representation) of content held in memory.
+        Chunks are memoryview slices, so content is not copied.
+        '''
+        view = memoryview(content)
+        def stream(start=0, stop=None):
+            part = view[start:stop]
+            return (
+                part[offset:offset+self.STREAM_CHUNK_SIZE]
+                for offset in range(0, len(part), self.STREAM_CHUNK_SIZE)
+                )
+        return stream
+
+    def representation(self, file_data, digest, last_modified, etags=(), modified_since=None, size=None, stream=None):
+        '''
+        Returns a dictionary describing content sent to a client: modified, content (bytes or None
+        for large files), size, stream (function returning an iterator over chunks of content[start:stop]),
+        etag (content digest) and last_modified (epoch seconds). Large files are given by size and stream
+        instead of file_data. modified is False and there is no content if client's copy, identified by
+        etags (If-None-Match) or modified_since (If-Modified-Since), is current.
+        '''
+        if etags:
+            current = digest in etags or '*' in etags
+        else:
+            current = modified_since is not None and last_modified is not None and last_modified <= modified_since
+        if current:
+            file_data, stream = None, None
+        elif file_data is not None:
+            size, stream = len(file_data), self.content_stream(self, file_data)
+        return {
+            'modified': not current,
+            'content': file_data,
+            'size': size,
+            'stream': stream,
+            'etag': digest,
+            'last_modified': last_modified,
+        }
+
     @classmethod
-    def add_file_record(cls, uploaded_file, owner, minify=False, convert=False, **kwargs):
+    def retrieve_linked_from_cache(cls, key, etags=(), modified_since=None, typed=False):
         '''
-        Saves file in physical storage and creates db entry for that file.
+        Returns representation of content linked by key, without fetching content if client's
+        copy is current, with content_type carried by the link. Returns False on a cache miss.
+        If typed is set, links not carrying a content type are treated as misses.
+        '''
+        known_targets = [etag if etag == '*' else cls.generate_blob_key(cls, etag) for etag in etags]
+        with cls.time_cache_backend(cls, 'get'):
+            result = cls._cache_backend.get_linked_record_if_changed(
+                key, known_targets, modified_since, max_size=cls.STREAM_THRESHOLD)
+        if result:
+            link, file_data = result
+            blob_key, last_modified, content_type = cls._cache_backend.split_link(link)
+        # Links written before they carried modification time (or content type) are rebuilt.
+        if not result or file_data is False or last_modified is None or (typed and content_type is None):
+            cls.count_cache_lookup(cls, 'miss')
+            return False
+        cls.count_cache_lookup(cls, 'hit')
+        digest = blob_key[len(cls.BLOB_KEY_PREFIX):]
+        if isinstance(file_data, int):
+            # Large content is streamed from cache, file_data is its size.
+            stream = functools.partial(cls._cache_backend.stream_record, blob_key, chunk_size=cls.STREAM_CHUNK_SIZE)
+            representation = cls.representation(cls, None, digest, last_modified, size=file_data, stream=stream)
+        else:
+            representation = cls.representation(cls, file_data, digest, last_modified, etags, modified_since)
+        return dict(representation, content_type=content_type)
+
+    @classmethod
+    def cache_stored_file(cls, key, owner, name, last_modified, etags=(), modified_since=None, content_type=None):
+        '''
+        Caches stored file name of owner under its content digest, links key to it and returns
+        its representation. content_type, if given, is kept on the link and in the representation.
+        Returns False if file does not exist. Files larger than STREAM_THRESHOLD
+        are copied to cache chunk by chunk and streamed, so they are never held in memory as a whole.
+        '''
+        namespace = cls.generate_namespace(cls, owner)
+        file_stat = cls._storage_backend.stat(namespace, name)
+        if file_stat is None:
+            return False
+        if file_stat['size'] <= cls.STREAM_THRESHOLD:
+            file_data = cls._storage_backend.get(namespace, name)
+            if not file_data:
+                return False
+            digest = cls._file_manager.hash_content(cls._file_manager, file_data)
+            with cls.time_cache_backend(cls, 'set'):
+                cls._cache_backend.add_records(cls.link_records(cls, key, file_data, digest, last_modified, content_type))
+            return dict(
+                cls.representation(cls, file_data, digest, int(last_modified.timestamp()), etags, modified_since),
+                content_type=content_type)
+        chunks = cls._storage_backend.stream(namespace, name, chunk_size=cls.STREAM_CHUNK_SIZE)
+        if chunks is None:
+            return False
+        hasher = hashlib.sha256()
+        size = 0
+        def hashed_chunks():
+            nonlocal size
+            for chunk in chunks:
+                hasher.update(chunk)
+                size = size + len(chunk)
+                yield chunk
+        # Digest is known only after content is written, so it is written under a temporary key first.
+        partial_key = f"{cls.BLOB_KEY_PREFIX}partial_{uuid.uuid4().hex}"
+        written = cls._cache_backend.add_record_chunks(partial_key, hashed_chunks())
+        blob_key = cls.generate_blob_key(cls, hasher.hexdigest())
+        if written == size and cls._cache_backend.rename_record(partial_key, blob_key):
+            cls._cache_backend.add_record(key, cls.generate_link(cls, blob_key, last_modified, content_type))
+            stream = functools.partial(cls._cache_backend.stream_record, blob_key, chunk_size=cls.STREAM_CHUNK_SIZE)
+        else:
+            # Partially written content was evicted, file is streamed from storage instead.
+            cls._cache_backend.delete_record(partial_key)
+            stream = functools.partial(cls._storage_backend.stream, namespace, name, chunk_size=cls.STREAM_CHUNK_SIZE)
+        return dict(
+            cls.representation(
+                cls, None, hasher.hexdigest(), int(last_modified.timestamp()), etags, modified_since, size, stream),
+            content_type=content_type)
+
+    @classmethod
+    def prepare_uploaded_file(cls, uploaded_file, owner, minify=False, convert=False, background=False):
+        '''
+        Validates and transforms uploaded_file without saving it, see store_uploaded_file.
         '''
         if not cls.verify_file_size(cls, uploaded_file):
             return {'success': False, \
@@ -395,92 +1341,642 @@ class CacheMan:
         file_type = cls.verify_file_type(cls, uploaded_file)
         if not file_type:
             return {'success': False, 'errors': ["Uploaded file's type is not allowed."]}
-        path = cls.generate_file_path(cls, uploaded_file, owner)
         if file_type[0] == 'text':
             convert = False
         if file_type[0] == 'image':
             minify = False
-        file_storage_result = cls._file_manager.store_file(
-            path,
-            uploaded_file,
-            minify=minify,
-            convert=convert
-            )
+        transform = None
+        if background:
+            transform = TransformJob.MINIFY if minify else TransformJob.CONVERT if convert else None
+            minify = convert = False
+        file_storage_result, content = cls._file_manager.prepare_file(uploaded_file, minify=minify, convert=convert)
         file_storage_result.update({'uploaded_file_type': file_type})
-        db_object = cls.add_file_record_in_database(cls, file_storage_result, owner)
+        return {'success': True, 'file_info': file_storage_result, 'content': content, 'transform': transform}
+
+    def write_uploaded_file(self, store_result, owner):
+        '''
+        Saves file prepared by prepare_uploaded_file in physical storage.
+        '''
+        self._file_manager.write_file(
+            self._file_manager, self._storage_backend, self.generate_namespace(self, owner),
+            store_result['file_info'], store_result['content'])
+        return store_result
+
+    @classmethod
+    def store_uploaded_file(cls, uploaded_file, owner, minify=False, convert=False, background=False):
+        '''
+        Validates uploaded_file and saves it in physical storage.
+        On success, result also holds final content of stored file so it can be cached without reading it back.
+        If background is set, file is stored as uploaded and the requested operation is
+        returned as transform to be run later by a transform job.
+        '''
+        store_result = cls.prepare_uploaded_file(
+            uploaded_file, owner, minify=minify, convert=convert, background=background)
+        if not store_result['success']:
+            return store_result
+        return cls.write_uploaded_file(cls, store_result, owner)
+
+    @classmethod
+    def add_file_record(cls, uploaded_file, owner, minify=False, convert=False, background=False, **kwargs):
+        '''
+        Saves file in physical storage and creates db entry for that file.
+        With background set, minification or convertion is left to a transform job.
+        '''
+        store_result = cls.store_uploaded_file(
+            uploaded_file, owner, minify=minify, convert=convert, background=background)
+        if not store_result['success']:
+            return store_result
+        file_storage_result = store_result['file_info']
+        with transaction.atomic():
+            db_object = cls.add_file_record_in_database(cls, file_storage_result, owner)
+            jobs = cls.replace_transform_jobs(cls, [(db_object, store_result['transform'])])
         file_storage_result.update({'file_id': db_object.id, 'url': db_object.get_absolute_url()})
-        cls.save_file_in_cache(file_storage_result['filename'], owner)
+        if jobs:
+            file_storage_result['transform'] = cls.transform_status(cls, jobs[0])
+        with cls.time_cache_backend(cls, 'set'):
+            cls._cache_backend.add_records(cls.cache_records(
+                cls, owner, file_storage_result['filename'], store_result['content'],
+                db_object.last_update_time, file_storage_result['digest']))
         return {'success': True, 'file_info': file_storage_result}
 
     @classmethod
-    def save_file_in_cache(cls, filename, owner):
+    def add_file_records(cls, uploaded_files, owner, minify=False, convert=False, background=False, **kwargs):
         '''
-        Reads file content from persistant storage and saves it in cache.
+        Saves several files in physical storage using a pool of UPLOAD_WORKERS threads,
+        then creates their db entries in one transaction and caches them in one batch.
+        Returns a list of results in the same order as uploaded_files.
         '''
-        file_data = cls._file_manager.retrieve_file(cls.BASE_STORAGE_PATH+str(owner.username)+'/', filename)
-        if file_data:
-            if cls._cache_backend.add_record(cls.generate_key(cls, owner.username, filename), file_data):
-                return file_data
+        with ThreadPoolExecutor(max_workers=cls.UPLOAD_WORKERS) as executor:
+            results = list(executor.map(
+                lambda uploaded_file: cls.prepare_uploaded_file(
+                    uploaded_file, owner, minify=minify, convert=convert, background=background),
+                uploaded_files))
+            # Converted files are renamed (e.g. a.png and a.jpg are both stored as a.webp), so
+            # duplicates are found by final filename before anything is written. First file wins.
+            stored, filenames = [], set()
+            for index, result in enumerate(results):
+                if not result['success']:
+                    continue
+                filename = result['file_info']['filename']
+                if filename in filenames:
+                    results[index] = {'success': False, \
+                        'errors': [f"Another file of this batch is already stored as {filename}."]}
+                else:
+                    filenames.add(filename)
+                    stored.append(result)
+            list(executor.map(lambda result: cls.write_uploaded_file(cls, result, owner), stored))
+        with transaction.atomic():
+            db_objects = cls.add_file_records_in_database(cls, [result['file_info'] for result in stored], owner)
+            jobs = cls.replace_transform_jobs(cls, [
+                (db_objects[result['file_info']['filename']], result['transform']) for result in stored])
+        jobs = {job.base_file_id: job for job in jobs}
+        records = {}
+        for result in stored:
+            result.pop('transform')
+            file_info = result['file_info']
+            db_object = db_objects[file_info['filename']]
+            file_info.update({'file_id': db_object.id, 'url': db_object.get_absolute_url()})
+            if db_object.id in jobs:
+                file_info['transform'] = cls.transform_status(cls, jobs[db_object.id])
+            records.update(cls.cache_records(
+                cls, owner, file_info['filename'], result.pop('content'), db_object.last_update_time, file_info['digest']))
+        with cls.time_cache_backend(cls, 'set'):
+            cls._cache_backend.add_records(records)
+        return results
+
+    def replace_transform_jobs(self, transforms):
+        '''
+        Replaces transform jobs of files given as (BaseFile, operation or None) pairs.
+        New jobs are queued once transaction commits. Returns created jobs.
+        '''
+        TransformJob.objects.filter(base_file__in=[base_file for base_file, _ in transforms]).delete()
+        jobs = TransformJob.objects.bulk_create([
+            TransformJob(base_file=base_file, operation=operation, source_digest=base_file.blob_id)
+            for base_file, operation in transforms if operation is not None
+            ])
+        if jobs:
+            transaction.on_commit(lambda: [self._transform_queue.submit(self.run_transform_job, job.id) for job in jobs])
+        return jobs
+
+    def transform_status(self, job):
+        '''
+        Returns state of transform job as a dictionary.
+        '''
+        status = {'operation': job.operation, 'status': job.status}
+        if job.status == TransformJob.DONE:
+            status['result_filename'] = job.result_filename
+        elif job.status == TransformJob.FAILED:
+            status['error'] = job.error
+        return status
+
+    @classmethod
+    def fail_transform_job(cls, job_id, error):
+        TransformJob.objects.filter(id=job_id).update(
+            status=TransformJob.FAILED, error=error[:255], finish_time=timezone.now())
         return False
 
     @classmethod
-    def retrieve_file_from_cache(cls, filename, owner):
+    def run_transform_job(cls, job_id):
+        '''
+        Runs a pending transform job: processes file content, stores the result and
+        updates database and cache. Returns True if job is done.
+        Like a synchronous upload, a converted image replaces the original, which is
+        removed, and the job moves to the converted file.
+        '''
+        if not TransformJob.objects.filter(id=job_id, status=TransformJob.PENDING).update(status=TransformJob.RUNNING):
+            return False
+        try:
+            job = TransformJob.objects.select_related('base_file__owner').get(id=job_id)
+            owner = job.base_file.owner
+            namespace = cls.generate_namespace(cls, owner)
+            content = cls._storage_backend.get(namespace, job.base_file.filename)
+            if content is None or cls._file_manager.hash_content(cls._file_manager, content) != job.source_digest:
+                return cls.fail_transform_job(job_id, "File was changed before it was processed.")
+            file_info, content = cls._file_manager.transform(
+                content,
+                job.base_file.filename,
+                minify=job.operation == TransformJob.MINIFY,
+                convert=job.operation == TransformJob.CONVERT)
+            file_info['uploaded_file_type'] = [
+                'text' if job.operation == TransformJob.MINIFY else 'image',
+                file_info['filename'].rsplit('.', maxsplit=1)[-1]]
+            with transaction.atomic():
+                source = BaseFile.objects.select_for_update().filter(
+                    id=job.base_file_id, blob_id=job.source_digest).first()
+                if source is None:
+                    return cls.fail_transform_job(job_id, "File was changed before it was processed.")
+                cls._storage_backend.put(namespace, file_info['filename'], content, digest=file_info['digest'])
+                db_object = cls.add_file_record_in_database(cls, file_info, owner)
+                if db_object.id != source.id:
+                    TransformJob.objects.filter(base_file=db_object).exclude(id=job_id).delete()
+                    TransformJob.objects.filter(id=job_id).update(base_file=db_object)
+                    cls.discard_file_record(cls, source, owner)
+                TransformJob.objects.filter(id=job_id).update(
+                    status=TransformJob.DONE, result_filename=file_info['filename'], finish_time=timezone.now())
+            with cls.time_cache_backend(cls, 'set'):
+                cls._cache_backend.add_records(cls.cache_records(
+                    cls, owner, file_info['filename'], content, db_object.last_update_time, file_info['digest']))
+        except Exception as error:
+            return cls.fail_transform_job(job_id, str(error) or error.__class__.__name__)
+        return True
+
+    def generate_variant_name(self, filename, variant):
+        '''
+        Returns storage name of an image variant. Leading dot hides it from storage listings.
+        '''
+        return f".variant.{filename}.{variant['label']}.{variant['preset']}.{variant['format']}"
+
+    @classmethod
+    def generate_image_variants(cls, base_file_id, source_digest):
+        '''
+        Encodes configured variants of an image on image transcoder's process pool, stores
+        them and replaces ImageVariant records of the image. Does nothing if image content
+        is not source_digest anymore. Returns list of created ImageVariant objects.
+        '''
+        base_file = BaseFile.objects.select_related('owner').filter(id=base_file_id, blob_id=source_digest).first()
+        if base_file is None:
+            return []
+        namespace = cls.generate_namespace(cls, base_file.owner)
+        content = cls._storage_backend.get(namespace, base_file.filename)
+        if content is None or cls._file_manager.hash_content(cls._file_manager, content) != source_digest:
+            return []
+        variants = cls._image_transcoder.transcode(content)
+        with transaction.atomic():
+            image_file = ImageFile.objects.select_for_update().filter(
+                base_file_id=base_file_id, base_file__blob_id=source_digest).first()
+            if image_file is None:
+                return []
+            old_names = set(image_file.variants.values_list('name', flat=True))
+            records = []
+            for variant in variants:
+                name = cls.generate_variant_name(cls, base_file.filename, variant)
+                digest = cls._file_manager.hash_content(cls._file_manager, variant['content'])
+                cls._storage_backend.put(namespace, name, variant['content'], digest=digest)
+                records.append(ImageVariant(
+                    image_file=image_file,
+                    name=name,
+                    format=variant['format'],
+                    preset=variant['preset'],
+                    width=variant['width'],
+                    height=variant['height'],
+                    size=len(variant['content']),
+                    encode_time=variant['encode_time'],
+                    digest=digest,
+                    source_digest=source_digest))
+            image_file.variants.all().delete()
+            records = ImageVariant.objects.bulk_create(records)
+        cls.forget_variant_links(cls, base_file.owner, base_file.filename)
+        for name in old_names - {record.name for record in records}:
+            cls._storage_backend.delete(namespace, name)
+        return records
+
+    def generate_encoded_name(self, filename, encoding):
+        '''
+        Returns storage name of a precompressed text file. Leading dot hides it from storage listings.
+        '''
+        return f".encoded.{filename}.{encoding}"
+
+    @classmethod
+    def generate_text_encodings(cls, base_file_id, source_digest):
+        '''
+        Compresses a text file with every available encoding, stores results and replaces
+        TextVariant records of the file. Does nothing if file content is not source_digest anymore.
+        Returns list of created TextVariant objects.
+        '''
+        base_file = BaseFile.objects.select_related('owner').filter(id=base_file_id, blob_id=source_digest).first()
+        if base_file is None:
+            return []
+        namespace = cls.generate_namespace(cls, base_file.owner)
+        content = cls._storage_backend.get(namespace, base_file.filename)
+        if content is None or cls._file_manager.hash_content(cls._file_manager, content) != source_digest:
+            return []
+        variants = compression.compress(content)
+        with transaction.atomic():
+            txt_file = TextFile.objects.select_for_update().filter(
+                base_file_id=base_file_id, base_file__blob_id=source_digest).first()
+            if txt_file is None:
+                return []
+            records = []
+            for variant in variants:
+                name = cls.generate_encoded_name(cls, base_file.filename, variant['encoding'])
+                digest = cls._file_manager.hash_content(cls._file_manager, variant['content'])
+                cls._storage_backend.put(namespace, name, variant['content'], digest=digest)
+                records.append(TextVariant(
+                    text_file=txt_file,
+                    name=name,
+                    encoding=variant['encoding'],
+                    size=len(variant['content']),
+                    encode_time=variant['encode_time'],
+                    digest=digest,
+                    source_digest=source_digest))
+            txt_file.variants.all().delete()
+            records = TextVariant.objects.bulk_create(records)
+        cls.forget_encoded_links(cls, base_file.owner, base_file.filename)
+        return records
+
+    @classmethod
+    def save_file_in_cache(cls, filename, owner, etags=(), modified_since=None):
+        '''
+        Reads file content from persistant storage and saves it in cache.
+        Content is cached once per digest and shared by all files having the same bytes.
+        Returns representation of the file or False if it does not exist.
+        '''
+        last_modified = BaseFile.objects.filter(
+            owner=owner, filename=filename).values_list('last_update_time', flat=True).first()
+        if last_modified is None:
+            return False
+        key = cls.generate_key(cls, owner.username, filename)
+        return cls.cache_stored_file(key, owner, filename, last_modified, etags, modified_since)
+
+    @classmethod
+    def retrieve_file_from_cache(cls, filename, owner, etags=(), modified_since=None):
         '''
-        Returns file content from cache. If file is not cached, first loads file in cache then returns it.
+        Returns representation of file (see representation). If file is not cached, first loads
+        file in cache. Returns False if file does not exist.
         '''
         key = cls.generate_key(cls, owner.username, filename)
-        file_data = cls._cache_backend.get_record(key)
-        if file_data:
-            return file_data
-        file_data = cls.save_file_in_cache(filename, owner)
-        if file_data:
-            return file_data
+        representation = cls.retrieve_linked_from_cache(key, etags, modified_since)
+        if representation:
+            return representation
+        return cls.save_file_in_cache(filename, owner, etags, modified_since)
+
+    @classmethod
+    def retrieve_variant_from_cache(cls, filename, owner, formats, etags=(), modified_since=None):
+        '''
+        Returns representation of the smallest of image filename and its current variants encoded
+        in one of formats, or False if file does not exist. On a cache miss, the choice is made
+        from variant records and cached under a link of its own, so later requests with the
+        same formats need a single cache lookup.
+        '''
+        key = cls.generate_variant_link_key(cls, owner.username, filename, formats)
+        representation = cls.retrieve_linked_from_cache(key, etags, modified_since, typed=True)
+        if representation:
+            return representation
+        base_file = BaseFile.objects.filter(owner=owner, filename=filename).first()
+        if base_file is None or base_file.blob_id is None:
+            return False
+        variant = cls.choose_image_variant(cls, base_file, formats)
+        # Content type is taken from variant's recorded format, or from filename of the image itself,
+        # and kept on the link, so content is not sniffed.
+        if variant is None:
+            name, content_type = filename, mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        else:
+            name, content_type = variant.name, f"image/{variant.format}"
+        return cls.cache_stored_file(
+            key, owner, name, base_file.last_update_time, etags, modified_since, content_type=content_type)
+
+    def choose_image_variant(self, base_file, formats):
+        '''
+        Returns the smallest current variant of base_file encoded in one of formats,
+        or None if the image itself is smaller.
+        '''
+        variants = list(ImageVariant.objects.filter(
+            image_file__base_file=base_file, source_digest=base_file.blob_id, format__in=formats))
+        # Only variants keeping original width stand in for the image itself.
+        full_width = max([variant.width for variant in variants], default=0)
+        candidates = [variant for variant in variants if variant.width == full_width and variant.size < base_file.size]
+        return min(candidates, key=lambda variant: variant.size, default=None)
+
+    @classmethod
+    def locate_representation(cls, filename, owner, formats=None, encodings=None):
+        '''
+        Returns a dictionary describing stored file sent for filename, without reading it:
+        name, digest, last_modified (epoch seconds), content_type (None if it is to be guessed
+        from filename) and content_encoding. Images are located as their smallest variant in one
+        of formats, text files as their variant compressed with the first available of encodings.
+        Returns False if file does not exist.
+        '''
+        base_file = BaseFile.objects.filter(owner=owner, filename=filename).first()
+        if base_file is None:
+            return False
+        located = {
+            'name': filename,
+            'digest': base_file.blob_id,
+            'last_modified': int(base_file.last_update_time.timestamp()),
+            'content_type': None,
+            'content_encoding': None,
+        }
+        if base_file.blob_id is None:
+            return located
+        if formats:
+            variant = cls.choose_image_variant(cls, base_file, formats)
+            if variant is not None:
+                located.update(name=variant.name, digest=variant.digest, content_type=f"image/{variant.format}")
+        elif encodings:
+            variants = {
+                variant.encoding: variant for variant in TextVariant.objects.filter(
+                    text_file__base_file=base_file, source_digest=base_file.blob_id, encoding__in=encodings)
+                }
+            for encoding in encodings:
+                if encoding in variants:
+                    located.update(name=variants[encoding].name, digest=variants[encoding].digest, content_encoding=encoding)
+                    break
+        return located
+
+    @classmethod
+    def retrieve_encoded_from_cache(cls, filename, owner, encodings, etags=(), modified_since=None):
+        '''
+        Returns representation of text file filename compressed with the first of encodings it
+        has a precompressed variant for, with the encoding under content_encoding key.
+        Returns False if there is no such variant yet. Each encoding is cached under a link of its own.
+        '''
+        variants = None
+        for encoding in encodings:
+            key = cls.generate_encoded_link_key(cls, owner.username, filename, encoding)
+            representation = cls.retrieve_linked_from_cache(key, etags, modified_since)
+            if representation:
+                return dict(representation, content_encoding=encoding)
+            if variants is None:
+                variants = {
+                    variant.encoding: variant for variant in TextVariant.objects.select_related(
+                        'text_file__base_file').filter(
+                        text_file__base_file__owner=owner,
+                        text_file__base_file__filename=filename,
+                        text_file__base_file__blob_id=F('source_digest'),
+                        encoding__in=encodings)
+                    }
+            if encoding not in variants:
+                continue
+            variant = variants[encoding]
+            representation = cls.cache_stored_file(
+                key, owner, variant.name, variant.text_file.base_file.last_update_time, etags, modified_since)
+            if representation:
+                return dict(representation, content_encoding=encoding)
         return False
 
+    @classmethod
+    def remove_file_record(cls, filename, owner):
+        '''
+        Removes file from database, physical storage and cache.
+        Its content is only dropped when no other file shares it. Returns False if file does not exist.
+        '''
+        with transaction.atomic():
+            try:
+                base_file = BaseFile.objects.select_for_update().get(owner=owner, filename=filename)
+            except BaseFile.DoesNotExist:
+                return False
+            cls.discard_file_record(cls, base_file, owner)
+        return True
+
+    def discard_file_record(self, base_file, owner):
+        '''
+        Deletes locked base_file of owner from database and releases its blob. Once transaction
+        commits, its cache links and stored files, variants included, are removed too.
+        Must run inside a transaction.
+        '''
+        filename = base_file.filename
+        variant_names = list(ImageVariant.objects.filter(
+            image_file__base_file=base_file).values_list('name', flat=True))
+        encoded_names = list(TextVariant.objects.filter(
+            text_file__base_file=base_file).values_list('name', flat=True))
+        digest = base_file.blob_id
+        base_file.delete()
+        self.release_blobs(self, [digest])
+        def remove_stored():
+            self._cache_backend.delete_record(self.generate_key(self, owner.username, filename))
+            if variant_names:
+                self.forget_variant_links(self, owner, filename)
+            if encoded_names:
+                self.forget_encoded_links(self, owner, filename)
+            for name in [filename] + variant_names + encoded_names:
+                self._storage_backend.delete(self.generate_namespace(self, owner), name)
+        transaction.on_commit(remove_stored)
+
     @classmethod
     def file_memory_usage_in_cache(cls, filename, owner):
         '''
         Retruns memory used by filename in ram.
         '''
-        key = cls.generate_key(cls, owner.username, filename)
-        return cls._cache_backend.memory_used_by_key(key)
+        digest = BaseFile.objects.filter(owner=owner, filename=filename).values_list('blob', flat=True).first()
+        if digest is None:
+            return 0
+        return cls._cache_backend.memory_used_by_key(cls.generate_blob_key(cls, digest))
+
+    @classmethod
+    def blobs_memory_usage_in_cache(cls, digests):
+        '''
+        Returns a dictionary mapping each of content digests to memory its content uses in ram.
+        '''
+        keys = [cls.generate_blob_key(cls, digest) for digest in digests]
+        return dict(zip(digests, cls._cache_backend.memory_used_by_keys(keys)))
+
+    @classmethod
+    def export_metrics(cls):
+        '''
+        Returns metrics of all worker processes and keys evicted by cache server
+        in Prometheus text exposition format.
+        '''
+        text = metrics.REGISTRY.render()
+        evicted_keys = cls._cache_backend.server_evicted_keys()
+        if evicted_keys is not None:
+            text = text + "\n".join([
+                "# HELP content_cache_server_evicted_keys_total Keys evicted by cache server (Redis maxmemory-policy).",
+                "# TYPE content_cache_server_evicted_keys_total counter",
+                f'content_cache_server_evicted_keys_total{{backend="{type(cls._cache_backend).__name__}"}} {evicted_keys}',
+            ]) + "\n"
+        return text
 
 class CacheFacade:
     '''
     Clients use this class only to work with cache system.
     '''
+    LIST_FIELDS = [
+        'filename', 'creation_time', 'last_update_time', 'size', 'url', 'consumed_ram',
+        'type', 'processed', 'process_duration', 'process_memory_usage', 'transform', 'variants',
+    ]
+
     def __init__(self, cache_manager=CacheMan):
         self._cache_manager = cache_manager
 
-    def store_file(self, uploaded_file, owner, minify=False, convert=False, **kwargs):
+    def store_file(self, uploaded_file, owner, minify=False, convert=False, background=False, **kwargs):
         '''
         Stores uploaded file and applies minification or convertion operation if neccessary.
+        With background set, the operation runs after the file is stored and its progress
+        is reported by transform field of file listing.
         Returns result as a dictionary.
         '''
         store_result = self._cache_manager.add_file_record(
             uploaded_file,
             owner,
             minify=minify,
-            convert=convert
+            convert=convert,
+            background=background
             )
         return store_result
+
+    def store_files(self, uploaded_files, owner, minify=False, convert=False, background=False, **kwargs):
+        '''
+        Stores several uploaded files at once. Returns a list of results, one per file.
+        '''
+        return self._cache_manager.add_file_records(
+            uploaded_files,
+            owner,
+            minify=minify,
+            convert=convert,
+            background=background
+            )
+
     def retrieve_file(self, filename, owner):
         '''
         Returns file named filename that is owned by user owner if such file exists.
         False otherwise.
         '''
-        return self._cache_manager.retrieve_file_from_cache(filename, owner)
+        representation = self._cache_manager.retrieve_file_from_cache(filename, owner)
+        if not representation:
+            return False
+        if representation['content'] is None:
+            return b''.join(representation['stream']())
+        return representation['content']
+
+    def retrieve_representation(self, filename, owner, accept='', accept_encoding='', etags=(), modified_since=None):
+        '''
+        Returns what to send to a client asking for filename with given Accept and Accept-Encoding
+        header values: images as their smallest variant in an accepted format, css/js precompressed
+        with the preferred encoding. Result is a dictionary with content, etag, last_modified
+        (epoch seconds), content_type, content_encoding, vary (request headers response depends on)
+        and max_age, along with modified, size and stream of large files (see CacheMan.representation).
+        modified is False if client's copy, identified by etags or modified_since, is current.
+        Returns False if file does not exist.
+        '''
+        manager = self._cache_manager
+        formats = manager.accepted_variant_formats(manager, filename, accept)
+        encodings = manager.accepted_encodings(manager, filename, accept_encoding)
+        representation = False
+        if formats:
+            representation = manager.retrieve_variant_from_cache(filename, owner, formats, etags, modified_since)
+        elif encodings:
+            representation = manager.retrieve_encoded_from_cache(filename, owner, encodings, etags, modified_since)
+        if not representation:
+            representation = manager.retrieve_file_from_cache(filename, owner, etags, modified_since)
+        if not representation:
+            return False
+        representation.setdefault('content_encoding', None)
+        representation.setdefault('content_type', None)
+        return self.describe_negotiation(representation, filename, formats, encodings)
+
+    def describe_negotiation(self, representation, filename, formats, encodings):
+        '''
+        Adds vary (request headers representation depends on) and max_age to representation.
+        '''
+        manager = self._cache_manager
+        representation['vary'] = []
+        if formats is not None:
+            representation['vary'].append('Accept')
+        if encodings is not None:
+            representation['vary'].append('Accept-Encoding')
+        representation['max_age'] = manager.max_age(manager, filename)
+        return representation
 
-    def list_files(self, owner):
+    def export_metrics(self):
+        '''
+        Returns cache and pipeline metrics of all worker processes in Prometheus text format.
+        '''
+        return self._cache_manager.export_metrics()
+
+    def offloads_retrieval(self):
+        '''
+        True if file content is sent by nginx (see locate_representation).
+        '''
+        manager = self._cache_manager
+        return manager.accel_redirect_location(manager) is not None
+
+    def locate_representation(self, filename, owner, accept='', accept_encoding='', etags=(), modified_since=None):
+        '''
+        Negotiates representation like retrieve_representation, but returns accel_redirect,
+        internal URI nginx sends the stored file from, instead of content.
+        Neither cache nor storage is read. Returns False if file does not exist.
+        '''
+        manager = self._cache_manager
+        formats = manager.accepted_variant_formats(manager, filename, accept)
+        encodings = manager.accepted_encodings(manager, filename, accept_encoding)
+        located = manager.locate_representation(filename, owner, formats, encodings)
+        if not located:
+            return False
+        representation = manager.representation(
+            manager, None, located['digest'], located['last_modified'], etags, modified_since)
+        representation['content_type'] = located['content_type'] or mimetypes.guess_type(filename)[0]
+        representation['content_encoding'] = located['content_encoding']
+        path = manager._storage_backend.relative_path(manager.generate_namespace(manager, owner), located['name'])
+        representation['accel_redirect'] = manager.accel_redirect_location(manager) + urllib.parse.quote(path)
+        return self.describe_negotiation(representation, filename, formats, encodings)
+
+    def delete_file(self, filename, owner):
+        '''
+        Deletes file named filename owned by owner. Returns False if such file does not exist.
+        '''
+        return self._cache_manager.remove_file_record(filename, owner)
+
+    def file_records(self, owner, fields=None):
+        '''
+        Returns queryset of files owned by owner with their text/image details joined in.
+        Image variants are prefetched only if fields include variants.
+        '''
+        records = owner.cachedfiles.select_related('txtdetails', 'imgdetails', 'transform')
+        if fields is None or 'variants' in fields:
+            records = records.prefetch_related('imgdetails__variants')
+        return records
+
+    def list_files(self, owner, files=None, fields=None):
         '''
         Returns a list of files owned by owner.
+        files limits the listing to given records (e.g. a page of file_records) and
+        fields limits reported attributes to given LIST_FIELDS. RAM usage is only
+        looked up when consumed_ram is requested.
         '''
+        if files is None:
+            files = self.file_records(owner, fields)
+        if fields is None:
+            fields = self.LIST_FIELDS
+        files = list(files)
         result = {
-            'total_consumed_ram': 0,
             'number_of_files': 0,
             'files': []
             }
-        files = owner.cachedfiles.all()
+        if 'consumed_ram' in fields:
+            memory_usage = self._cache_manager.blobs_memory_usage_in_cache(
+                list({record.blob_id for record in files if record.blob_id}))
+            # Files sharing content share its cached copy, so each blob is counted once.
+            result['total_consumed_ram'] = sum(usage or 0 for usage in memory_usage.values())
         for record in files:
             tmp_file = {}
             tmp_file['filename'] = record.filename
@@ -488,33 +1984,40 @@ class CacheFacade:
             tmp_file['last_update_time'] = record.last_update_time
             tmp_file['size'] = record.size
             tmp_file['url'] = record.get_absolute_url()
-            tmp_file['consumed_ram'] = self._cache_manager.file_memory_usage_in_cache(
-                tmp_file['filename'],
-                owner)
+            if 'consumed_ram' in fields:
+                tmp_file['consumed_ram'] = memory_usage.get(record.blob_id) or 0
             result['number_of_files'] +=1
-            if tmp_file['consumed_ram']:
-                result['total_consumed_ram'] += tmp_file['consumed_ram']
-            else:
-                tmp_file['comsumed_ram'] = 0
-            try:
-                tmp_file['processed'] = record.txtdetails.minify
+            txt_details = getattr(record, 'txtdetails', None)
+            img_details = getattr(record, 'imgdetails', None)
+            if txt_details is not None:
+                tmp_file['processed'] = txt_details.minify
                 tmp_file['type'] = "text"
                 if tmp_file['processed']:
-                    tmp_file['process_duration'] = record.txtdetails.minification_time
-                    tmp_file['process_memory_usage'] = record.txtdetails.minification_memory
+                    tmp_file['process_duration'] = txt_details.minification_time
+                    tmp_file['process_memory_usage'] = txt_details.minification_memory
                 else:
                     tmp_file['process_duration'] = tmp_file['process_memory_usage'] = 0
-            except:
-                pass
-            try:
-                tmp_file['processed'] = record.imgdetails.convert_to_webp
+            if img_details is not None:
+                tmp_file['processed'] = img_details.convert_to_webp
                 tmp_file['type'] = 'image'
                 if tmp_file['processed']:
-                    tmp_file['process_duration'] = record.imgdetails.convertion_time
-                    tmp_file['process_memory_usage'] = record.imgdetails.convertion_memory
+                    tmp_file['process_duration'] = img_details.convertion_time
+                    tmp_file['process_memory_usage'] = img_details.convertion_memory
                 else:
                     tmp_file['process_duration'] = tmp_file['process_memory_usage'] = 0
-            except:
-                pass
-            result['files'].append(tmp_file)
+                if 'variants' in fields:
+                    tmp_file['variants'] = [
+                        {
+                            'format': variant.format,
+                            'preset': variant.preset,
+                            'width': variant.width,
+                            'height': variant.height,
+                            'size': variant.size,
+                            'encode_time': variant.encode_time,
+                        }
+                        for variant in img_details.variants.all()
+                        ]
+            job = getattr(record, 'transform', None)
+            tmp_file['transform'] = None if job is None else self._cache_manager.transform_status(self._cache_manager, job)
+            result['files'].append({key: value for key, value in tmp_file.items() if key in fields})
         return result
@@ -0,0 +1,67 @@
+'''
+Precompression of text files, so they are served with Content-Encoding
+without compressing them on every request.
+'''
+import gzip
+import time
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def compress_gzip(content):
+    # mtime=0 keeps output identical for identical content.
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+def compress_brotli(content):
+    return brotli.compress(content, quality=11, mode=brotli.MODE_TEXT)
+
+ENCODERS = {'gzip': compress_gzip}
+if brotli is not None:
+    ENCODERS['br'] = compress_brotli
+
+# Server preference among encodings a client accepts with the same quality.
+ENCODINGS = [encoding for encoding in ('br', 'gzip') if encoding in ENCODERS]
+
+def compress(content):
+    '''
+    Compresses content with every available encoder.
+    Returns a list of dictionaries holding encoding, compressed content and encode time.
+    '''
+    variants = []
+    for encoding in ENCODINGS:
+        start_time = time.process_time()
+        encoded_content = ENCODERS[encoding](content)
+        variants.append({
+            'encoding': encoding,
+            'content': encoded_content,
+            'encode_time': time.process_time() - start_time,
+        })
+    return variants
+
+def accepted_encodings(accept_encoding):
+    '''
+    Returns available encodings allowed by Accept-Encoding header value, most preferred first.
+    '''
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, parameters = coding.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    wildcard = qualities.get('*', 0.0)
+    accepted = [
+        encoding for encoding in ENCODINGS
+        if qualities.get(encoding, wildcard) > 0
+        ]
+    # sorted is stable, so server preference breaks ties.
+    return sorted(accepted, key=lambda encoding: -qualities.get(encoding, wildcard))
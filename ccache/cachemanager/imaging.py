@@ -0,0 +1,148 @@
+'''
+Image transcoding engine producing resized and re-encoded variants of stored
+images on a pool of worker processes.
+'''
+import io
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import ExifTags, Image, ImageOps
+from django.conf import settings
+
+DEFAULT_IMAGE_VARIANTS = {
+    'ENABLED': True,
+    # Formats that Pillow can not write on this host are skipped.
+    'FORMATS': ['webp', 'avif'],
+    # Preset name -> encoder quality.
+    'PRESETS': {
+        'high': 80,
+        'low': 50,
+    },
+    # None keeps original width. Widths larger than the image are skipped.
+    'WIDTHS': [None, 640],
+    # Number of worker processes of each web worker, see default_workers.
+    'WORKERS': None,
+}
+
+def get_image_variant_settings():
+    '''
+    Returns CONTENT_CACHE_IMAGE_VARIANTS settings completed with defaults.
+    '''
+    return dict(DEFAULT_IMAGE_VARIANTS, **getattr(settings, 'CONTENT_CACHE_IMAGE_VARIANTS', {}))
+
+def default_workers():
+    '''
+    Returns number of transcoding processes of each web worker, so that web workers of a
+    host run one transcoding process per core together. Number of web workers is read from
+    WEB_CONCURRENCY environment variable, which gunicorn uses as its number of workers.
+    '''
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
+def encode_variant(content, image_format, quality, width):
+    '''
+    Decodes image content, resizes it to width (None keeps original size), drops
+    its metadata and encodes it in image_format.
+    Runs in worker processes. Returns (encoded bytes, width, height, encode time).
+    '''
+    start_time = time.process_time()
+    with Image.open(io.BytesIO(content)) as source:
+        image = ImageOps.exif_transpose(source)
+        if width is not None and width < image.width:
+            image = image.resize(
+                (width, max(1, round(image.height * width / image.width))),
+                Image.Resampling.LANCZOS,
+                reducing_gap=3.0)
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+        # Encoders copy EXIF/ICC/XMP from info, so an empty info strips metadata.
+        image.info = {}
+        destination = io.BytesIO()
+        image.save(destination, format=image_format, quality=quality)
+    return destination.getvalue(), image.width, image.height, time.process_time() - start_time
+
+class ImageTranscoder:
+    '''
+    Generates configured set of variants (formats x quality presets x widths) of images.
+    '''
+    def __init__(self, formats, presets, widths, workers=None, enabled=True):
+        Image.init()
+        self.enabled = enabled
+        self.formats = [image_format for image_format in formats if image_format.upper() in Image.SAVE]
+        self.presets = presets
+        self.widths = widths
+        self.workers = workers or default_workers()
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = get_image_variant_settings()
+        return cls(config['FORMATS'], config['PRESETS'], config['WIDTHS'], config['WORKERS'], config['ENABLED'])
+
+    @property
+    def active(self):
+        '''
+        True if there is any variant to produce.
+        '''
+        return self.enabled and bool(self.formats) and bool(self.presets) and bool(self.widths)
+
+    @property
+    def pool(self):
+        '''
+        Process pool of current process. Workers are spawned rather than forked,
+        since pool is started from threads of a server process.
+        '''
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._pool
+
+    def plan(self, width):
+        '''
+        Returns a list of (format, preset, quality, width) of variants to produce for an image
+        of given width. width of variants keeping original size is None.
+        '''
+        widths = [target for target in self.widths if target is None or target < width]
+        return [
+            (image_format, preset, quality, target)
+            for image_format in self.formats
+            for preset, quality in self.presets.items()
+            for target in widths
+            ]
+
+    def transcode(self, content):
+        '''
+        Encodes all variants of image content in parallel.
+        Returns a list of dictionaries describing variants, including their content.
+        '''
+        with Image.open(io.BytesIO(content)) as image:
+            width, height = image.size
+            # Rotated images are transposed before resizing, so their height becomes width.
+            if image.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+                width = height
+        plan = self.plan(width)
+        futures = [
+            self.pool.submit(encode_variant, content, image_format, quality, target)
+            for image_format, _, quality, target in plan
+            ]
+        variants = []
+        for (image_format, preset, quality, target), future in zip(plan, futures):
+            variant_content, variant_width, variant_height, encode_time = future.result()
+            variants.append({
+                'format': image_format,
+                'preset': preset,
+                'quality': quality,
+                'label': 'orig' if target is None else f'{target}w',
+                'width': variant_width,
+                'height': variant_height,
+                'encode_time': encode_time,
+                'content': variant_content,
+            })
+        return variants
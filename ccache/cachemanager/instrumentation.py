@@ -0,0 +1,72 @@
+'''
+Lightweight instrumentation of file transforms (minification and convertion).
+'''
+import sys
+import time
+import random
+import resource
+import threading
+import tracemalloc
+from django.conf import settings
+
+class TransformProfile:
+    '''
+    Context manager measuring wall and CPU time of a transform with monotonic timers.
+    A fraction of transforms (sample_rate) is also measured for memory: peak of Python
+    allocations traced by tracemalloc, or growth of process's peak RSS if it is larger
+    (allocations made by C libraries such as Pillow are not traced).
+    Tracing is process wide, so only one transform is traced at a time; the others are
+    timed only. memory_usage is None for transforms that were not traced.
+    Where stopping tracemalloc is not thread safe, sampled transforms are measured by
+    peak RSS growth only.
+    '''
+    sample_rate = getattr(settings, 'CONTENT_CACHE_PROFILE_SAMPLE_RATE', 0.05)
+    # Older versions can crash when tracemalloc is stopped while other threads (upload
+    # workers, transform jobs) allocate memory, see CPython issue gh-128679.
+    CAN_STOP_TRACING = sys.version_info >= (3, 13, 2) or (3, 12, 9) <= sys.version_info < (3, 13)
+    _tracing = threading.Lock()
+
+    def __init__(self, sample_rate=None):
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        self.sampled = sample_rate > 0 and random.random() < sample_rate
+        self.traced = self.started_tracing = False
+        self.wall_time = self.cpu_time = None
+        self.memory_usage = None
+
+    def __enter__(self):
+        # Only tracing started here is stopped on exit, a tracemalloc session started
+        # by someone else (e.g. python -X tracemalloc) is left untouched.
+        if self.sampled and self._tracing.acquire(blocking=False):
+            self.traced = True
+            self._max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.started_tracing = self.CAN_STOP_TRACING and not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+        self._cpu_start = time.thread_time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.cpu_time = time.thread_time() - self._cpu_start
+        if self.traced:
+            peak = 0
+            if self.started_tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self._tracing.release()
+            # ru_maxrss is in kilobytes on Linux.
+            rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._max_rss) * 1024
+            self.memory_usage = max(peak, rss_growth)
+        return False
+
+    def as_dict(self):
+        '''
+        Returns measurements in the form stored as transform details.
+        '''
+        return {
+            'memory_usage': self.memory_usage,
+            'cpu_time': self.cpu_time,
+            'wall_time': self.wall_time,
+        }
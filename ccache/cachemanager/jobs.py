@@ -0,0 +1,46 @@
+'''
+Local worker pool running background jobs of cache manager.
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+
+class JobQueue:
+    '''
+    Runs jobs in a pool of worker threads owned by current process.
+    Jobs are expected to keep their state in database, so jobs lost with a
+    process can be run again later (see run_transform_jobs command).
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        '''
+        Schedules func(*args) on a worker thread. Returns a Future.
+        '''
+        with self._lock:
+            # Worker threads do not survive fork, so every worker process starts its own pool.
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cachemanager-job')
+                self._pid = os.getpid()
+            return self._executor.submit(self.run, func, *args)
+
+    def drain(self):
+        '''
+        Waits until submitted jobs are done. Jobs submitted later start a new pool.
+        '''
+        with self._lock:
+            executor, self._executor, self._pid = self._executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def run(self, func, *args):
+        try:
+            return func(*args)
+        finally:
+            # Each worker thread has its own database connection.
+            connection.close()
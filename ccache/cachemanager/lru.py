@@ -0,0 +1,129 @@
+'''
+In-process LRU engine used by memory based cache backends.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    '''
+    Bounded key-value store with O(1) get, put and eviction.
+    Memory usage is accounted by the real length of stored payloads.
+    Records may carry a time to live after which they are treated as missing.
+    on_evict is called with number of evicted records and freed bytes after each eviction.
+    '''
+    def __init__(self, maxmemory, on_evict=None):
+        self.maxmemory = maxmemory
+        self.on_evict = on_evict
+        self.total_memory_used = 0
+        self._records = OrderedDict()
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def _evict(self, needed_space):
+        '''
+        Removes least recently used records until needed_space bytes are freed.
+        Caller must hold the lock. Returns number of freed bytes.
+        '''
+        saved_space = 0
+        evicted = 0
+        while self._records and saved_space < needed_space:
+            key, value = self._records.popitem(last=False)
+            self._expires.pop(key, None)
+            saved_space = saved_space + len(value)
+            evicted = evicted + 1
+        self.total_memory_used = self.total_memory_used - saved_space
+        if evicted and self.on_evict is not None:
+            self.on_evict(evicted, saved_space)
+        return saved_space
+
+    def evict(self, needed_space):
+        '''
+        Frees at least needed_space bytes. Returns True on success and False otherwise.
+        '''
+        with self._lock:
+            return self._evict(needed_space) >= needed_space
+
+    def put(self, key, value, ttl=None):
+        '''
+        Stores value under key, evicting least recently used records if necessary.
+        If ttl is set, record expires after ttl seconds.
+        Returns True on success and False if value does not fit in the cache at all,
+        in which case the previous value of key is removed, so it is not served stale.
+        '''
+        value_size = len(value)
+        if value_size > self.maxmemory:
+            with self._lock:
+                self._remove(key)
+            return False
+        with self._lock:
+            old_value = self._records.pop(key, None)
+            if old_value is not None:
+                self.total_memory_used = self.total_memory_used - len(old_value)
+            needed_space = self.total_memory_used + value_size - self.maxmemory
+            if needed_space > 0:
+                self._evict(needed_space)
+            self._records[key] = value
+            self.total_memory_used = self.total_memory_used + value_size
+            if ttl is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.monotonic() + ttl
+        return True
+
+    def get(self, key, default=None):
+        '''
+        Returns value stored under key and marks it as most recently used.
+        '''
+        with self._lock:
+            try:
+                value = self._records[key]
+            except KeyError:
+                return default
+            if key in self._expires and self._expires[key] <= time.monotonic():
+                self._remove(key)
+                return default
+            self._records.move_to_end(key)
+        return value
+
+    def delete(self, key):
+        '''
+        Removes key from cache. Returns True if key existed.
+        '''
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        '''
+        Removes key from cache. Caller must hold the lock.
+        '''
+        value = self._records.pop(key, None)
+        self._expires.pop(key, None)
+        if value is None:
+            return False
+        self.total_memory_used = self.total_memory_used - len(value)
+        return True
+
+    def clear(self):
+        '''
+        Removes all records.
+        '''
+        with self._lock:
+            self._records.clear()
+            self._expires.clear()
+            self.total_memory_used = 0
+
+    def size_of(self, key):
+        '''
+        Returns number of bytes used by value stored under key or 0 if key does not exist.
+        '''
+        value = self._records.get(key)
+        if value is None:
+            return 0
+        return len(value)
@@ -0,0 +1,14 @@
+'''
+Applies cache backend memory configuration to the Redis server.
+'''
+from django.core.management.base import BaseCommand
+from cachemanager.cachelib import RedisCacheBackend
+
+class Command(BaseCommand):
+    help = "Applies RedisCacheBackend.memory_config (maxmemory, eviction policy) to Redis."
+
+    def handle(self, *args, **options):
+        backend = RedisCacheBackend()
+        backend.apply_memory_config()
+        for config, value in backend.memory_config.items():
+            self.stdout.write(f"{config} = {value}")
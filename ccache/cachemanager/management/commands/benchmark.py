@@ -0,0 +1,404 @@
+'''
+Reproducible benchmark of upload, retrieval, listing and cache backend hot paths.
+
+Runs against a throwaway test database, a temporary storage directory and an empty
+Redis database (or fakeredis), reports p50/p99 latency, throughput and peak RSS of each
+scenario and compares them with a stored baseline.
+'''
+import io
+import os
+import gc
+import json
+import math
+import random
+import shutil
+import hashlib
+import platform
+import resource
+import tempfile
+import time
+import itertools
+import redis
+from PIL import Image
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from cachemanager import cachelib
+from cachemanager import redisconn
+from cachemanager.cachelib import CacheFacade, CacheMan
+from cachemanager.models import BaseFile, Blob, TextFile
+from cachemanager.storage import LocalStorageBackend
+
+class Command(BaseCommand):
+    help = "Benchmarks store_file, retrieve_file, list_files and cache backends under Zipfian load."
+    requires_system_checks = []
+
+    SCENARIOS = ['store', 'retrieve', 'list', 'backends']
+    # Text files by size in bytes, images by width and height in pixels.
+    TEXT_SIZES = [4*1024, 64*1024, 1536*1024]
+    IMAGE_SIZES = [128, 512, 1024]
+    BACKENDS = [
+        'RedisCacheBackend', 'TwoTierCacheBackend', 'CustomCacheBackend',
+        'ShardedCacheBackend', 'SharedMemoryCacheBackend',
+    ]
+    # Results compared with baseline, True if larger is better.
+    COMPARED = {'p50_ms': False, 'p99_ms': False, 'throughput': True}
+    BASELINE_OPTIONS = ['iterations', 'list_sizes', 'keys', 'ops', 'zipf', 'value_sizes', 'cache_fraction', 'seed']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=self.SCENARIOS, default=self.SCENARIOS)
+        parser.add_argument('--iterations', type=int, default=50,
+            help="Timed operations per store/retrieve scenario (and per list scenario of up to 100 files).")
+        parser.add_argument('--list-sizes', nargs='+', type=int, default=[10, 100, 1000, 10000],
+            help="Number of files owned by the listed user.")
+        parser.add_argument('--keys', type=int, default=5000, help="Distinct keys of backend scenarios.")
+        parser.add_argument('--ops', type=int, default=20000, help="Timed operations per backend.")
+        parser.add_argument('--zipf', type=float, default=1.1, help="Exponent of Zipfian key popularity.")
+        parser.add_argument('--value-sizes', nargs='+', type=int, default=[1024, 4096, 16384],
+            help="Sizes of cached values in backend scenarios, picked uniformly per key.")
+        parser.add_argument('--cache-fraction', type=float, default=0.25,
+            help="Memory of in-process backends as a fraction of the backend working set.")
+        parser.add_argument('--fake-redis', action='store_true',
+            help="Use fakeredis instead of a Redis server. It implements neither MEMORY USAGE nor, "
+                 "without lupa, Lua scripts, so store/retrieve/list use CustomCacheBackend.")
+        parser.add_argument('--redis-db', type=int, default=15,
+            help="Empty database of the configured Redis server to use; it is flushed afterwards.")
+        parser.add_argument('--image-variants', action='store_true',
+            help="Keep generating image variants in background while uploads are timed.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default='benchmark_baseline.json',
+            help="Baseline results are read from (and with --save-baseline written to) this file.")
+        parser.add_argument('--save-baseline', action='store_true', help="Store results as the new baseline.")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+            help="Relative change from baseline reported as a regression.")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        self.seed = options['seed']
+        self.samples = None
+        self.results = {}
+        self.baseline = self.read_baseline(options['baseline'])
+        self.tolerance = options['tolerance']
+        self.redis = self.setup_redis(options)
+        self.settings = {
+            'database': connection.vendor,
+            'redis': 'fakeredis' if options['fake_redis'] else 'server',
+            'cache_backend': type(CacheMan._cache_backend).__name__,
+            'options': {key: options[key] for key in self.BASELINE_OPTIONS},
+        }
+        changed = [key for key, value in self.baseline.get('settings', {}).items() if self.settings.get(key) != value]
+        if changed:
+            self.stderr.write(f"Baseline was measured with different {', '.join(changed)}; differences may not be regressions.")
+        storage_root = tempfile.mkdtemp(prefix='content-cache-benchmark-')
+        CacheMan._storage_backend = LocalStorageBackend(root=os.path.join(storage_root, ''))
+        CacheMan._image_transcoder.enabled = options['image_variants']
+        old_database_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            # In-memory test databases lock whole tables, which background jobs would run into.
+            connection.settings_dict['TEST']['NAME'] = os.path.join(storage_root, 'benchmark.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        self.stdout.write(
+            f"{'scenario':<34} {'ops':>6} {'p50 (ms)':>9} {'p99 (ms)':>9} {'ops/s':>10} {'RSS (MB)':>9}  baseline")
+        try:
+            for scenario in options['scenarios']:
+                getattr(self, f"benchmark_{scenario}")(options)
+                CacheMan._transform_queue.drain()
+        finally:
+            CacheMan._transform_queue.drain()
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            shutil.rmtree(storage_root, ignore_errors=True)
+            self.redis.flushdb()
+        if options['save_baseline']:
+            self.write_baseline(options)
+        regressions = [name for name, result in self.results.items() if result.get('regressions')]
+        if regressions:
+            self.stdout.write(self.style.WARNING(f"Regressions: {', '.join(regressions)}"))
+            if options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} scenarios regressed beyond {self.tolerance:.0%}.")
+
+    def setup_redis(self, options):
+        '''
+        Points every Redis client created from now on to fakeredis or to the benchmark database.
+        '''
+        if options['fake_redis']:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError("fakeredis is not installed.")
+            pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        else:
+            pool = redisconn.get_connection_pool({'db': options['redis_db']})
+            try:
+                keys = redis.Redis(connection_pool=pool).dbsize()
+            except redis.RedisError as error:
+                raise CommandError(f"Redis can not be reached ({error}); use --fake-redis to run without it.")
+            if keys:
+                raise CommandError(f"Redis database {options['redis_db']} holds {keys} keys, choose an empty one.")
+        redisconn.use_connection_pool(pool)
+        if options['fake_redis']:
+            # Listing looks up memory usage with MEMORY USAGE, which fakeredis does not implement.
+            self.stderr.write("fakeredis can not report memory usage of keys, CustomCacheBackend is used instead.")
+            CacheMan._cache_backend = cachelib.CustomCacheBackend()
+        return redis.Redis(connection_pool=pool)
+
+    def measure(self, name, operation, items, before=None, **extra):
+        '''
+        Times operation(item) for each of items and reports the scenario.
+        before(item) runs ahead of each operation, outside the timed section.
+        '''
+        latencies = []
+        gc.collect()
+        for item in items:
+            if before is not None:
+                before(item)
+            start_time = time.perf_counter()
+            operation(item)
+            latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        result = {
+            'ops': len(latencies),
+            'p50_ms': self.percentile(latencies, 0.5) * 1000,
+            'p99_ms': self.percentile(latencies, 0.99) * 1000,
+            'throughput': len(latencies) / sum(latencies),
+            # ru_maxrss is in kilobytes on Linux. It is the peak of the whole run so far.
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        result.update(extra)
+        result['regressions'] = self.compare(name, result)
+        self.results[name] = result
+        self.stdout.write(
+            f"{name:<34} {result['ops']:>6} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} "
+            f"{result['throughput']:>10.1f} {result['peak_rss_mb']:>9.1f}  {self.describe_change(name, result)}")
+        return result
+
+    def percentile(self, ordered, fraction):
+        '''
+        Returns nearest-rank percentile of sorted values.
+        '''
+        return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+    def create_user(self, username):
+        return get_user_model().objects.create_user(username=username, password=None)
+
+    def text_content(self, rng, extension, size):
+        '''
+        Returns css or js source of about size bytes, with comments and indentation to minify.
+        '''
+        if extension == 'css':
+            template = "/* block {0} */\n.block-{0} {{\n    margin: {1}px;\n    color: #{2:06x};\n}}\n"
+        else:
+            template = "// Adds values of block {0}\nfunction block{0}(first, second) {{\n    return first + second * {1} + {2};\n}}\n"
+        parts = []
+        length = 0
+        for index in itertools.count():
+            part = template.format(index, rng.randrange(64), rng.randrange(16**6))
+            parts.append(part)
+            length = length + len(part)
+            if length >= size:
+                return ''.join(parts).encode()
+
+    def image_content(self, rng, image_format, side):
+        '''
+        Returns an image of side x side pixels: smooth random colour fields, which compress
+        like photographs rather than like noise or flat colour.
+        '''
+        cells = max(side // 16, 2)
+        image = Image.frombytes('RGB', (cells, cells), rng.randbytes(cells * cells * 3))
+        image = image.resize((side, side), Image.BILINEAR)
+        content = io.BytesIO()
+        image.save(content, format=image_format)
+        return content.getvalue()
+
+    def upload_samples(self):
+        '''
+        Returns (label, extension, content, minify, convert) of every uploaded file kind and size.
+        Contents depend on seed only, whichever scenarios run.
+        '''
+        if self.samples is not None:
+            return self.samples
+        rng = random.Random(self.seed)
+        samples = []
+        for extension in ['css', 'js']:
+            for size in self.TEXT_SIZES:
+                content = self.text_content(rng, extension, size)
+                samples.append((f"{extension}-{size // 1024}k", extension, content, True, False))
+        for extension, image_format in [('png', 'PNG'), ('jpg', 'JPEG')]:
+            for side in self.IMAGE_SIZES:
+                content = self.image_content(rng, image_format, side)
+                samples.append((f"{extension}-{side}px", extension, content, False, True))
+        for label, _, content, _, _ in samples:
+            if len(content) >= CacheMan.MAX_FILE_SIZE:
+                raise CommandError(f"Sample {label} is larger than maximum upload size.")
+        self.samples = samples
+        return samples
+
+    def store(self, facade, owner, filename, content, minify=False, convert=False):
+        result = facade.store_file(SimpleUploadedFile(filename, content), owner, minify=minify, convert=convert)
+        if not result['success']:
+            raise CommandError(f"Storing {filename} failed: {result['errors']}")
+        return result
+
+    def benchmark_store(self, options):
+        '''
+        CacheFacade.store_file of each file kind and size, minified or converted, under new names.
+        '''
+        facade = CacheFacade()
+        owner = self.create_user('benchmark-store')
+        for label, extension, content, minify, convert in self.upload_samples():
+            self.measure(
+                f"store/{label}",
+                lambda index: self.store(facade, owner, f"{label}-{index}.{extension}", content, minify, convert),
+                range(options['iterations']),
+                size=len(content))
+            CacheMan._transform_queue.drain()
+
+    def benchmark_retrieve(self, options):
+        '''
+        CacheFacade.retrieve_file of cached files (hit) and of files dropped from cache (miss).
+        Files larger than STREAM_THRESHOLD are streamed to the end, like a response would be.
+        '''
+        facade = CacheFacade()
+        owner = self.create_user('benchmark-retrieve')
+        files = 8
+        for label, extension, content, _, _ in self.upload_samples():
+            filenames = [f"{label}-{index}.{extension}" for index in range(files)]
+            for filename in filenames:
+                self.store(facade, owner, filename, content)
+            CacheMan._transform_queue.drain()
+            digests = dict(BaseFile.objects.filter(owner=owner, filename__in=filenames).values_list('filename', 'blob_id'))
+            requests = [filenames[index % files] for index in range(options['iterations'])]
+            def retrieve(filename):
+                if not facade.retrieve_file(filename, owner):
+                    raise CommandError(f"Retrieving {filename} failed.")
+            def drop(filename):
+                CacheMan._cache_backend.delete_records([
+                    CacheMan.generate_key(CacheMan, owner.username, filename),
+                    CacheMan.generate_blob_key(CacheMan, digests[filename]),
+                ])
+            for filename in filenames:
+                retrieve(filename)
+            self.measure(f"retrieve/hit/{label}", retrieve, requests, size=len(content))
+            self.measure(f"retrieve/miss/{label}", retrieve, requests, before=drop, size=len(content))
+
+    def benchmark_list(self, options):
+        '''
+        CacheFacade.list_files with all fields, for users owning each of list_sizes files.
+        '''
+        facade = CacheFacade()
+        for count in options['list_sizes']:
+            owner = self.create_user(f"benchmark-list-{count}")
+            blobs = Blob.objects.bulk_create([
+                Blob(digest=hashlib.sha256(f"{owner.username}-{index}".encode()).hexdigest(), size=1024, reference_count=1)
+                for index in range(count)
+            ])
+            now = timezone.now()
+            base_files = BaseFile.objects.bulk_create([
+                BaseFile(owner=owner, filename=f"file-{index}.css", size=1024, blob=blob,
+                    creation_time=now, last_update_time=now)
+                for index, blob in enumerate(blobs)
+            ])
+            TextFile.objects.bulk_create([
+                TextFile(base_file=base_file, minify=True, minification_time=0.001, minification_memory=4096)
+                for base_file in base_files
+            ])
+            iterations = max(5, min(options['iterations'], options['iterations'] * 100 // count))
+            facade.list_files(owner)
+            self.measure(f"list/{count}", lambda _: facade.list_files(owner), range(iterations), files=count)
+
+    def create_backend(self, name, working_set, options):
+        '''
+        Returns a new instance of backend name, in-process ones limited to cache_fraction of working_set.
+        '''
+        backend_class = getattr(cachelib, name)
+        maxmemory = int(working_set * options['cache_fraction'])
+        kwargs = {}
+        if name in ('CustomCacheBackend', 'ShardedCacheBackend', 'TwoTierCacheBackend'):
+            kwargs['maxmemory'] = maxmemory
+        if name == 'SharedMemoryCacheBackend':
+            kwargs.update(maxmemory=maxmemory, slots=2 * options['keys'],
+                path=os.path.join(self.shared_memory_dir, f"benchmark-{os.getpid()}.arena"))
+        # Backends are singletons; benchmarks use a separate instance sized for the workload.
+        return type.__call__(backend_class, **kwargs)
+
+    def benchmark_backends(self, options):
+        '''
+        Read-through workload on each cache backend: keys are requested with Zipfian popularity
+        and missing ones are added. Reports hit ratio along with latency of get (and add on miss).
+        '''
+        self.shared_memory_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        rng = random.Random(self.seed)
+        payloads = {size: rng.randbytes(size) for size in options['value_sizes']}
+        values = [payloads[rng.choice(options['value_sizes'])] for _ in range(options['keys'])]
+        working_set = sum(len(value) for value in values)
+        popularity = list(itertools.accumulate(1 / rank ** options['zipf'] for rank in range(1, options['keys'] + 1)))
+        requests = rng.choices(range(options['keys']), cum_weights=popularity, k=options['ops'])
+        for name in self.BACKENDS:
+            backend = self.create_backend(name, working_set, options)
+            hits = 0
+            def request(index):
+                nonlocal hits
+                key = f"benchmark_{index}"
+                if backend.get_record(key):
+                    hits = hits + 1
+                else:
+                    backend.add_record(key, values[index])
+            try:
+                result = self.measure(f"backend/{name}", request, requests)
+            finally:
+                if name == 'SharedMemoryCacheBackend':
+                    os.remove(backend._arena.path)
+            result['hit_ratio'] = hits / len(requests)
+            self.stdout.write(f"{'':<34} hit ratio {result['hit_ratio']:.1%}")
+            self.redis.flushdb()
+
+    def compare(self, name, result):
+        '''
+        Returns names of results worse than baseline by more than tolerance.
+        '''
+        base = self.baseline.get('results', {}).get(name)
+        if base is None:
+            return []
+        regressions = []
+        for field, larger_is_better in self.COMPARED.items():
+            change = result[field] / base[field] - 1
+            if (-change if larger_is_better else change) > self.tolerance:
+                regressions.append(field)
+        return regressions
+
+    def describe_change(self, name, result):
+        base = self.baseline.get('results', {}).get(name)
+        if base is None:
+            return '-'
+        text = f"p50 {result['p50_ms'] / base['p50_ms'] - 1:+.0%}, ops/s {result['throughput'] / base['throughput'] - 1:+.0%}"
+        if result['regressions']:
+            text = text + ' ' + self.style.ERROR(f"REGRESSION ({', '.join(result['regressions'])})")
+        return text
+
+    def read_baseline(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as baseline_file:
+            return json.load(baseline_file)
+
+    def write_baseline(self, options):
+        '''
+        Stores results with the environment and options they were measured with.
+        '''
+        baseline = {
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': self.settings,
+            'results': {
+                name: {key: value for key, value in result.items() if key != 'regressions'}
+                for name, result in self.results.items()
+            },
+        }
+        if self.baseline:
+            # Scenarios not run this time keep their previous baseline.
+            baseline['results'] = dict(self.baseline.get('results', {}), **baseline['results'])
+        with open(options['baseline'], 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        self.stdout.write(f"Baseline written to {options['baseline']}.")
@@ -0,0 +1,100 @@
+'''
+Microbenchmark comparing LRUCache against the list based engine it replaced.
+'''
+import sys
+import random
+import time
+from django.core.management.base import BaseCommand
+from cachemanager.lru import LRUCache
+
+class ListLRUCache:
+    '''
+    Previous CustomCacheBackend engine, kept here as the benchmark baseline.
+    '''
+    def __init__(self, maxmemory):
+        self.maxmemory = maxmemory
+        self.total_memory_used = 0
+        self._last_used_key = []
+        self._cache = {}
+        self._size_cache = {}
+
+    def clear_space(self, needed_space):
+        saved_space = 0
+        removed_keys = []
+        for key in self._last_used_key:
+            del self._cache[key]
+            saved_space = saved_space + self._size_cache[key]
+            self.total_memory_used = self.total_memory_used - self._size_cache[key]
+            del self._size_cache[key]
+            removed_keys.append(key)
+            if saved_space >= needed_space:
+                break
+        for removed_key in removed_keys:
+            self._last_used_key.remove(removed_key)
+        return saved_space >= needed_space
+
+    def put(self, key, value):
+        value_size = sys.getsizeof(value)
+        if value_size + self.total_memory_used > self.maxmemory and \
+            not self.clear_space(self.total_memory_used + value_size - self.maxmemory):
+            return False
+        self._cache[key] = value
+        self.total_memory_used = self.total_memory_used + value_size
+        self._last_used_key.append(key)
+        self._size_cache[key] = value_size
+        return True
+
+    def get(self, key, default=None):
+        if key not in self._cache:
+            return default
+        self._last_used_key.remove(key)
+        self._last_used_key.append(key)
+        return self._cache[key]
+
+class Command(BaseCommand):
+    help = "Compares get/put/evict cost of LRUCache and the old list based engine."
+    requires_system_checks = []
+
+    ENGINES = {
+        'list': ListLRUCache,
+        'lru': LRUCache,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000],
+            help="Number of cached keys for each round.")
+        parser.add_argument('--ops', type=int, default=1000,
+            help="Number of timed operations per engine and round.")
+        parser.add_argument('--payload', type=int, default=64,
+            help="Payload size in bytes.")
+        parser.add_argument('--engines', nargs='+', choices=list(self.ENGINES), default=list(self.ENGINES))
+        parser.add_argument('--seed', type=int, default=0)
+
+    def fill(self, engine_class, size, payload):
+        '''
+        Returns an engine holding exactly size keys with no spare room.
+        '''
+        value = b'x' * payload
+        engine = engine_class(maxmemory=float('inf'))
+        for index in range(size):
+            engine.put(f"user_{index}.css", value)
+        engine.maxmemory = engine.total_memory_used
+        return engine, value
+
+    def time_operations(self, operation, keys):
+        start_time = time.perf_counter()
+        for key in keys:
+            operation(key)
+        return (time.perf_counter() - start_time) / len(keys)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f"{'keys':>9} {'engine':>6} {'get hit (us)':>13} {'put+evict (us)':>15}")
+        for size in options['sizes']:
+            hit_keys = [f"user_{rng.randrange(size)}.css" for _ in range(options['ops'])]
+            new_keys = [f"new_{index}.css" for index in range(options['ops'])]
+            for name in options['engines']:
+                engine, value = self.fill(self.ENGINES[name], size, options['payload'])
+                get_cost = self.time_operations(engine.get, hit_keys)
+                put_cost = self.time_operations(lambda key: engine.put(key, value), new_keys)
+                self.stdout.write(f"{size:>9} {name:>6} {get_cost*1e6:>13.2f} {put_cost*1e6:>15.2f}")
@@ -0,0 +1,26 @@
+'''
+Precompresses stored text files that are missing up to date gzip/brotli variants.
+'''
+from django.core.management.base import BaseCommand
+from cachemanager.cachelib import CacheMan
+from cachemanager.models import TextFile
+
+class Command(BaseCommand):
+    help = "Creates gzip/brotli variants of css/js files without up to date variants."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Recompress all text files.")
+
+    def handle(self, *args, **options):
+        compressed = 0
+        text_files = TextFile.objects.select_related('base_file').prefetch_related('variants')
+        for txt_file in text_files.iterator(chunk_size=100):
+            base_file = txt_file.base_file
+            if base_file.blob_id is None:
+                continue
+            up_to_date = any(variant.source_digest == base_file.blob_id for variant in txt_file.variants.all())
+            if up_to_date and not options['force']:
+                continue
+            if CacheMan.generate_text_encodings(base_file.id, base_file.blob_id):
+                compressed = compressed + 1
+        self.stdout.write(f"{compressed} text files compressed")
@@ -0,0 +1,26 @@
+'''
+Generates image variants of stored images that are missing them.
+'''
+from django.core.management.base import BaseCommand
+from cachemanager.cachelib import CacheMan
+from cachemanager.models import ImageFile
+
+class Command(BaseCommand):
+    help = "Encodes configured image variants (CONTENT_CACHE_IMAGE_VARIANTS) of images without up to date variants."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate variants of all images.")
+
+    def handle(self, *args, **options):
+        generated = 0
+        image_files = ImageFile.objects.select_related('base_file').prefetch_related('variants')
+        for image_file in image_files.iterator(chunk_size=100):
+            base_file = image_file.base_file
+            if base_file.blob_id is None:
+                continue
+            up_to_date = any(variant.source_digest == base_file.blob_id for variant in image_file.variants.all())
+            if up_to_date and not options['force']:
+                continue
+            if CacheMan.generate_image_variants(base_file.id, base_file.blob_id):
+                generated = generated + 1
+        self.stdout.write(f"Variants generated for {generated} images")
@@ -0,0 +1,29 @@
+'''
+Links files stored before content deduplication to their content blobs.
+'''
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from cachemanager.cachelib import CacheMan
+from cachemanager.models import BaseFile
+
+class Command(BaseCommand):
+    help = "Computes content digests of files without a blob and updates blob reference counts."
+
+    def handle(self, *args, **options):
+        linked = missing = 0
+        for base_file in BaseFile.objects.select_related('owner').filter(blob__isnull=True).iterator():
+            file_data = CacheMan._storage_backend.get(
+                CacheMan.generate_namespace(CacheMan, base_file.owner), base_file.filename)
+            if file_data is None:
+                missing = missing + 1
+                continue
+            digest = CacheMan._file_manager.hash_content(CacheMan._file_manager, file_data)
+            with transaction.atomic():
+                base_file = BaseFile.objects.select_for_update().filter(pk=base_file.pk, blob__isnull=True).first()
+                if base_file is None:
+                    continue
+                CacheMan.reference_blobs(CacheMan, [(digest, len(file_data))])
+                base_file.blob_id = digest
+                base_file.save(update_fields=['blob'])
+                linked = linked + 1
+        self.stdout.write(f"{linked} files linked, {missing} files missing from storage")
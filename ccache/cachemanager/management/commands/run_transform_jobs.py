@@ -0,0 +1,26 @@
+'''
+Runs transform jobs left pending, e.g. by a worker process that was restarted.
+'''
+from django.core.management.base import BaseCommand
+from cachemanager.cachelib import CacheMan
+from cachemanager.models import TransformJob
+
+class Command(BaseCommand):
+    help = "Runs pending background minification/convertion jobs in this process."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requeue-running', action='store_true',
+            help="Also run jobs marked as running. Only use this when no server process is running jobs.")
+
+    def handle(self, *args, **options):
+        if options['requeue_running']:
+            TransformJob.objects.filter(status=TransformJob.RUNNING).update(status=TransformJob.PENDING)
+        done = failed = 0
+        job_ids = TransformJob.objects.filter(status=TransformJob.PENDING).order_by('id').values_list('id', flat=True)
+        for job_id in list(job_ids):
+            if CacheMan.run_transform_job(job_id):
+                done = done + 1
+            else:
+                failed = failed + 1
+        self.stdout.write(f"{done} jobs done, {failed} jobs failed or skipped")
@@ -0,0 +1,263 @@
+'''
+Counters and histograms of cache and pipeline hot paths, exported in Prometheus text format.
+
+Each process adds observations to in-memory totals, which a daemon thread moves to a
+Redis hash every FLUSH_INTERVAL seconds with HINCRBYFLOAT. Every gunicorn worker adds
+to the same hash, so /metrics reports totals of all workers, whichever worker serves it.
+'''
+import os
+import time
+import bisect
+import threading
+import collections
+import redis
+from cachemanager.redisconn import get_redis
+
+class MetricsRegistry:
+    '''
+    Holds registered metrics and totals observed by current process, not yet sent to Redis.
+    Samples are stored under their exposition names, e.g. 'name_bucket{label="value",le="0.1"}'.
+    '''
+    KEY = 'content-cache:metrics'
+    FLUSH_INTERVAL = 1
+
+    def __init__(self):
+        self.metrics = []
+        self._pending = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        self._redis = None
+
+    @property
+    def redis(self):
+        '''
+        Redis client created on first use on the shared connection pool.
+        '''
+        if self._redis is None:
+            self._redis = get_redis()
+        return self._redis
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add(self, samples):
+        '''
+        Adds (sample name, amount) pairs to pending totals.
+        '''
+        self.ensure_flusher()
+        with self._lock:
+            for sample, amount in samples:
+                self._pending[sample] += amount
+
+    def ensure_flusher(self):
+        '''
+        Starts the thread flushing pending totals of current process.
+        '''
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            # Totals inherited from a parent process are sent by the parent.
+            self._pending.clear()
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self.run_flusher, daemon=True).start()
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        '''
+        Adds pending totals to Redis. Totals are kept for next flush if Redis can not be reached.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, collections.defaultdict(float)
+        if not pending:
+            return True
+        pipeline = self.redis.pipeline(transaction=False)
+        for sample, amount in pending.items():
+            pipeline.hincrbyfloat(self.KEY, sample, amount)
+        try:
+            pipeline.execute()
+        except redis.RedisError:
+            self.add(pending.items())
+            return False
+        return True
+
+    def collect(self):
+        '''
+        Returns totals of all processes as {sample name: value}.
+        '''
+        self.flush()
+        return {sample.decode(): value.decode() for sample, value in self.redis.hgetall(self.KEY).items()}
+
+    def render(self):
+        '''
+        Returns all metrics in Prometheus text exposition format.
+        '''
+        samples = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            own_samples = [sample for sample in samples if sample.partition('{')[0] in metric.sample_names]
+            for sample in sorted(own_samples, key=metric.sort_key):
+                lines.append(f"{sample} {samples[sample]}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        '''
+        Drops totals of all processes.
+        '''
+        with self._lock:
+            self._pending.clear()
+        self.redis.delete(self.KEY)
+
+REGISTRY = MetricsRegistry()
+
+def format_sample(name, labels):
+    '''
+    Returns exposition name of sample of metric name having (label name, value) pairs labels.
+    '''
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+class Counter:
+    '''
+    Monotonically increasing total, labelled by label_names.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.sample_names = (name,)
+        self._samples = {}
+        self.registry = registry
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        label_values = tuple(labels[name] for name in self.label_names)
+        sample = self._samples.get(label_values)
+        if sample is None:
+            sample = self._samples[label_values] = format_sample(self.name, list(zip(self.label_names, label_values)))
+        self.registry.add([(sample, amount)])
+
+    def sort_key(self, sample):
+        return sample
+
+class Histogram:
+    '''
+    Distribution of observed values (seconds) over cumulative buckets, labelled by label_names.
+    '''
+    kind = 'histogram'
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self, name, documentation, label_names=(), buckets=BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.bucket_labels = [f"{bucket:g}".replace('inf', '+Inf') for bucket in self.buckets]
+        self.sample_names = (name + '_bucket', name + '_sum', name + '_count')
+        self._samples = {}
+        self.registry = registry
+        registry.register(self)
+
+    def samples_of(self, label_values):
+        '''
+        Returns (bucket sample names, sum sample name, count sample name) of label_values.
+        '''
+        samples = self._samples.get(label_values)
+        if samples is None:
+            labels = list(zip(self.label_names, label_values))
+            samples = self._samples[label_values] = (
+                [format_sample(self.name + '_bucket', labels + [('le', bucket)]) for bucket in self.bucket_labels],
+                format_sample(self.name + '_sum', labels),
+                format_sample(self.name + '_count', labels),
+            )
+        return samples
+
+    def observe(self, value, **labels):
+        buckets, sum_sample, count_sample = self.samples_of(tuple(labels[name] for name in self.label_names))
+        # Buckets are cumulative, value is counted in the first bucket holding it and all above.
+        # Lower buckets get 0, so every bucket is exported once its labels were observed.
+        first = bisect.bisect_left(self.buckets, value)
+        samples = [(bucket, int(index >= first)) for index, bucket in enumerate(buckets)]
+        samples.append((sum_sample, value))
+        samples.append((count_sample, 1))
+        self.registry.add(samples)
+
+    def time(self, **labels):
+        '''
+        Returns a context manager observing time spent in its block.
+        '''
+        return Timer(self, labels)
+
+    def sort_key(self, sample):
+        name, _, labels = sample.partition('{')
+        labels, _, bucket = labels.rstrip('}').partition('le="')
+        return (labels.rstrip(','), self.sample_names.index(name), float(bucket.rstrip('"')) if bucket else 0)
+
+class Timer:
+    '''
+    Context manager observing wall time of its block in a histogram.
+    '''
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start_time, **self.labels)
+        return False
+
+CACHE_REQUESTS = Counter(
+    'content_cache_requests_total',
+    "Cache lookups of files by backend and result (hit or miss).",
+    ['backend', 'result'])
+CACHE_TIER_EVENTS = Counter(
+    'content_cache_tier_events_total',
+    "Hits, misses and promotions of each tier of TwoTierCacheBackend.",
+    ['tier', 'event'])
+CACHE_EVICTED_KEYS = Counter(
+    'content_cache_evicted_keys_total',
+    "Records evicted from in-process and shared memory caches to make room for new ones.",
+    ['backend'])
+CACHE_EVICTED_BYTES = Counter(
+    'content_cache_evicted_bytes_total',
+    "Bytes freed by evicting records from in-process and shared memory caches.",
+    ['backend'])
+BACKEND_LATENCY = Histogram(
+    'content_cache_backend_seconds',
+    "Latency of cache backend reads (get) and writes (set).",
+    ['backend', 'operation'])
+STORAGE_READ_LATENCY = Histogram(
+    'content_cache_storage_read_seconds',
+    "Latency of reading whole files or single chunks from persistent storage.",
+    ['mode'])
+MIME_SNIFF_LATENCY = Histogram(
+    'content_cache_mime_sniff_seconds',
+    "Latency of detecting MIME type of uploads with libmagic.")
+TRANSFORM_LATENCY = Histogram(
+    'content_cache_transform_seconds',
+    "Wall time of minification and convertion of uploads.",
+    ['operation'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+def evictions_counter(backend):
+    '''
+    Returns a callback counting evictions of backend, for LRUCache and SharedMemoryArena.
+    '''
+    def count_evictions(keys, freed_bytes):
+        CACHE_EVICTED_KEYS.inc(keys, backend=backend)
+        CACHE_EVICTED_BYTES.inc(freed_bytes, backend=backend)
+    return count_evictions
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachemanager', '0002_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransformJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('minify', 'Minify'), ('convert', 'Convert to webp')], max_length=10)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('source_digest', models.CharField(max_length=64)),
+                ('result_filename', models.CharField(blank=True, max_length=120)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('creation_time', models.DateTimeField(auto_now_add=True)),
+                ('finish_time', models.DateTimeField(blank=True, null=True)),
+                ('base_file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='transform', to='cachemanager.basefile')),
+            ],
+        ),
+    ]
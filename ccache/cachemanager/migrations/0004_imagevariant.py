@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachemanager', '0003_transformjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('format', models.CharField(max_length=10)),
+                ('preset', models.CharField(max_length=30)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('size', models.IntegerField()),
+                ('encode_time', models.FloatField()),
+                ('digest', models.CharField(max_length=64)),
+                ('source_digest', models.CharField(max_length=64)),
+                ('image_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='cachemanager.imagefile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('image_file', 'name'), name='unique_image_variant_name')],
+            },
+        ),
+    ]
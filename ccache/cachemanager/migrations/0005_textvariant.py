@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachemanager', '0004_imagevariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('encoding', models.CharField(max_length=10)),
+                ('size', models.IntegerField()),
+                ('encode_time', models.FloatField()),
+                ('digest', models.CharField(max_length=64)),
+                ('source_digest', models.CharField(max_length=64)),
+                ('text_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='cachemanager.textfile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('text_file', 'encoding'), name='unique_text_variant_encoding')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:59
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def remove_duplicate_files(apps, schema_editor):
+    '''
+    Keeps the most recently updated row of each (owner, filename) pair created
+    before uniqueness was enforced and releases blobs of removed rows.
+    '''
+    BaseFile = apps.get_model('cachemanager', 'BaseFile')
+    Blob = apps.get_model('cachemanager', 'Blob')
+    released = set()
+    duplicates = BaseFile.objects.values('owner', 'filename').annotate(rows=Count('id')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        rows = BaseFile.objects.filter(
+            owner=duplicate['owner'], filename=duplicate['filename']).order_by('-last_update_time', '-id')
+        for base_file in rows[1:]:
+            digest = base_file.blob_id
+            base_file.delete()
+            if digest is not None:
+                Blob.objects.filter(digest=digest).update(reference_count=F('reference_count') - 1)
+                released.add(digest)
+    Blob.objects.filter(digest__in=released, reference_count=0, files__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachemanager', '0005_textvariant'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_files, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='basefile',
+            constraint=models.UniqueConstraint(fields=('owner', 'filename'), name='unique_owner_filename'),
+        ),
+    ]
@@ -7,6 +7,17 @@ from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+class Blob(models.Model):
+    '''
+    Distinct file content shared by every BaseFile having the same bytes.
+    '''
+    digest = models.CharField(max_length=64, primary_key=True)
+    size = models.IntegerField()
+    reference_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.digest
+
 class BaseFile(models.Model):
     '''
     Base class for text and image files.
@@ -16,6 +27,12 @@ class BaseFile(models.Model):
     creation_time = models.DateTimeField(auto_now_add=True)
     last_update_time = models.DateTimeField(auto_now=True)
     size = models.IntegerField()
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='files', null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'filename'], name='unique_owner_filename'),
+        ]
 
     def get_absolute_url(self):
         '''
@@ -35,6 +52,26 @@ class TextFile(models.Model):
     minification_time = models.FloatField(null=True, blank=True)
     minification_memory = models.IntegerField(null=True, blank=True)
 
+class TextVariant(models.Model):
+    '''
+    Precompressed copy of a stored text file, served with Content-Encoding.
+    '''
+    text_file = models.ForeignKey(TextFile, on_delete=models.CASCADE, related_name='variants')
+    name = models.CharField(max_length=200)
+    encoding = models.CharField(max_length=10)
+    size = models.IntegerField()
+    encode_time = models.FloatField()
+    digest = models.CharField(max_length=64)
+    source_digest = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['text_file', 'encoding'], name='unique_text_variant_encoding'),
+        ]
+
+    def __str__(self):
+        return self.name
+
 class ImageFile(models.Model):
     '''
     Represents stored image files in database.
@@ -43,3 +80,58 @@ class ImageFile(models.Model):
     convert_to_webp = models.BooleanField(default=False)
     convertion_time = models.FloatField(null=True, blank=True)
     convertion_memory = models.IntegerField(null=True, blank=True)
+
+class ImageVariant(models.Model):
+    '''
+    Resized and re-encoded copy of a stored image.
+    '''
+    image_file = models.ForeignKey(ImageFile, on_delete=models.CASCADE, related_name='variants')
+    name = models.CharField(max_length=200)
+    format = models.CharField(max_length=10)
+    preset = models.CharField(max_length=30)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    size = models.IntegerField()
+    encode_time = models.FloatField()
+    digest = models.CharField(max_length=64)
+    source_digest = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image_file', 'name'], name='unique_image_variant_name'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class TransformJob(models.Model):
+    '''
+    Minification or webp convertion of a stored file, run in background.
+    '''
+    MINIFY = 'minify'
+    CONVERT = 'convert'
+    OPERATIONS = [
+        (MINIFY, 'Minify'),
+        (CONVERT, 'Convert to webp'),
+    ]
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    base_file = models.OneToOneField(BaseFile, on_delete=models.CASCADE, related_name='transform')
+    operation = models.CharField(max_length=10, choices=OPERATIONS)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    source_digest = models.CharField(max_length=64)
+    result_filename = models.CharField(max_length=120, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    creation_time = models.DateTimeField(auto_now_add=True)
+    finish_time = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.operation} {self.base_file_id} ({self.status})"
@@ -0,0 +1,17 @@
+'''
+Content negotiation of API responses.
+'''
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+class FileContentNegotiation(DefaultContentNegotiation):
+    '''
+    Renderer selection for views sending stored files. Accept header of such requests lists
+    media types of files (e.g. image/avif), which are negotiated by the view itself, so
+    responses rendered by DRF (errors) fall back to the first renderer instead of 406.
+    '''
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return (renderers[0], renderers[0].media_type)
@@ -0,0 +1,25 @@
+'''
+Pagination classes for cachemanager API endpoints.
+'''
+from rest_framework.pagination import CursorPagination
+
+class FileCursorPagination(CursorPagination):
+    '''
+    Cursor based pagination for file listings.
+    Ordering can be chosen by client among ALLOWED_ORDERINGS via ordering query parameter.
+    '''
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = '-last_update_time'
+    ordering_query_param = 'ordering'
+    ALLOWED_ORDERINGS = ['id', '-id', 'last_update_time', '-last_update_time']
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get(self.ordering_query_param, self.ordering)
+        if ordering not in self.ALLOWED_ORDERINGS:
+            ordering = self.ordering
+        if ordering.lstrip('-') == 'id':
+            return (ordering,)
+        # id breaks ties between equal timestamps so offsets inside a cursor stay stable.
+        return (ordering, '-id' if ordering.startswith('-') else 'id')
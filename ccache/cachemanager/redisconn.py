@@ -0,0 +1,70 @@
+'''
+Shared Redis connection pools configured from Django settings.
+'''
+import threading
+import redis
+from django.conf import settings
+
+DEFAULT_REDIS_SETTINGS = {
+    'HOST': 'localhost',
+    'PORT': 6379,
+    'DB': 0,
+    'UNIX_SOCKET_PATH': None,
+    'MAX_CONNECTIONS': 50,
+    'POOL_TIMEOUT': 5.0,
+    'SOCKET_TIMEOUT': 1.0,
+    'SOCKET_CONNECT_TIMEOUT': 1.0,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_redis_settings(connection_info=None):
+    '''
+    Returns CONTENT_CACHE_REDIS settings completed with defaults.
+    connection_info (host, port, db) overrides settings when provided.
+    '''
+    config = dict(DEFAULT_REDIS_SETTINGS, **getattr(settings, 'CONTENT_CACHE_REDIS', {}))
+    if connection_info is not None:
+        config.update({key.upper(): value for key, value in connection_info.items()})
+    return config
+
+def get_connection_pool(connection_info=None):
+    '''
+    Returns connection pool shared by every client using the same configuration.
+    No connection is opened until a command is executed.
+    '''
+    config = get_redis_settings(connection_info)
+    pool_key = tuple(sorted(config.items()))
+    with _pools_lock:
+        if pool_key not in _pools:
+            options = {
+                'db': config['DB'],
+                'max_connections': config['MAX_CONNECTIONS'],
+                'timeout': config['POOL_TIMEOUT'],
+                'socket_timeout': config['SOCKET_TIMEOUT'],
+                'socket_connect_timeout': config['SOCKET_CONNECT_TIMEOUT'],
+            }
+            if config['UNIX_SOCKET_PATH']:
+                options['connection_class'] = redis.UnixDomainSocketConnection
+                options['path'] = config['UNIX_SOCKET_PATH']
+            else:
+                options['host'] = config['HOST']
+                options['port'] = config['PORT']
+            _pools[pool_key] = redis.BlockingConnectionPool(**options)
+        return _pools[pool_key]
+
+def use_connection_pool(pool, connection_info=None):
+    '''
+    Makes clients created later for this configuration use pool, e.g. a pool of another
+    database or of fakeredis in benchmarks. Clients created before keep their pool.
+    '''
+    config = get_redis_settings(connection_info)
+    with _pools_lock:
+        _pools[tuple(sorted(config.items()))] = pool
+
+def get_redis(connection_info=None):
+    '''
+    Returns a Redis client on the shared connection pool.
+    '''
+    return redis.Redis(connection_pool=get_connection_pool(connection_info))
@@ -0,0 +1,499 @@
+'''
+Memory-mapped cache arena shared by every worker process on a host.
+
+The backing file holds a header, a fixed size open addressing index, a block
+map and a data arena. All processes map the same file (normally in /dev/shm)
+and serialize modifications with flock, so cached bytes are stored once per host.
+Reads copy a value out of the map (a single memcpy, without a Redis round trip).
+Arenas of different layouts (format version, size or number of slots) live in
+different files, so a process configured differently never remaps a file in use.
+'''
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+import contextlib
+
+class SharedMemoryArena:
+    '''
+    LRU key-value store living in a shared memory mapped file.
+    Values are bytes or str; str values are stored UTF-8 encoded and decoded again by get.
+
+    Values live in blocks of a buddy allocator: blocks are MIN_BLOCK bytes times a power
+    of two, free blocks of each size (order) are kept in doubly linked free lists stored
+    inside the free blocks, and a released block merges with its buddy while the buddy is
+    free too. Allocating and releasing take O(log arena size).
+    Records are linked from least to most recently used through their index slots, so
+    eviction takes O(1). Reads only hold a shared lock, so they do not move records in
+    that list; they set the record's referenced flag, and a referenced record reaching the
+    least recently used end is moved back to the other end instead of being evicted.
+    Writers mark the arena dirty while they modify it. A process killed in the middle of a
+    modification leaves the mark behind, so readers treat the arena as empty and the next
+    writer clears it.
+    '''
+    VERSION = 4
+    MAGIC = b'CCSHM%03d' % VERSION
+    # magic, slots, arena_size, used, count, deleted, lru_head, lru_tail, dirty
+    HEADER = struct.Struct('<8sQQQQQQQQ')
+    HEADER_FIELDS = ('magic', 'slots', 'arena_size', 'used', 'count', 'deleted', 'lru_head', 'lru_tail', 'dirty')
+    DIRTY_FIELD = HEADER.size - 8
+    ORDERS = 48
+    FREE_HEADS = struct.Struct(f'<{ORDERS}Q')
+    HEADER_SIZE = 512
+    # digest, state, kind, referenced, offset, length, prev, next
+    SLOT = struct.Struct('<20sBBBxQQII')
+    REFERENCED_FIELD = 22
+    LINKS_FIELD = 40
+    LINKS = struct.Struct('<II')
+    # prev, next offsets of a free block, stored at its start.
+    FREE_LINKS = struct.Struct('<QQ')
+    OFFSET = struct.Struct('<Q')
+    EMPTY, USED, DELETED = 0, 1, 2
+    BYTES, TEXT = 0, 1
+    NO_SLOT = 0xFFFFFFFF
+    NO_BLOCK = 0xFFFFFFFFFFFFFFFF
+    MIN_BLOCK = 64
+    # Block map holds order + 1 at the first unit of each block, with FREE set if the
+    # block is free, and 0 for units inside blocks.
+    FREE = 0x80
+    MAX_LOAD = 0.75
+
+    def __init__(self, path, maxmemory, slots, on_evict=None):
+        self.on_evict = on_evict
+        self.units = maxmemory // self.MIN_BLOCK
+        self.arena_size = self.units * self.MIN_BLOCK
+        self.path = self.layout_path(path, self.arena_size, slots)
+        self.max_order = max(self.units.bit_length() - 1, 0)
+        self.slots = slots
+        self.map_start = self.HEADER_SIZE + self.SLOT.size * slots
+        self.data_start = self.map_start + -(-self.units // self.MIN_BLOCK) * self.MIN_BLOCK
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = None
+
+    @classmethod
+    def layout_path(cls, path, arena_size, slots):
+        '''
+        Returns path of the backing file of an arena with given layout.
+        '''
+        return f"{path}.v{cls.VERSION}-{arena_size}-{slots}"
+
+    def _open(self):
+        '''
+        Maps backing file in current process, initializing it if it is new.
+        File descriptor is opened per process so flock excludes forked workers too.
+        Raises ValueError if the file holds an arena of another layout, which is never overwritten.
+        '''
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self._map_file(fd)
+        except BaseException:
+            # Closing the file descriptor releases its flock too.
+            os.close(fd)
+            raise
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _map_file(self, fd):
+        '''
+        Maps backing file fd, held under exclusive flock, checking layout stored in its header.
+        '''
+        total_size = self.data_start + self.arena_size
+        file_size = os.fstat(fd).st_size
+        if file_size == 0:
+            os.ftruncate(fd, total_size)
+        elif file_size != total_size:
+            raise ValueError(f"{self.path} is {file_size} bytes long, not an arena of {total_size} bytes.")
+        self._map = mmap.mmap(fd, total_size)
+        magic = self._map[:len(self.MAGIC)]
+        if magic == bytes(len(self.MAGIC)):
+            # Creator of the file did not get to initialize it.
+            self._initialize()
+            return
+        header = self._read_header()
+        if magic != self.MAGIC or header['slots'] != self.slots or header['arena_size'] != self.arena_size:
+            self._map.close()
+            self._map = None
+            raise ValueError(
+                f"{self.path} holds an arena of another layout "
+                f"({magic!r}, {header['slots']} slots, {header['arena_size']} bytes).")
+
+    def _initialize(self):
+        '''
+        Clears index and block map and splits the arena into free blocks as large as possible.
+        '''
+        self._map[:self.data_start] = bytes(self.data_start)
+        self.FREE_HEADS.pack_into(self._map, self.HEADER.size, *[self.NO_BLOCK] * self.ORDERS)
+        offset = 0
+        for order in range(self.max_order, -1, -1):
+            if self.arena_size - offset >= self.MIN_BLOCK << order:
+                self._push_free(offset, order)
+                offset = offset + (self.MIN_BLOCK << order)
+        self._write_header(used=0, count=0, deleted=0, lru_head=self.NO_SLOT, lru_tail=self.NO_SLOT, dirty=0)
+
+    def _locked(self, shared=False):
+        '''
+        Returns a context manager holding both the thread and the process lock.
+        '''
+        self._open()
+        return _ArenaLock(self._lock, self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    @contextlib.contextmanager
+    def _modifying(self):
+        '''
+        Holds the exclusive lock and keeps the arena marked dirty until modification completes.
+        An arena left dirty by a process killed while modifying it is cleared first.
+        '''
+        with self._locked():
+            if self._is_dirty():
+                self._initialize()
+            self._set_dirty(1)
+            yield
+            self._set_dirty(0)
+
+    def _is_dirty(self):
+        return self.OFFSET.unpack_from(self._map, self.DIRTY_FIELD)[0] != 0
+
+    def _set_dirty(self, dirty):
+        self.OFFSET.pack_into(self._map, self.DIRTY_FIELD, dirty)
+
+    def _read_header(self):
+        return dict(zip(self.HEADER_FIELDS, self.HEADER.unpack_from(self._map, 0)))
+
+    def _write_header(self, **fields):
+        header = self._read_header() if self._map[:len(self.MAGIC)] == self.MAGIC else {}
+        header.update(fields)
+        self.HEADER.pack_into(
+            self._map, 0, self.MAGIC, self.slots, self.arena_size, header['used'],
+            header['count'], header['deleted'], header['lru_head'], header['lru_tail'], header['dirty'])
+
+    # Block allocator.
+
+    def _free_head(self, order):
+        return self.OFFSET.unpack_from(self._map, self.HEADER.size + order * self.OFFSET.size)[0]
+
+    def _set_free_head(self, order, offset):
+        self.OFFSET.pack_into(self._map, self.HEADER.size + order * self.OFFSET.size, offset)
+
+    def _block_state(self, offset):
+        return self._map[self.map_start + offset // self.MIN_BLOCK]
+
+    def _set_block_state(self, offset, state):
+        self._map[self.map_start + offset // self.MIN_BLOCK] = state
+
+    def _push_free(self, offset, order):
+        head = self._free_head(order)
+        self.FREE_LINKS.pack_into(self._map, self.data_start + offset, self.NO_BLOCK, head)
+        if head != self.NO_BLOCK:
+            self.OFFSET.pack_into(self._map, self.data_start + head, offset)
+        self._set_free_head(order, offset)
+        self._set_block_state(offset, self.FREE | (order + 1))
+
+    def _unlink_free(self, offset, order):
+        previous, following = self.FREE_LINKS.unpack_from(self._map, self.data_start + offset)
+        if previous == self.NO_BLOCK:
+            self._set_free_head(order, following)
+        else:
+            self.OFFSET.pack_into(self._map, self.data_start + previous + self.OFFSET.size, following)
+        if following != self.NO_BLOCK:
+            self.OFFSET.pack_into(self._map, self.data_start + following, previous)
+        self._set_block_state(offset, 0)
+
+    def order_of(self, size):
+        '''
+        Returns order of the smallest block holding size bytes.
+        '''
+        units = max(1, -(-size // self.MIN_BLOCK))
+        return (units - 1).bit_length()
+
+    def _allocate(self, order):
+        '''
+        Returns offset of a free block of order, splitting a larger free block if needed,
+        or None if there is no large enough free block.
+        '''
+        for found in range(order, self.max_order + 1):
+            offset = self._free_head(found)
+            if offset != self.NO_BLOCK:
+                break
+        else:
+            return None
+        self._unlink_free(offset, found)
+        while found > order:
+            found = found - 1
+            self._push_free(offset + (self.MIN_BLOCK << found), found)
+        self._set_block_state(offset, order + 1)
+        return offset
+
+    def _release(self, offset, order):
+        '''
+        Frees block of order at offset, merging it with its buddies while they are free.
+        '''
+        self._set_block_state(offset, 0)
+        while order < self.max_order:
+            buddy = offset ^ (self.MIN_BLOCK << order)
+            if buddy + (self.MIN_BLOCK << order) > self.arena_size \
+                or self._block_state(buddy) != self.FREE | (order + 1):
+                break
+            self._unlink_free(buddy, order)
+            offset = min(offset, buddy)
+            order = order + 1
+        self._push_free(offset, order)
+
+    # Index and recency list.
+
+    def _slot_offset(self, index):
+        return self.HEADER_SIZE + index * self.SLOT.size
+
+    def _read_slot(self, index):
+        '''
+        Returns (digest, state, kind, referenced, offset, length, prev, next) of slot index.
+        '''
+        return self.SLOT.unpack_from(self._map, self._slot_offset(index))
+
+    def _write_slot(self, index, digest, state, kind=BYTES, offset=0, length=0):
+        self.SLOT.pack_into(
+            self._map, self._slot_offset(index), digest, state, kind, 0, offset, length,
+            self.NO_SLOT, self.NO_SLOT)
+
+    def _set_links(self, index, previous, following):
+        self.LINKS.pack_into(self._map, self._slot_offset(index) + self.LINKS_FIELD, previous, following)
+
+    def _links(self, index):
+        return self.LINKS.unpack_from(self._map, self._slot_offset(index) + self.LINKS_FIELD)
+
+    def _link_last(self, index, header):
+        '''
+        Appends slot index to the most recently used end of the recency list.
+        '''
+        last = header['lru_tail']
+        self._set_links(index, last, self.NO_SLOT)
+        if last == self.NO_SLOT:
+            header['lru_head'] = index
+        else:
+            self._set_links(last, self._links(last)[0], index)
+        header['lru_tail'] = index
+
+    def _unlink(self, index, header):
+        previous, following = self._links(index)
+        if previous == self.NO_SLOT:
+            header['lru_head'] = following
+        else:
+            self._set_links(previous, self._links(previous)[0], following)
+        if following == self.NO_SLOT:
+            header['lru_tail'] = previous
+        else:
+            self._set_links(following, previous, self._links(following)[1])
+
+    @staticmethod
+    def digest(key):
+        '''
+        Returns fixed size identity of key stored in the index.
+        '''
+        return hashlib.sha1(key.encode()).digest()
+
+    def _probe(self, digest):
+        '''
+        Returns (index of slot holding digest or None, first reusable slot index).
+        '''
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        reusable = None
+        for _ in range(self.slots):
+            slot_digest, state = self._read_slot(index)[:2]
+            if state == self.EMPTY:
+                return None, index if reusable is None else reusable
+            if state == self.DELETED:
+                if reusable is None:
+                    reusable = index
+            elif slot_digest == digest:
+                return index, index
+            index = (index + 1) % self.slots
+        return None, reusable
+
+    def _remove(self, index, header):
+        '''
+        Removes record of slot index, leaving a tombstone. Returns its length.
+        '''
+        offset, length = self._read_slot(index)[4:6]
+        self._unlink(index, header)
+        self._release(offset, self.order_of(length))
+        self._write_slot(index, bytes(20), self.DELETED)
+        header['used'] = header['used'] - length
+        header['count'] = header['count'] - 1
+        header['deleted'] = header['deleted'] + 1
+        return length
+
+    def _evict(self, header):
+        '''
+        Evicts the least recently used record not referenced since it was last passed over.
+        Returns False if there is no record left.
+        '''
+        while header['lru_head'] != self.NO_SLOT:
+            index = header['lru_head']
+            referenced_at = self._slot_offset(index) + self.REFERENCED_FIELD
+            if self._map[referenced_at]:
+                self._map[referenced_at] = 0
+                self._unlink(index, header)
+                self._link_last(index, header)
+                continue
+            length = self._remove(index, header)
+            if self.on_evict is not None:
+                self.on_evict(1, length)
+            return True
+        return False
+
+    def _rebuild_index(self, header):
+        '''
+        Reinserts live records into a clean index, in recency order, to drop accumulated tombstones.
+        '''
+        records = []
+        index = header['lru_head']
+        while index != self.NO_SLOT:
+            record = self._read_slot(index)
+            records.append(record)
+            index = record[7]
+        self._map[self.HEADER_SIZE:self.map_start] = bytes(self.map_start - self.HEADER_SIZE)
+        header['lru_head'] = header['lru_tail'] = self.NO_SLOT
+        for slot_digest, _, kind, referenced, offset, length, _, _ in records:
+            _, index = self._probe(slot_digest)
+            self._write_slot(index, slot_digest, self.USED, kind, offset, length)
+            self._map[self._slot_offset(index) + self.REFERENCED_FIELD] = referenced
+            self._link_last(index, header)
+        header['deleted'] = 0
+
+    def put(self, key, value):
+        '''
+        Stores value under key. Returns True on success and False otherwise, in which case
+        key is not in the arena anymore.
+        '''
+        kind = self.BYTES
+        if isinstance(value, str):
+            kind = self.TEXT
+            value = value.encode()
+        size = len(value)
+        order = self.order_of(size)
+        digest = self.digest(key)
+        with self._modifying():
+            header = self._read_header()
+            index, _ = self._probe(digest)
+            if index is not None:
+                self._remove(index, header)
+            # A rejected value must not leave the previous one behind to be served.
+            if order > self.max_order or (self.MIN_BLOCK << order) > self.arena_size:
+                self._write_header(**header)
+                return False
+            if header['count'] + 1 > self.slots * self.MAX_LOAD:
+                self._evict(header)
+            if header['count'] + header['deleted'] + 1 > self.slots * self.MAX_LOAD:
+                self._rebuild_index(header)
+            offset = self._allocate(order)
+            while offset is None and self._evict(header):
+                offset = self._allocate(order)
+            if offset is None:
+                self._write_header(**header)
+                return False
+            _, index = self._probe(digest)
+            if self._read_slot(index)[1] == self.DELETED:
+                header['deleted'] = header['deleted'] - 1
+            start = self.data_start + offset
+            self._map[start:start+size] = value
+            self._write_slot(index, digest, self.USED, kind, offset, size)
+            self._link_last(index, header)
+            header['used'] = header['used'] + size
+            header['count'] = header['count'] + 1
+            self._write_header(**header)
+        return True
+
+    def get(self, key, default=None):
+        '''
+        Returns copy of value stored under key and marks it as referenced.
+        Values are copied out under the shared lock instead of returned as memoryviews of the
+        map: once the lock is released another process may evict the value and reuse its
+        block, and a view exported from the map would also keep it from being closed.
+        '''
+        digest = self.digest(key)
+        with self._locked(shared=True):
+            if self._is_dirty():
+                return default
+            index, _ = self._probe(digest)
+            if index is None:
+                return default
+            _, _, kind, referenced, offset, length, _, _ = self._read_slot(index)
+            if not referenced:
+                # Every reader writes the same byte, so a shared lock is enough.
+                self._map[self._slot_offset(index) + self.REFERENCED_FIELD] = 1
+            start = self.data_start + offset
+            value = self._map[start:start+length]
+        return value.decode() if kind == self.TEXT else value
+
+    def delete(self, key):
+        '''
+        Removes key from the arena. Returns True if key existed.
+        '''
+        with self._modifying():
+            index, _ = self._probe(self.digest(key))
+            if index is None:
+                return False
+            header = self._read_header()
+            self._remove(index, header)
+            self._write_header(**header)
+        return True
+
+    def size_of(self, key):
+        '''
+        Returns number of bytes used by value stored under key or 0 if key does not exist.
+        '''
+        with self._locked(shared=True):
+            if self._is_dirty():
+                return 0
+            index, _ = self._probe(self.digest(key))
+            if index is None:
+                return 0
+            return self._read_slot(index)[5]
+
+    def sizes_of(self, keys):
+        '''
+        Returns a list of number of bytes used by each of keys, looked up under one lock.
+        '''
+        sizes = []
+        with self._locked(shared=True):
+            if self._is_dirty():
+                return [0] * len(keys)
+            for key in keys:
+                index, _ = self._probe(self.digest(key))
+                sizes.append(0 if index is None else self._read_slot(index)[5])
+        return sizes
+
+    def __contains__(self, key):
+        with self._locked(shared=True):
+            return not self._is_dirty() and self._probe(self.digest(key))[0] is not None
+
+    @property
+    def total_memory_used(self):
+        with self._locked(shared=True):
+            return 0 if self._is_dirty() else self._read_header()['used']
+
+class _ArenaLock:
+    '''
+    Holds a thread lock and a flock (shared or exclusive) on the arena file.
+    Threads of a process share its file descriptor, so they are serialized by the thread lock.
+    '''
+    def __init__(self, thread_lock, fd, operation):
+        self._thread_lock = thread_lock
+        self._fd = fd
+        self._operation = operation
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._fd, self._operation)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
@@ -0,0 +1,323 @@
+'''
+Persistent storage backends used by cache manager.
+
+Files are addressed by a namespace (owner's username) and a name. Uploads are
+prepared in staging_dir() and committed with put_file, which adopts the staged
+file without copying it when both live on the same filesystem.
+'''
+import os
+import hashlib
+import tempfile
+from django.conf import settings
+from django.utils.module_loading import import_string
+from cachemanager import metrics
+
+class BaseStorageBackend:
+    '''
+    Interface class for all storage backends.
+    '''
+    TMP_FILE_PREFIX = ".upload-"
+    TMP_FILE_SUFFIX = ".part"
+    FILE_MODE = 0o644
+    CHUNK_SIZE = 64*1024
+
+    def staging_dir(self):
+        '''
+        Returns a directory for temporary files that put_file can adopt cheaply.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def put_file(self, namespace, name, tmp_path, digest=None):
+        '''
+        Stores content of temporary file tmp_path as name, consuming tmp_path.
+        digest is sha256 hex digest of content, if caller already knows it.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def get(self, namespace, name):
+        '''
+        Returns content of name as bytes or None if it does not exist.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def stream(self, namespace, name, start=0, stop=None, chunk_size=None):
+        '''
+        Returns an iterator over chunks of content[start:stop] of name or None if it does not exist.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def relative_path(self, namespace, name):
+        '''
+        Returns path of name relative to storage root, for web server to send it directly.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def stat(self, namespace, name):
+        '''
+        Returns a dictionary with size and mtime of name or None if it does not exist.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def delete(self, namespace, name):
+        '''
+        Removes name. Returns True if it existed.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def list(self, namespace):
+        '''
+        Returns a sorted list of names stored in namespace.
+        '''
+        raise NotImplementedError("Not implemented by concrete storage backend in use.")
+
+    def put(self, namespace, name, content, digest=None):
+        '''
+        Stores content (bytes or an iterable of bytes chunks) as name.
+        '''
+        tmp_fd, tmp_path = self.create_tmp_file(name)
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                if isinstance(content, (bytes, bytearray, memoryview)):
+                    tmp_file.write(content)
+                else:
+                    for chunk in content:
+                        tmp_file.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.put_file(namespace, name, tmp_path, digest=digest)
+
+    def create_tmp_file(self, name):
+        '''
+        Creates an empty temporary file for name in staging directory.
+        Returns (file descriptor, file path).
+        '''
+        os.makedirs(self.staging_dir(), exist_ok=True)
+        return tempfile.mkstemp(
+            dir=self.staging_dir(),
+            prefix=self.TMP_FILE_PREFIX,
+            suffix='-'+name+self.TMP_FILE_SUFFIX)
+
+    def fsync_path(self, path):
+        '''
+        Flushes file or directory at path to disk.
+        '''
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read_file(self, path):
+        try:
+            with metrics.STORAGE_READ_LATENCY.time(mode='file'), open(path, 'rb') as file_handler:
+                return file_handler.read()
+        except FileNotFoundError:
+            return None
+
+    def iter_file(self, path, start=0, stop=None, chunk_size=None):
+        try:
+            file_handler = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        return self._iter_chunks(file_handler, start, stop, chunk_size or self.CHUNK_SIZE)
+
+    def _iter_chunks(self, file_handler, start, stop, chunk_size):
+        with file_handler:
+            file_handler.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                with metrics.STORAGE_READ_LATENCY.time(mode='chunk'):
+                    chunk = file_handler.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining = remaining - len(chunk)
+                yield chunk
+
+    def stat_file(self, path):
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+class LocalStorageBackend(BaseStorageBackend):
+    '''
+    Stores files as <root>/<namespace>/<name> on local disk.
+    Files are written to a staging file on the same filesystem and atomically
+    renamed into place, so readers never see partially written files.
+    '''
+    def __init__(self, root='/opt/content-cache/'):
+        self.root = root
+
+    def namespace_path(self, namespace):
+        return os.path.join(self.root, namespace)
+
+    def file_path(self, namespace, name):
+        return os.path.join(self.root, namespace, name)
+
+    def relative_path(self, namespace, name):
+        return os.path.join(namespace, name)
+
+    def staging_dir(self):
+        return os.path.join(self.root, '.staging')
+
+    def put_file(self, namespace, name, tmp_path, digest=None):
+        path = self.namespace_path(namespace)
+        try:
+            os.makedirs(path, exist_ok=True)
+            os.chmod(tmp_path, self.FILE_MODE)
+            self.fsync_path(tmp_path)
+            os.replace(tmp_path, self.file_path(namespace, name))
+        except BaseException:
+            # Staged file is consumed even if it could not be stored.
+            os.remove(tmp_path)
+            raise
+        self.fsync_path(path)
+
+    def get(self, namespace, name):
+        return self.read_file(self.file_path(namespace, name))
+
+    def stream(self, namespace, name, start=0, stop=None, chunk_size=None):
+        return self.iter_file(self.file_path(namespace, name), start, stop, chunk_size)
+
+    def stat(self, namespace, name):
+        return self.stat_file(self.file_path(namespace, name))
+
+    def delete(self, namespace, name):
+        try:
+            os.remove(self.file_path(namespace, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def list(self, namespace):
+        try:
+            names = os.listdir(self.namespace_path(namespace))
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.startswith('.'))
+
+class ContentAddressedStorageBackend(BaseStorageBackend):
+    '''
+    Stores each distinct content once as <root>/objects/<sha256[:2]>/<sha256>.
+    Names live in <root>/names/<namespace>/ as hard links to their object, so the
+    object's link count tells how many names still refer to it.
+    Link counts are the only references of stored objects. They also cover image variants
+    and encoded text files, which have no Blob record; Blob.reference_count is not used here.
+    '''
+    def __init__(self, root='/opt/content-cache/'):
+        self.root = root
+
+    def namespace_path(self, namespace):
+        return os.path.join(self.root, 'names', namespace)
+
+    def name_path(self, namespace, name):
+        return os.path.join(self.root, 'names', namespace, name)
+
+    def relative_path(self, namespace, name):
+        return os.path.join('names', namespace, name)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def staging_dir(self):
+        return os.path.join(self.root, 'tmp')
+
+    def hash_file(self, file_handler):
+        '''
+        Returns sha256 hex digest of an open binary file.
+        '''
+        digest = hashlib.sha256()
+        file_handler.seek(0)
+        for chunk in iter(lambda: file_handler.read(self.CHUNK_SIZE), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def release(self, file_handler):
+        '''
+        Removes object of an unlinked name if no other name refers to it anymore.
+        '''
+        file_stat = os.fstat(file_handler.fileno())
+        if file_stat.st_nlink != 1:
+            return
+        object_path = self.object_path(self.hash_file(file_handler))
+        try:
+            if os.stat(object_path).st_ino == file_stat.st_ino:
+                os.remove(object_path)
+        except FileNotFoundError:
+            pass
+
+    def put_file(self, namespace, name, tmp_path, digest=None):
+        if digest is None:
+            with open(tmp_path, 'rb') as tmp_file:
+                digest = self.hash_file(tmp_file)
+        object_path = self.object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.makedirs(self.namespace_path(namespace), exist_ok=True)
+        link_path = os.path.join(
+            self.namespace_path(namespace), f".{name}.{os.path.basename(tmp_path)}")
+        try:
+            os.chmod(tmp_path, self.FILE_MODE)
+            while True:
+                try:
+                    self.fsync_path(tmp_path)
+                    os.link(tmp_path, object_path)
+                    self.fsync_path(os.path.dirname(object_path))
+                except FileExistsError:
+                    pass
+                try:
+                    os.link(object_path, link_path)
+                    break
+                except FileNotFoundError:
+                    # Object was released by a concurrent delete, publish it again.
+                    continue
+        finally:
+            os.remove(tmp_path)
+        try:
+            old_file = open(self.name_path(namespace, name), 'rb')
+        except FileNotFoundError:
+            old_file = None
+        os.replace(link_path, self.name_path(namespace, name))
+        self.fsync_path(self.namespace_path(namespace))
+        if old_file is not None:
+            with old_file:
+                self.release(old_file)
+        return digest
+
+    def get(self, namespace, name):
+        return self.read_file(self.name_path(namespace, name))
+
+    def stream(self, namespace, name, start=0, stop=None, chunk_size=None):
+        return self.iter_file(self.name_path(namespace, name), start, stop, chunk_size)
+
+    def stat(self, namespace, name):
+        return self.stat_file(self.name_path(namespace, name))
+
+    def delete(self, namespace, name):
+        try:
+            name_file = open(self.name_path(namespace, name), 'rb')
+        except FileNotFoundError:
+            return False
+        with name_file:
+            os.remove(self.name_path(namespace, name))
+            self.release(name_file)
+        return True
+
+    def list(self, namespace):
+        try:
+            names = os.listdir(self.namespace_path(namespace))
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.startswith('.'))
+
+def get_storage_backend():
+    '''
+    Returns storage backend configured by CONTENT_CACHE_STORAGE setting.
+    LocalStorageBackend is the default, so files with identical content are stored once
+    only if ContentAddressedStorageBackend is configured.
+    '''
+    config = getattr(settings, 'CONTENT_CACHE_STORAGE', {})
+    backend_class = import_string(config.get('BACKEND', 'cachemanager.storage.LocalStorageBackend'))
+    return backend_class(**config.get('OPTIONS', {}))
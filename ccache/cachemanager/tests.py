@@ -1,3 +1,1258 @@
-from django.test import TestCase
+import io
+import gzip
+import os
+import fcntl
+import hashlib
+import zlib
+import shutil
+import tempfile
+import threading
+import unittest
+import tracemalloc
+import importlib.util
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework import permissions
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+from cachemanager import metrics
+from cachemanager.cachelib import (
+    CacheMan, CustomCacheBackend, RedisCacheBackend, ShardedCacheBackend, TwoTierCacheBackend)
+from cachemanager.imaging import ImageTranscoder
+from cachemanager.instrumentation import TransformProfile
+from cachemanager.lru import LRUCache
+from cachemanager.models import BaseFile, Blob, TransformJob
+from cachemanager.shmcache import SharedMemoryArena
+from cachemanager.storage import ContentAddressedStorageBackend, LocalStorageBackend, get_storage_backend
+from cachemanager.throttling import RedisRateThrottleMixin, RedisUserRateThrottle
+from cachemanager.views import Storage
 
-# Create your tests here.
+# fakeredis runs Lua scripts only with lupa installed.
+FAKE_REDIS = importlib.util.find_spec('fakeredis') is not None
+FAKE_REDIS_SCRIPTS = FAKE_REDIS and importlib.util.find_spec('lupa') is not None
+BROTLI = importlib.util.find_spec('brotli') is not None
+
+def fake_redis():
+    '''
+    Returns a client of a new, empty fakeredis server.
+    '''
+    import fakeredis
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+class SharedMemoryArenaTests(SimpleTestCase):
+    '''
+    Behaviour of the shared memory arena backing SharedMemoryCacheBackend.
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evicted = []
+        self.arena = self.make_arena('arena', 64 * 1024, 64)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_arena(self, name, maxmemory, slots):
+        return SharedMemoryArena(
+            os.path.join(self.directory, name), maxmemory, slots,
+            on_evict=lambda keys, freed_bytes: self.evicted.append(freed_bytes))
+
+    def test_put_get_delete(self):
+        self.assertTrue(self.arena.put('key', b'value'))
+        self.assertEqual(self.arena.get('key'), b'value')
+        self.assertEqual(self.arena.size_of('key'), 5)
+        self.assertIn('key', self.arena)
+        self.assertTrue(self.arena.put('key', b'other value'))
+        self.assertEqual(self.arena.get('key'), b'other value')
+        self.assertEqual(self.arena.total_memory_used, 11)
+        self.assertTrue(self.arena.delete('key'))
+        self.assertFalse(self.arena.delete('key'))
+        self.assertIsNone(self.arena.get('key'))
+        self.assertFalse(self.arena.get('key', False))
+        self.assertEqual(self.arena.sizes_of(['key']), [0])
+        self.assertEqual(self.arena.total_memory_used, 0)
+
+    def test_str_and_bytes_values(self):
+        link = 'blob_' + 'a' * 64 + '|1700000000'
+        self.assertTrue(self.arena.put('link', link))
+        self.assertTrue(self.arena.put('file', b'\x89PNG'))
+        self.assertTrue(self.arena.put('text', 'café'))
+        self.assertEqual(self.arena.get('link'), link)
+        self.assertEqual(self.arena.get('file'), b'\x89PNG')
+        self.assertEqual(self.arena.get('text'), 'café')
+        self.assertEqual(self.arena.size_of('text'), 5)
+
+    def test_value_larger_than_arena_is_rejected(self):
+        self.assertTrue(self.arena.put('key', b'value'))
+        self.assertFalse(self.arena.put('huge', b'0' * (64 * 1024 + 1)))
+        self.assertEqual(self.arena.get('key'), b'value')
+
+    def test_oversized_value_removes_previous_value(self):
+        self.assertTrue(self.arena.put('key', b'old'))
+        self.assertFalse(self.arena.put('key', b'0' * (64 * 1024 + 1)))
+        self.assertIsNone(self.arena.get('key'))
+        self.assertNotIn('key', self.arena)
+        self.assertEqual(self.arena.total_memory_used, 0)
+        self.assertTrue(self.arena.put('key', b'new'))
+        self.assertEqual(self.arena.get('key'), b'new')
+
+    def test_eviction_order(self):
+        # 8000 bytes take a 8 KiB block, so the arena holds eight values.
+        for index in range(8):
+            self.assertTrue(self.arena.put(f'key{index}', b'v' * 8000))
+        self.assertEqual(self.evicted, [])
+        self.assertTrue(self.arena.put('key8', b'v' * 8000))
+        self.assertEqual(self.evicted, [8000])
+        self.assertNotIn('key0', self.arena)
+        # A value read since it was last passed over gets a second chance.
+        self.arena.get('key1')
+        self.assertTrue(self.arena.put('key9', b'v' * 8000))
+        self.assertIn('key1', self.arena)
+        self.assertNotIn('key2', self.arena)
+        self.assertEqual(len(self.evicted), 2)
+
+    def test_eviction_frees_enough_contiguous_space(self):
+        for index in range(64):
+            self.assertTrue(self.arena.put(f'small{index}', b's' * 1000))
+        self.assertTrue(self.arena.put('large', b'l' * 32 * 1024))
+        self.assertEqual(self.arena.get('large'), b'l' * 32 * 1024)
+        self.assertLessEqual(self.arena.total_memory_used, 64 * 1024)
+
+    def test_freed_blocks_coalesce(self):
+        for index in range(100):
+            self.arena.put(f'key{index}', os.urandom(index * 37 % 3000 + 1))
+        for index in range(100):
+            self.arena.delete(f'key{index}')
+        self.evicted.clear()
+        self.assertTrue(self.arena.put('whole', b'w' * 64 * 1024))
+        self.assertEqual(self.evicted, [])
+
+    def test_tombstones_are_rebuilt(self):
+        arena = self.make_arena('tombstones', 64 * 1024, 16)
+        for index in range(200):
+            self.assertTrue(arena.put(f'key{index}', f'value{index}'))
+            if index % 2:
+                self.assertTrue(arena.delete(f'key{index}'))
+        header = arena._read_header()
+        self.assertLessEqual(header['count'] + header['deleted'], 16 * arena.MAX_LOAD)
+        # Live values keep their recency order across rebuilds.
+        live = [f'key{index}' for index in range(200) if f'key{index}' in arena]
+        self.assertEqual(live, [f'key{index}' for index in range(200 - 2 * len(live), 200, 2)])
+        for key in live:
+            self.assertEqual(arena.get(key), 'value' + key[3:])
+
+    def test_other_layout_uses_another_file(self):
+        self.arena.put('key', b'value')
+        other = self.make_arena('arena', 128 * 1024, 64)
+        self.assertNotEqual(other.path, self.arena.path)
+        self.assertTrue(other.put('other', b'other value'))
+        self.assertIsNone(other.get('key'))
+        self.assertEqual(self.arena.get('key'), b'value')
+        self.assertTrue(self.arena.put('more', b'more'))
+        self.assertEqual(other.get('other'), b'other value')
+
+    def test_file_of_another_format_is_not_overwritten(self):
+        self.arena.put('key', b'value')
+        with open(self.arena.path, 'rb') as arena_file:
+            content = b'CCSHM003' + arena_file.read()[8:]
+        # Same layout in a file written by an older format version.
+        with open(self.arena.path, 'wb') as arena_file:
+            arena_file.write(content)
+        arena = self.make_arena('arena', 64 * 1024, 64)
+        with self.assertRaises(ValueError):
+            arena.get('key')
+        with open(arena.path, 'rb') as arena_file:
+            self.assertEqual(arena_file.read(), content)
+
+    def test_arena_left_dirty_is_cleared(self):
+        self.arena.put('key', b'value')
+        pid = os.fork()
+        if pid == 0:
+            # Killed while modifying the arena.
+            self.arena._open()
+            fcntl.flock(self.arena._fd, fcntl.LOCK_EX)
+            self.arena._set_dirty(1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertIsNone(self.arena.get('key'))
+        self.assertNotIn('key', self.arena)
+        self.assertTrue(self.arena.put('other', b'other value'))
+        self.assertEqual(self.arena.get('other'), b'other value')
+        self.assertEqual(self.arena.total_memory_used, 11)
+
+    def test_shared_between_processes(self):
+        self.arena.put('parent', 'from parent')
+        pid = os.fork()
+        if pid == 0:
+            status = 0 if self.arena.get('parent') == 'from parent' and self.arena.put('child', b'from child') else 1
+            os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(self.arena.get('child'), b'from child')
+
+class LRUCacheTests(SimpleTestCase):
+    '''
+    Behaviour of the in-process LRU engine.
+    '''
+    def test_eviction_order(self):
+        cache = LRUCache(30)
+        cache.put('a', b'a' * 10)
+        cache.put('b', b'b' * 10)
+        cache.put('c', b'c' * 10)
+        cache.get('a')
+        self.assertTrue(cache.put('d', b'd' * 10))
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        self.assertEqual(cache.total_memory_used, 30)
+
+    def test_oversized_value_removes_previous_value(self):
+        cache = LRUCache(30)
+        cache.put('key', b'old')
+        self.assertFalse(cache.put('key', b'new' * 20))
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.total_memory_used, 0)
+
+class ShardedCacheBackendTests(SimpleTestCase):
+    '''
+    Keys of ShardedCacheBackend spread over independently bounded LRU shards.
+    '''
+    def setUp(self):
+        # Backends are singletons; tests use separate instances.
+        self.backend = type.__call__(ShardedCacheBackend, maxmemory=4 * 1000, shards=4)
+
+    def test_keys_are_spread_by_crc32(self):
+        keys = [f"owner_file{index}.css" for index in range(100)]
+        for key in keys:
+            self.assertTrue(self.backend.add_record(key, b'v'))
+        for index, shard in enumerate(self.backend._shards):
+            expected = [key for key in keys if zlib.crc32(key.encode()) % 4 == index]
+            self.assertTrue(expected)
+            self.assertEqual(len(shard), len(expected))
+            for key in expected:
+                self.assertIs(self.backend.get_shard(key), shard)
+                self.assertIn(key, shard)
+        self.assertEqual(self.backend.get_record('owner_file7.css'), b'v')
+        self.assertEqual(self.backend.memory_used_by_keys(['owner_file7.css', 'missing']), [1, 0])
+
+    def test_each_shard_evicts_within_its_share(self):
+        for index in range(200):
+            self.backend.add_record(f"key{index}", b'v' * 100)
+        for shard in self.backend._shards:
+            self.assertEqual(shard.maxmemory, 1000)
+            self.assertLessEqual(shard.total_memory_used, 1000)
+            self.assertEqual(len(shard), 10)
+        # Most recently added key of each shard is kept.
+        self.assertEqual(self.backend.get_record('key199'), b'v' * 100)
+        self.assertFalse(self.backend.get_record('key0'))
+        # A value larger than a shard's share is rejected even if maxmemory could hold it.
+        self.assertFalse(self.backend.add_record('large', b'l' * 1001))
+        self.assertFalse(self.backend.key_exists('large'))
+
+    def test_concurrent_threads_keep_backend_consistent(self):
+        backend = type.__call__(ShardedCacheBackend, maxmemory=64 * 1000, shards=4)
+        errors = []
+        def worker(thread):
+            try:
+                for index in range(500):
+                    key = f"key{(thread * 7 + index) % 300}"
+                    value = key.encode() * (1 + index % 5)
+                    backend.add_record(key, value)
+                    found = backend.get_record(key)
+                    # Another thread may have replaced or evicted it, never with bytes of another key.
+                    if found is not False and found.replace(key.encode(), b''):
+                        errors.append((key, found))
+                    if index % 10 == 0:
+                        backend.delete_record(key)
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=worker, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for shard in backend._shards:
+            self.assertLessEqual(shard.total_memory_used, shard.maxmemory)
+            self.assertEqual(shard.total_memory_used, sum(len(value) for value in shard._records.values()))
+
+@unittest.skipUnless(FAKE_REDIS_SCRIPTS, "fakeredis and lupa are not installed")
+class TwoTierCacheBackendTests(SimpleTestCase):
+    '''
+    Behaviour of the in-process L1 in front of Redis.
+    '''
+    def setUp(self):
+        # Backends are singletons; tests use separate instances.
+        self.l2 = type.__call__(RedisCacheBackend)
+        self.l2._redis = fake_redis()
+        self.backend = type.__call__(TwoTierCacheBackend, backend=self.l2, max_entry_size=1024)
+
+    def test_large_value_is_left_in_l2(self):
+        value = b'v' * (CacheMan.STREAM_THRESHOLD + 1)
+        self.l2.add_record('large', value)
+        self.assertEqual(self.backend.get_record_up_to('large', CacheMan.STREAM_THRESHOLD), len(value))
+        self.assertNotIn('large', self.backend._l1)
+        self.assertEqual(b''.join(self.backend.stream_record('large')), value)
+        self.assertEqual(self.backend.stats()['l1']['promotions'], 0)
+
+    def test_value_between_max_entry_size_and_max_size_is_not_promoted(self):
+        self.l2.add_record('medium', b'm' * 2048)
+        self.assertEqual(self.backend.get_record_up_to('medium', CacheMan.STREAM_THRESHOLD), b'm' * 2048)
+        self.assertNotIn('medium', self.backend._l1)
+        self.assertFalse(self.backend.get_record_up_to('missing', CacheMan.STREAM_THRESHOLD))
+
+    def test_linked_record_is_resolved_by_one_l2_call(self):
+        self.l2.add_records({'link': 'target|100', 'target': b'content'})
+        with mock.patch.object(self.l2, 'get_linked_record_if_changed',
+                               wraps=self.l2.get_linked_record_if_changed) as get_linked, \
+            mock.patch.object(self.l2, 'get_record') as get_record, \
+            mock.patch.object(self.l2, 'get_record_up_to') as get_record_up_to:
+            link, value = self.backend.get_linked_record_if_changed('link', max_size=1024)
+            self.assertEqual(value, b'content')
+            get_linked.assert_called_once()
+            get_record.assert_not_called()
+            get_record_up_to.assert_not_called()
+            # Both link and target were promoted, so L2 is not used again.
+            self.assertEqual(self.backend.get_linked_record_if_changed('link', max_size=1024), (link, b'content'))
+            self.assertEqual(self.backend.get_linked_record_if_changed('link', known_since=100), (link, None))
+            self.assertEqual(self.backend.get_linked_record_if_changed('link', known_targets=['target']), (link, None))
+            get_linked.assert_called_once()
+        self.assertFalse(self.backend.get_linked_record_if_changed('missing'))
+
+    def test_overwrite_drops_l1_copy(self):
+        self.l2.add_record('key', b'old')
+        self.assertEqual(self.backend.get_record('key'), b'old')
+        self.assertIn('key', self.backend._l1)
+        self.backend.add_record('key', b'new')
+        self.assertNotIn('key', self.backend._l1)
+        self.assertEqual(self.backend.get_record('key'), b'new')
+
+    def test_l2_without_invalidations_is_not_promoted(self):
+        backend = type.__call__(TwoTierCacheBackend, backend=type.__call__(CustomCacheBackend), max_entry_size=1024)
+        backend.add_records({'link': 'target', 'target': b'content'})
+        self.assertEqual(backend.get_linked_record_if_changed('link'), ('target', b'content'))
+        backend.rename_record('target', 'renamed')
+        backend.delete_records(['link'])
+        self.assertEqual(backend.get_record('renamed'), b'content')
+        self.assertEqual(len(backend._l1), 0)
+
+class LocalStorageTests(SimpleTestCase):
+    '''
+    Staged, atomically replaced files of LocalStorageBackend.
+    '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = LocalStorageBackend(root=os.path.join(self.root, ''))
+
+    def test_overwrite_replaces_whole_file(self):
+        self.storage.put('owner', 'style.css', b'old')
+        path = self.storage.file_path('owner', 'style.css')
+        replace = os.replace
+        def check_then_replace(source, destination):
+            # Readers see the old file until the complete new one is renamed over it.
+            self.assertEqual(os.path.dirname(source), self.storage.staging_dir())
+            with open(source, 'rb') as staged_file:
+                self.assertEqual(staged_file.read(), b'new content')
+            self.assertEqual(self.storage.get('owner', 'style.css'), b'old')
+            replace(source, destination)
+        with mock.patch('cachemanager.storage.os.replace', check_then_replace):
+            self.storage.put('owner', 'style.css', [b'new ', b'content'])
+        self.assertEqual(self.storage.get('owner', 'style.css'), b'new content')
+        self.assertEqual(os.stat(path).st_mode & 0o777, LocalStorageBackend.FILE_MODE)
+        self.assertEqual(os.listdir(self.storage.staging_dir()), [])
+        self.assertEqual(self.storage.list('owner'), ['style.css'])
+
+    def test_failed_put_leaves_no_staging_file(self):
+        self.storage.put('owner', 'style.css', b'old')
+        def failing_content():
+            yield b'partial'
+            raise OSError("upload interrupted")
+        with self.assertRaises(OSError):
+            self.storage.put('owner', 'style.css', failing_content())
+        with mock.patch('cachemanager.storage.os.replace', side_effect=OSError("disk full")), \
+            self.assertRaises(OSError):
+            self.storage.put('owner', 'style.css', b'new')
+        self.assertEqual(self.storage.get('owner', 'style.css'), b'old')
+        self.assertEqual(os.listdir(self.storage.staging_dir()), [])
+
+    def test_default_root(self):
+        self.assertEqual(LocalStorageBackend().root, '/opt/content-cache/')
+        self.assertEqual(settings.CONTENT_CACHE_STORAGE['OPTIONS']['root'], '/opt/content-cache/')
+        with override_settings(CONTENT_CACHE_STORAGE={}):
+            storage = get_storage_backend()
+        self.assertIsInstance(storage, LocalStorageBackend)
+        self.assertEqual(storage.file_path('owner', 'style.css'), '/opt/content-cache/owner/style.css')
+        self.assertEqual(storage.staging_dir(), '/opt/content-cache/.staging')
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    '''
+    Hard linked objects of ContentAddressedStorageBackend and their release.
+    '''
+    CONTENT = b'body { color: red; }'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = ContentAddressedStorageBackend(root=os.path.join(self.root, ''))
+        self.object_path = self.storage.object_path(hashlib.sha256(self.CONTENT).hexdigest())
+
+    def test_names_with_same_content_share_object(self):
+        self.storage.put('owner', 'first.css', self.CONTENT)
+        self.storage.put('other', 'second.css', self.CONTENT)
+        self.assertEqual(os.stat(self.object_path).st_nlink, 3)
+        self.assertEqual(
+            os.stat(self.storage.name_path('owner', 'first.css')).st_ino, os.stat(self.object_path).st_ino)
+        self.assertEqual(self.storage.get('other', 'second.css'), self.CONTENT)
+        self.assertEqual(os.listdir(self.storage.staging_dir()), [])
+
+    def test_overwrite_keeps_object_of_other_name(self):
+        self.storage.put('owner', 'first.css', self.CONTENT)
+        self.storage.put('owner', 'second.css', self.CONTENT)
+        self.storage.put('owner', 'first.css', b'body { color: blue; }')
+        self.assertEqual(os.stat(self.object_path).st_nlink, 2)
+        self.assertEqual(self.storage.get('owner', 'second.css'), self.CONTENT)
+        self.assertEqual(self.storage.get('owner', 'first.css'), b'body { color: blue; }')
+        # Overwriting the last name of an object removes it.
+        self.storage.put('owner', 'second.css', b'body { color: blue; }')
+        self.assertFalse(os.path.exists(self.object_path))
+        self.assertEqual(self.storage.list('owner'), ['first.css', 'second.css'])
+
+    def test_delete_of_last_name_removes_object(self):
+        self.storage.put('owner', 'first.css', self.CONTENT)
+        self.storage.put('owner', 'second.css', self.CONTENT)
+        self.assertTrue(self.storage.delete('owner', 'first.css'))
+        self.assertEqual(os.stat(self.object_path).st_nlink, 2)
+        self.assertTrue(self.storage.delete('owner', 'second.css'))
+        self.assertFalse(os.path.exists(self.object_path))
+        self.assertFalse(self.storage.delete('owner', 'second.css'))
+        self.assertIsNone(self.storage.get('owner', 'second.css'))
+
+    def test_released_object_is_published_again(self):
+        self.storage.put('owner', 'first.css', self.CONTENT)
+        self.storage.delete('owner', 'first.css')
+        self.storage.put('owner', 'second.css', self.CONTENT)
+        self.assertEqual(os.stat(self.object_path).st_nlink, 2)
+        self.assertEqual(self.storage.get('owner', 'second.css'), self.CONTENT)
+
+    def test_object_released_while_linking_is_published_again(self):
+        self.storage.put('owner', 'first.css', self.CONTENT)
+        link = os.link
+        def racing_link(source, destination):
+            if source == self.object_path and os.path.basename(destination).startswith('.second.css.'):
+                # Last name of the object is deleted after the object was found to exist.
+                self.storage.delete('owner', 'first.css')
+                self.assertFalse(os.path.exists(self.object_path))
+                patched.stop()
+            return link(source, destination)
+        patched = mock.patch('cachemanager.storage.os.link', racing_link)
+        patched.start()
+        self.addCleanup(mock.patch.stopall)
+        self.storage.put('owner', 'second.css', self.CONTENT)
+        self.assertEqual(os.stat(self.object_path).st_nlink, 2)
+        self.assertEqual(self.storage.get('owner', 'second.css'), self.CONTENT)
+        self.assertEqual(self.storage.list('owner'), ['second.css'])
+
+class CacheManTestMixin:
+    '''
+    Runs CacheMan on a new in-process cache and a temporary storage directory, without
+    image variants. Background jobs are queued in a mock and not run. Throttling keeps
+    its state in Redis, so it is turned off.
+    '''
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patches = [
+            # Backends are singletons; tests use a separate instance.
+            mock.patch.object(CacheMan, '_cache_backend', type.__call__(CustomCacheBackend)),
+            mock.patch.object(CacheMan, '_storage_backend', LocalStorageBackend(root=os.path.join(directory, ''))),
+            mock.patch.object(CacheMan._image_transcoder, 'enabled', False),
+            mock.patch.object(CacheMan, '_transform_queue', mock.Mock()),
+            mock.patch.object(RedisRateThrottleMixin, 'allow_request', return_value=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.user = get_user_model().objects.create_user(username='owner', password=None)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, filename, content, **data):
+        return self.client.post('/storage/', dict(data, file=SimpleUploadedFile(filename, content)))
+
+    def content_of(self, response):
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+class RangeRequestTests(CacheManTestMixin, TestCase):
+    '''
+    Range and If-Range handling of get_saved_file.
+    '''
+    CONTENT = b'body { color: red; }\n' * 10
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.upload('style.css', self.CONTENT).status_code, 200)
+        self.response = self.client.get('/storage/style.css/')
+
+    def get(self, byte_range, **headers):
+        return self.client.get('/storage/style.css/', headers=dict(headers, Range=byte_range))
+
+    def assert_partial(self, response, start, stop):
+        size = len(self.CONTENT)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.content_of(response), self.CONTENT[start:stop])
+        self.assertEqual(response['Content-Range'], f"bytes {start}-{stop - 1}/{size}")
+        self.assertEqual(response['Content-Length'], str(stop - start))
+
+    def assert_whole(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content_of(response), self.CONTENT)
+        self.assertNotIn('Content-Range', response)
+
+    def test_whole_file_advertises_ranges(self):
+        self.assert_whole(self.response)
+        self.assertEqual(self.response['Accept-Ranges'], 'bytes')
+
+    def test_byte_ranges(self):
+        size = len(self.CONTENT)
+        self.assert_partial(self.get('bytes=0-4'), 0, 5)
+        self.assert_partial(self.get('bytes=10-19'), 10, 20)
+        self.assert_partial(self.get('bytes=10-'), 10, size)
+        self.assert_partial(self.get('bytes=-5'), size - 5, size)
+        self.assert_partial(self.get(f"bytes=-{size + 10}"), 0, size)
+        self.assert_partial(self.get(f"bytes=5-{size + 10}"), 5, size)
+        self.assert_partial(self.get(f"bytes={size - 1}-{size - 1}"), size - 1, size)
+
+    def test_unsatisfiable_ranges(self):
+        size = len(self.CONTENT)
+        for byte_range in [f"bytes={size}-", f"bytes={size + 5}-{size + 10}", 'bytes=-0', 'bytes=5-4']:
+            response = self.get(byte_range)
+            self.assertEqual(response.status_code, 416, byte_range)
+            self.assertEqual(response['Content-Range'], f"bytes */{size}")
+            self.assertEqual(response.content, b'')
+
+    def test_ignored_ranges(self):
+        for byte_range in ['bytes=0-1,3-4', 'items=0-4', 'bytes=a-b', 'bytes=5', 'bytes=-']:
+            self.assert_whole(self.get(byte_range))
+
+    def test_if_range(self):
+        etag = self.response['ETag']
+        last_modified = self.response['Last-Modified']
+        self.assert_partial(self.get('bytes=0-4', **{'If-Range': etag}), 0, 5)
+        self.assert_partial(self.get('bytes=0-4', **{'If-Range': last_modified}), 0, 5)
+        # Weak entity tags never match If-Range.
+        self.assert_whole(self.get('bytes=0-4', **{'If-Range': 'W/' + etag}))
+        self.assert_whole(self.get('bytes=0-4', **{'If-Range': '"0123"'}))
+        self.assert_whole(self.get('bytes=0-4', **{'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+
+    def test_range_of_streamed_file(self):
+        content = b'/* large */\n' * (CacheMan.STREAM_THRESHOLD // 12 + 1)
+        self.upload('large.js', content)
+        # Dropped from cache, so it is copied back chunk by chunk and streamed.
+        CacheMan._cache_backend._cache.clear()
+        response = self.client.get('/storage/large.js/', headers={'Range': 'bytes=100-299'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[100:300])
+        self.assertEqual(response['Content-Range'], f"bytes 100-299/{len(content)}")
+
+class ConditionalRequestTests(CacheManTestMixin, TestCase):
+    '''
+    If-None-Match and If-Modified-Since handling of get_saved_file.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.upload('style.css', b'body { color: red; }')
+        self.response = self.client.get('/storage/style.css/')
+
+    def get(self, **headers):
+        return self.client.get('/storage/style.css/', headers=headers)
+
+    def assert_not_modified(self, response):
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], self.response['ETag'])
+        self.assertEqual(response['Last-Modified'], self.response['Last-Modified'])
+        self.assertEqual(response['Cache-Control'], self.response['Cache-Control'])
+
+    def test_validators_are_sent(self):
+        self.assertEqual(self.response.status_code, 200)
+        self.assertEqual(self.response['ETag'], '"' + hashlib.sha256(b'body { color: red; }').hexdigest() + '"')
+        self.assertIn('private', self.response['Cache-Control'])
+        self.assertIn('max-age=3600', self.response['Cache-Control'])
+
+    def test_if_none_match(self):
+        etag = self.response['ETag']
+        self.assert_not_modified(self.get(**{'If-None-Match': etag}))
+        self.assert_not_modified(self.get(**{'If-None-Match': f'"0123", {etag}'}))
+        self.assert_not_modified(self.get(**{'If-None-Match': 'W/' + etag}))
+        self.assert_not_modified(self.get(**{'If-None-Match': '*'}))
+        response = self.get(**{'If-None-Match': '"0123"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'body { color: red; }')
+
+    def test_if_modified_since(self):
+        self.assert_not_modified(self.get(**{'If-Modified-Since': self.response['Last-Modified']}))
+        response = self.get(**{'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        # If-Modified-Since is ignored when If-None-Match is present.
+        response = self.get(**{'If-None-Match': '"0123"', 'If-Modified-Since': self.response['Last-Modified']})
+        self.assertEqual(response.status_code, 200)
+
+    def test_changed_file_is_sent(self):
+        etag = self.response['ETag']
+        self.upload('style.css', b'body { color: blue; }')
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'body { color: blue; }')
+        self.assertNotEqual(response['ETag'], etag)
+
+class ThreePerMinuteThrottle(RedisUserRateThrottle):
+    rate = '3/minute'
+
+class ThrottledView(APIView):
+    permission_classes = [permissions.AllowAny]
+    throttle_classes = [ThreePerMinuteThrottle]
+
+    def get(self, request):
+        return Response({})
+
+@unittest.skipUnless(FAKE_REDIS_SCRIPTS, "fakeredis and lupa are not installed")
+class RedisRateThrottleTests(SimpleTestCase):
+    '''
+    GCRA throttling of RedisRateThrottleMixin, on fakeredis with a fake clock.
+    '''
+    def setUp(self):
+        client = fake_redis()
+        self.now = 1700000000.0
+        patches = [
+            mock.patch.object(RedisRateThrottleMixin, '_redis', client),
+            mock.patch.object(RedisRateThrottleMixin, '_gcra_script', client.register_script(RedisRateThrottleMixin.GCRA_SCRIPT)),
+            # fakeredis answers TIME (and expires keys) by time.time.
+            mock.patch('time.time', side_effect=lambda: self.now),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def request_as(self, pk):
+        return mock.Mock(user=mock.Mock(pk=pk, is_authenticated=True))
+
+    def allow(self, pk=1):
+        throttle = ThreePerMinuteThrottle()
+        return throttle.allow_request(self.request_as(pk), None), throttle.wait()
+
+    def test_burst_then_one_request_per_interval(self):
+        self.assertEqual([self.allow() for _ in range(3)], [(True, None)] * 3)
+        self.assertEqual(self.allow(), (False, 20.0))
+        self.now = self.now + 5
+        self.assertEqual(self.allow(), (False, 15.0))
+        self.now = self.now + 15
+        self.assertEqual(self.allow(), (True, None))
+        self.assertEqual(self.allow(), (False, 20.0))
+
+    def test_bucket_drains_while_idle(self):
+        for _ in range(3):
+            self.allow()
+        self.now = self.now + 60
+        self.assertEqual([self.allow() for _ in range(3)], [(True, None)] * 3)
+        self.assertFalse(self.allow()[0])
+
+    def test_users_are_throttled_separately(self):
+        for _ in range(3):
+            self.allow(pk=1)
+        self.assertFalse(self.allow(pk=1)[0])
+        self.assertTrue(self.allow(pk=2)[0])
+
+    def test_retry_after_header(self):
+        factory = APIRequestFactory()
+        user = mock.Mock(pk=1, is_authenticated=True)
+        for _ in range(3):
+            request = factory.get('/')
+            force_authenticate(request, user=user)
+            self.assertEqual(ThrottledView.as_view()(request).status_code, 200)
+        self.now = self.now + 0.5
+        request = factory.get('/')
+        force_authenticate(request, user=user)
+        response = ThrottledView.as_view()(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '20')
+
+    def test_requests_are_allowed_without_redis(self):
+        with mock.patch.object(RedisRateThrottleMixin, '_gcra_script', side_effect=redis.ConnectionError):
+            self.assertEqual([self.allow() for _ in range(5)], [(True, None)] * 5)
+
+class BlobReferenceTests(CacheManTestMixin, TestCase):
+    '''
+    Reference counting of content shared by several files.
+    '''
+    CONTENT = b'body { color: red; }'
+
+    def setUp(self):
+        super().setUp()
+        self.digest = hashlib.sha256(self.CONTENT).hexdigest()
+        self.blob_key = CacheMan.generate_blob_key(CacheMan, self.digest)
+
+    def reference_count(self, digest=None):
+        return Blob.objects.filter(digest=digest or self.digest).values_list('reference_count', flat=True).first()
+
+    def delete(self, filename):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.delete(f"/storage/{filename}/")
+
+    def test_shared_blob_is_removed_with_last_file(self):
+        self.upload('first.css', self.CONTENT)
+        self.assertEqual(self.reference_count(), 1)
+        self.upload('second.css', self.CONTENT)
+        self.assertEqual(self.reference_count(), 2)
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertTrue(CacheMan._cache_backend.key_exists(self.blob_key))
+        self.assertEqual(self.delete('first.css').status_code, 204)
+        self.assertEqual(self.reference_count(), 1)
+        self.assertTrue(CacheMan._cache_backend.key_exists(self.blob_key))
+        self.assertEqual(self.client.get('/storage/second.css/').content, self.CONTENT)
+        self.assertEqual(self.delete('second.css').status_code, 204)
+        self.assertFalse(Blob.objects.filter(digest=self.digest).exists())
+        self.assertFalse(CacheMan._cache_backend.key_exists(self.blob_key))
+        self.assertEqual(self.delete('second.css').status_code, 404)
+
+    def test_overwritten_file_releases_its_blob(self):
+        self.upload('first.css', self.CONTENT)
+        self.upload('second.css', self.CONTENT)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload('first.css', b'body { color: blue; }')
+        self.assertEqual(self.reference_count(), 1)
+        self.assertEqual(self.reference_count(hashlib.sha256(b'body { color: blue; }').hexdigest()), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload('second.css', b'body { color: blue; }')
+        self.assertFalse(Blob.objects.filter(digest=self.digest).exists())
+        self.assertFalse(CacheMan._cache_backend.key_exists(self.blob_key))
+
+    def test_shared_blob_ram_is_counted_once(self):
+        self.upload('first.css', self.CONTENT)
+        self.upload('second.css', self.CONTENT)
+        listing = self.client.get('/storage/', {'fields': 'filename,consumed_ram'}).json()
+        usage = CacheMan._cache_backend.memory_used_by_keys([self.blob_key])[0]
+        self.assertGreater(usage, 0)
+        self.assertEqual([file['consumed_ram'] for file in listing['files']], [usage, usage])
+        self.assertEqual(listing['total_consumed_ram'], usage)
+
+    def test_blob_released_during_upload_is_kept(self):
+        self.upload('first.css', self.CONTENT)
+        reference_blobs = CacheMan.reference_blobs
+        def reference_then_release(cache_man, blobs):
+            # Last file using the content is deleted between the upload's blob upsert and its file row.
+            reference_blobs(cache_man, blobs)
+            CacheMan.remove_file_record('first.css', self.user)
+        with mock.patch.object(CacheMan, 'reference_blobs', reference_then_release):
+            self.assertEqual(self.upload('second.css', self.CONTENT).status_code, 200)
+        self.assertEqual(self.reference_count(), 1)
+        self.assertEqual(list(BaseFile.objects.values_list('filename', 'blob_id')), [('second.css', self.digest)])
+
+    def test_blob_released_before_upload_is_created_again(self):
+        self.upload('first.css', self.CONTENT)
+        reference_blobs = CacheMan.reference_blobs
+        def release_then_reference(cache_man, blobs):
+            CacheMan.remove_file_record('first.css', self.user)
+            self.assertFalse(Blob.objects.filter(digest=self.digest).exists())
+            reference_blobs(cache_man, blobs)
+        with mock.patch.object(CacheMan, 'reference_blobs', release_then_reference):
+            self.assertEqual(self.upload('second.css', self.CONTENT).status_code, 200)
+        self.assertEqual(self.reference_count(), 1)
+        self.assertEqual(self.client.get('/storage/second.css/').content, self.CONTENT)
+
+class FileListingTests(CacheManTestMixin, TestCase):
+    '''
+    Cursor pagination and fields of Storage GET.
+    '''
+    def image(self):
+        content = io.BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(content, format='PNG')
+        return content.getvalue()
+
+    def upload_files(self, start, stop):
+        for index in range(start, stop):
+            if index % 2:
+                self.upload(f"logo{index}.png", self.image())
+            else:
+                self.upload(f"style{index}.css", f"body {{ z-index: {index}; }}".encode())
+
+    def list_pages(self, **params):
+        pages = []
+        response = self.client.get('/storage/', params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append([file['filename'] for file in response.json()['files']])
+            if not response.json()['next']:
+                return pages
+            response = self.client.get(response.json()['next'])
+
+    def test_pages_follow_ordering(self):
+        self.upload_files(0, 7)
+        by_id = list(BaseFile.objects.order_by('id').values_list('filename', flat=True))
+        pages = self.list_pages(page_size=3, ordering='id')
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), by_id)
+        self.assertEqual(sum(self.list_pages(page_size=3, ordering='-id'), []), by_id[::-1])
+        # Files updated at the same time are ordered by id, newest first by default.
+        BaseFile.objects.update(last_update_time=timezone.now())
+        self.assertEqual(sum(self.list_pages(page_size=2), []), by_id[::-1])
+        # Previous link of a page leads back to the page before it.
+        first = self.client.get('/storage/', {'page_size': 3, 'ordering': 'id'}).json()
+        second = self.client.get(first['next']).json()
+        previous = self.client.get(second['previous']).json()
+        self.assertEqual(previous['files'], first['files'])
+
+    def test_query_count_does_not_grow_with_files(self):
+        self.upload_files(0, 4)
+        # Page and image variants of its images are read by one query each.
+        with self.assertNumQueries(2):
+            response = self.client.get('/storage/', {'page_size': 100})
+        self.assertEqual(response.json()['number_of_files'], 4)
+        self.upload_files(4, 20)
+        with self.assertNumQueries(2):
+            response = self.client.get('/storage/', {'page_size': 100})
+        self.assertEqual(response.json()['number_of_files'], 20)
+        # Variants are not prefetched unless requested.
+        with self.assertNumQueries(1):
+            self.client.get('/storage/', {'page_size': 100, 'fields': 'filename,size,consumed_ram'})
+
+    def test_fields(self):
+        self.upload_files(0, 2)
+        response = self.client.get('/storage/', {'fields': 'filename,size'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('total_consumed_ram', response.json())
+        response = self.client.get('/storage/', {'fields': 'filename,owner,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'errors': ["Invalid fields: owner, password"]})
+
+class ImageVariantNegotiationTests(CacheManTestMixin, TestCase):
+    '''
+    Accept based choice of image variants by get_saved_file.
+    '''
+    def setUp(self):
+        super().setUp()
+        # Variants are encoded in a thread instead of a spawned process.
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        patches = [
+            mock.patch.object(CacheMan._image_transcoder, 'enabled', True),
+            mock.patch.object(ImageTranscoder, 'pool', property(lambda transcoder: executor)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # Noise does not compress losslessly, so lossy variants are smaller than the PNG.
+        content = io.BytesIO()
+        Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(content, format='PNG')
+        self.content = content.getvalue()
+        self.assertEqual(self.upload('photo.png', self.content).status_code, 200)
+        self.base_file = BaseFile.objects.get(filename='photo.png')
+
+    def get(self, accept):
+        return self.client.get('/storage/photo.png/', headers={'Accept': accept})
+
+    def generate_variants(self):
+        return CacheMan.generate_image_variants(self.base_file.id, self.base_file.blob_id)
+
+    def assert_original(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(self.content_of(response), self.content)
+
+    def assert_variant(self, response, variant):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], f"image/{variant.format}")
+        self.assertEqual(
+            self.content_of(response), CacheMan._storage_backend.get(self.user.username, variant.name))
+
+    def vary(self, response):
+        return [header.strip() for header in response['Vary'].split(',')]
+
+    def test_original_is_sent_before_variants_exist(self):
+        response = self.get('image/avif,image/webp,*/*')
+        self.assert_original(response)
+        self.assertIn('Accept', self.vary(response))
+
+    def test_smallest_accepted_variant_is_sent(self):
+        self.get('image/avif,image/webp')
+        variants = self.generate_variants()
+        full_width = [variant for variant in variants if variant.width == 64]
+        self.assertEqual({variant.format for variant in full_width}, {'webp', 'avif'})
+        smallest = min(full_width, key=lambda variant: variant.size)
+        # Links cached before variants existed were dropped when they were generated.
+        response = self.get('image/avif,image/webp')
+        self.assert_variant(response, smallest)
+        self.assertIn('Accept', self.vary(response))
+        self.assertEqual(self.get('image/avif,image/webp').content, response.content)
+        webp = min([variant for variant in full_width if variant.format == 'webp'], key=lambda variant: variant.size)
+        self.assert_variant(self.get('image/webp'), webp)
+        self.assert_variant(self.get('image/avif;q=0, image/webp;q=0.8'), webp)
+
+    def test_wildcards_get_original(self):
+        self.generate_variants()
+        for accept in ('*/*', 'image/*', '', 'image/png'):
+            response = self.get(accept)
+            self.assert_original(response)
+            self.assertIn('Accept', self.vary(response))
+
+    def test_error_is_not_refused_for_image_accept(self):
+        response = self.client.get('/storage/missing.png/', headers={'Accept': 'image/avif,image/webp'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+class TextEncodingTests(CacheManTestMixin, TestCase):
+    '''
+    Accept-Encoding negotiation of precompressed css/js files.
+    '''
+    CONTENT = b'body { color: red; margin: 0 auto; }\n' * 50
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.upload('style.css', self.CONTENT).status_code, 200)
+        self.base_file = BaseFile.objects.get(filename='style.css')
+
+    def get(self, accept_encoding, **headers):
+        return self.client.get('/storage/style.css/', headers=dict(headers, **{'Accept-Encoding': accept_encoding}))
+
+    def generate_encodings(self):
+        return CacheMan.generate_text_encodings(self.base_file.id, self.base_file.blob_id)
+
+    def vary(self, response):
+        return [header.strip() for header in response['Vary'].split(',')]
+
+    def assert_identity(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(self.content_of(response), self.CONTENT)
+        self.assertIn('Accept-Encoding', self.vary(response))
+
+    def test_identity_is_sent_before_encodings_exist(self):
+        self.assert_identity(self.get('br, gzip'))
+
+    @unittest.skipUnless(BROTLI, "brotli is not installed")
+    def test_preferred_encoding_is_sent(self):
+        import brotli
+        self.get('br, gzip')
+        self.assertEqual(sorted(variant.encoding for variant in self.generate_encodings()), ['br', 'gzip'])
+        response = self.get('gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(self.content_of(response)), self.CONTENT)
+        self.assertIn('Accept-Encoding', self.vary(response))
+        self.assertEqual(response['Content-Type'], 'text/css')
+        response = self.get('br;q=0.5, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(self.content_of(response)), self.CONTENT)
+        self.assertIn('Accept-Encoding', self.vary(response))
+        self.assert_identity(self.get('identity'))
+        self.assert_identity(self.get('br;q=0, gzip;q=0'))
+
+    def test_range_is_served_from_identity(self):
+        self.generate_encodings()
+        response = self.get('br, gzip', Range='bytes=5-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(self.content_of(response), self.CONTENT[5:10])
+        self.assertEqual(response['Content-Range'], f"bytes 5-9/{len(self.CONTENT)}")
+        self.assertIn('Accept-Encoding', self.vary(response))
+
+@override_settings(CONTENT_CACHE_X_ACCEL_REDIRECT='/internal-storage/')
+class AccelRedirectTests(CacheManTestMixin, TestCase):
+    '''
+    Downloads offloaded to nginx with X-Accel-Redirect.
+    '''
+    CONTENT = b'body { color: red; }\n' * 20
+
+    def setUp(self):
+        super().setUp()
+        self.assertEqual(self.upload('style.css', self.CONTENT).status_code, 200)
+        self.base_file = BaseFile.objects.get(filename='style.css')
+
+    def get(self, **headers):
+        # Content is sent by nginx, so neither cache nor storage is read.
+        with mock.patch.object(CacheMan._storage_backend, 'get', side_effect=AssertionError("storage was read")), \
+            mock.patch.object(CacheMan._storage_backend, 'stream', side_effect=AssertionError("storage was read")), \
+            mock.patch.object(CacheMan._cache_backend, 'get_record', side_effect=AssertionError("cache was read")):
+            return self.client.get('/storage/style.css/', headers=headers)
+
+    def test_file_is_sent_by_nginx(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/internal-storage/owner/style.css')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['ETag'], f'"{self.base_file.blob_id}"')
+        self.assertEqual(response['Last-Modified'], http_date(self.base_file.last_update_time.timestamp()))
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, b'')
+
+    def test_encoded_file_is_sent_by_nginx(self):
+        variants = CacheMan.generate_text_encodings(self.base_file.id, self.base_file.blob_id)
+        gzip_variant = [variant for variant in variants if variant.encoding == 'gzip'][0]
+        response = self.get(**{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['X-Accel-Redirect'], '/internal-storage/owner/.encoded.style.css.gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], f'"{gzip_variant.digest}"')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response.content, b'')
+
+    def test_current_copy_is_not_sent(self):
+        response = self.get(**{'If-None-Match': f'"{self.base_file.blob_id}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(response.content, b'')
+
+class BatchUploadTests(CacheManTestMixin, TestCase):
+    '''
+    Storage POST with several files in files field.
+    '''
+    def image(self, image_format):
+        content = io.BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(content, format=image_format)
+        return content.getvalue()
+
+    def upload_batch(self, files, **data):
+        return self.client.post('/storage/', dict(data, files=[
+            SimpleUploadedFile(filename, content) for filename, content in files]))
+
+    def test_results_per_file(self):
+        response = self.upload_batch([
+            ('first.css', b'body { color: red; }'),
+            ('data.bin', bytes(range(256))),
+            ('first.css', b'body { color: blue; }'),
+            ('large.js', b'/* large */\n' * (CacheMan.MAX_FILE_SIZE // 12 + 1)),
+            ('second.js', b'var second = 2;'),
+            ])
+        self.assertEqual(response.status_code, 200)
+        files = response.json()['files']
+        self.assertEqual([result['success'] for result in files], [True, False, False, False, True])
+        self.assertEqual([result['filename'] for result in files],
+            ['first.css', 'data.bin', 'first.css', 'large.js', 'second.js'])
+        self.assertEqual(files[1]['errors'], ["Uploaded file's type is not allowed."])
+        self.assertEqual(files[2]['errors'], ["Another file of this batch is already stored as first.css."])
+        self.assertIn("Uploaded file's size should be less than", files[3]['errors'][0])
+        self.assertEqual(files[4]['url'], '/storage/second.js/')
+        self.assertEqual(response['X-Uploaded-Filename'], 'first.css,second.js')
+        self.assertEqual(sorted(BaseFile.objects.values_list('filename', flat=True)), ['first.css', 'second.js'])
+        # First file of the batch wins.
+        self.assertEqual(self.client.get('/storage/first.css/').content, b'body { color: red; }')
+
+    def test_converted_files_stored_under_the_same_name(self):
+        response = self.upload_batch([('logo.png', self.image('PNG')), ('logo.jpg', self.image('JPEG'))], convert='true')
+        files = response.json()['files']
+        self.assertTrue(files[0]['success'])
+        self.assertEqual(files[0]['filename'], 'logo.webp')
+        self.assertEqual(files[1], {
+            'filename': 'logo.jpg',
+            'success': False,
+            'errors': ["Another file of this batch is already stored as logo.webp."],
+            })
+        self.assertEqual(list(BaseFile.objects.values_list('filename', flat=True)), ['logo.webp'])
+
+    def test_batch_without_stored_files(self):
+        response = self.upload_batch([('data.bin', bytes(range(256)))])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['files'][0]['success'])
+        self.assertNotIn('X-Uploaded-Filename', response)
+
+    def test_too_many_files(self):
+        response = self.upload_batch([
+            (f"file{index}.css", b'body {}') for index in range(Storage.MAX_BATCH_FILES + 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(BaseFile.objects.exists())
+
+    def save_base_files(self, filenames):
+        digest = hashlib.sha256(b'body {}').hexdigest()
+        Blob.objects.get_or_create(digest=digest, defaults={'size': 7})
+        files_info = {filename: {'filesize': 7, 'digest': digest} for filename in filenames}
+        with transaction.atomic():
+            return CacheMan.save_base_files(CacheMan, files_info, self.user)
+
+    def test_filename_created_concurrently_is_updated(self):
+        self.save_base_files(['first.css'])
+        select_for_update = BaseFile.objects.select_for_update
+        lookups = []
+        def racing_select_for_update():
+            # First lookup runs before another upload inserted first.css.
+            lookups.append(None)
+            return BaseFile.objects.none() if len(lookups) == 1 else select_for_update()
+        with mock.patch.object(BaseFile.objects, 'select_for_update', racing_select_for_update):
+            base_files, blob_changes = self.save_base_files(['first.css', 'second.css'])
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(sorted(base_files), ['first.css', 'second.css'])
+        digest = hashlib.sha256(b'body {}').hexdigest()
+        self.assertCountEqual(blob_changes, [(None, digest), (digest, digest)])
+
+    def test_integrity_error_of_another_cause_is_raised(self):
+        with mock.patch.object(BaseFile.objects, 'bulk_create', side_effect=IntegrityError("NOT NULL constraint failed")), \
+            self.assertRaises(IntegrityError):
+            self.save_base_files(['first.css'])
+
+@unittest.skipUnless(FAKE_REDIS, "fakeredis is not installed")
+class MetricsTests(SimpleTestCase):
+    '''
+    Exposition format and Redis aggregation of metrics, and the /metrics endpoint.
+    '''
+    def setUp(self):
+        import fakeredis
+        self.server = fakeredis.FakeServer()
+
+    def make_registry(self):
+        '''
+        Returns registry of another worker process, with a counter and a histogram of its own.
+        '''
+        import fakeredis
+        registry = metrics.MetricsRegistry()
+        registry._redis = fakeredis.FakeRedis(server=self.server)
+        # Totals are flushed by the tests, not by a background thread.
+        registry._flusher_pid = os.getpid()
+        requests = metrics.Counter('test_requests_total', "Requests.", ['result'], registry=registry)
+        latency = metrics.Histogram('test_seconds', "Latency.", ['operation'], buckets=(0.01, 0.1, 1), registry=registry)
+        return registry, requests, latency
+
+    def test_exposition_format(self):
+        registry, requests, latency = self.make_registry()
+        requests.inc(result='hit')
+        requests.inc(2, result='hit')
+        requests.inc(result='miss')
+        latency.observe(0.005, operation='get')
+        latency.observe(0.5, operation='get')
+        latency.observe(2, operation='set')
+        self.assertEqual(registry.render(), "\n".join([
+            '# HELP test_requests_total Requests.',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{result="hit"} 3',
+            'test_requests_total{result="miss"} 1',
+            '# HELP test_seconds Latency.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{operation="get",le="0.01"} 1',
+            'test_seconds_bucket{operation="get",le="0.1"} 1',
+            'test_seconds_bucket{operation="get",le="1"} 2',
+            'test_seconds_bucket{operation="get",le="+Inf"} 2',
+            'test_seconds_sum{operation="get"} 0.505',
+            'test_seconds_count{operation="get"} 2',
+            'test_seconds_bucket{operation="set",le="0.01"} 0',
+            'test_seconds_bucket{operation="set",le="0.1"} 0',
+            'test_seconds_bucket{operation="set",le="1"} 0',
+            'test_seconds_bucket{operation="set",le="+Inf"} 1',
+            'test_seconds_sum{operation="set"} 2',
+            'test_seconds_count{operation="set"} 1',
+            ]) + "\n")
+
+    def test_totals_of_workers_are_added_in_redis(self):
+        first, first_requests, _ = self.make_registry()
+        second, second_requests, _ = self.make_registry()
+        first_requests.inc(result='hit')
+        second_requests.inc(2, result='hit')
+        self.assertTrue(second.flush())
+        # Totals of the worker rendering them are flushed first.
+        self.assertIn('test_requests_total{result="hit"} 3\n', first.render())
+        self.assertIn('test_requests_total{result="hit"} 3\n', second.render())
+        self.assertEqual(
+            dict(first.redis.hgetall(metrics.MetricsRegistry.KEY)), {b'test_requests_total{result="hit"}': b'3'})
+
+    def test_totals_are_kept_while_redis_is_down(self):
+        registry, requests, _ = self.make_registry()
+        requests.inc(result='hit')
+        self.server.connected = False
+        self.assertFalse(registry.flush())
+        requests.inc(result='hit')
+        self.server.connected = True
+        self.assertTrue(registry.flush())
+        self.assertIn('test_requests_total{result="hit"} 2\n', registry.render())
+
+    def test_endpoint(self):
+        registry, requests, _ = self.make_registry()
+        requests.inc(result='hit')
+        with mock.patch.object(metrics, 'REGISTRY', registry), \
+            mock.patch.object(CacheMan, '_cache_backend', type.__call__(CustomCacheBackend)):
+            response = self.client.get('/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+            self.assertIn(b'test_requests_total{result="hit"} 1\n', response.content)
+            self.server.connected = False
+            response = self.client.get('/metrics')
+            self.assertEqual(response.status_code, 503)
+
+    def test_endpoint_reports_evictions_of_cache_server(self):
+        registry, _, _ = self.make_registry()
+        with mock.patch.object(metrics, 'REGISTRY', registry), \
+            mock.patch.object(CacheMan, '_cache_backend', mock.Mock(server_evicted_keys=mock.Mock(return_value=7))):
+            response = self.client.get('/metrics')
+        self.assertIn(b'content_cache_server_evicted_keys_total{backend="Mock"} 7\n', response.content)
+
+class TransformProfileTests(SimpleTestCase):
+    '''
+    Timing and sampled memory measurement of transforms.
+    '''
+    def test_sampled_profile(self):
+        with TransformProfile(sample_rate=1) as profile:
+            data = [bytes(1024) for _ in range(1024)]
+        self.assertGreaterEqual(profile.wall_time, 0)
+        self.assertGreaterEqual(profile.cpu_time, 0)
+        self.assertIsNotNone(profile.memory_usage)
+        if TransformProfile.CAN_STOP_TRACING:
+            self.assertGreaterEqual(profile.memory_usage, len(data) * 1024)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_unsampled_profile(self):
+        with TransformProfile(sample_rate=0) as profile:
+            pass
+        self.assertIsNotNone(profile.wall_time)
+        self.assertIsNone(profile.memory_usage)
+
+    def test_tracing_started_elsewhere_is_kept(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        with TransformProfile(sample_rate=1):
+            pass
+        self.assertTrue(tracemalloc.is_tracing())
+
+class TransformJobTests(CacheManTestMixin, TestCase):
+    '''
+    Minification and convertion run in background by transform jobs.
+    '''
+    def run_job(self, filename):
+        job = TransformJob.objects.get(base_file__filename=filename)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(CacheMan.run_transform_job(job.id))
+        return TransformJob.objects.get(id=job.id)
+
+    def test_converted_image_replaces_original(self):
+        content = io.BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(content, format='PNG')
+        response = self.upload('logo.png', content.getvalue(), convert='true', background='true')
+        self.assertEqual(response.json()['transform'], {'operation': 'convert', 'status': 'pending'})
+        self.assertEqual(self.client.get('/storage/logo.png/').content, content.getvalue())
+        job = self.run_job('logo.png')
+        self.assertEqual((job.status, job.result_filename), (TransformJob.DONE, 'logo.webp'))
+        self.assertEqual(job.base_file.filename, 'logo.webp')
+        # As after a synchronous convertion, only the webp file is left.
+        self.assertEqual(list(BaseFile.objects.values_list('filename', flat=True)), ['logo.webp'])
+        self.assertEqual(CacheMan._storage_backend.list('owner'), ['logo.webp'])
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(self.client.get('/storage/logo.png/').status_code, 404)
+        response = self.client.get('/storage/logo.webp/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content[8:12], b'WEBP')
+        listed = self.client.get('/storage/').json()['files']
+        self.assertEqual([(entry['filename'], entry['processed'], entry['transform']['status']) for entry in listed],
+            [('logo.webp', True, TransformJob.DONE)])
+
+    def test_minified_file_keeps_its_name(self):
+        self.upload('style.css', b'body {\n    color: red;\n}\n', minify='true', background='true')
+        job = self.run_job('style.css')
+        self.assertEqual((job.status, job.result_filename), (TransformJob.DONE, 'style.css'))
+        self.assertEqual(list(BaseFile.objects.values_list('filename', flat=True)), ['style.css'])
+        self.assertEqual(self.client.get('/storage/style.css/').content, b'body{color:red}')
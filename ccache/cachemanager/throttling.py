@@ -0,0 +1,74 @@
+'''
+Throttle classes keeping their state in Redis, so limits hold across all worker processes.
+'''
+import redis
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+from cachemanager.redisconn import get_redis
+
+class RedisRateThrottleMixin:
+    '''
+    Replaces request history of DRF's SimpleRateThrottle with GCRA (generic cell rate
+    algorithm): Redis keeps a single timestamp per client, the theoretical arrival time
+    of its next request, updated by a script in one round trip. Up to num_requests
+    requests are allowed in a burst, then one every duration / num_requests seconds.
+    Requests are allowed when Redis can not be reached.
+    '''
+    # ARGV[1] is emission interval and ARGV[2] is burst tolerance, both in microseconds.
+    # Returns -1 if request is allowed, otherwise microseconds to wait.
+    GCRA_SCRIPT = '''
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+        local tat = tonumber(redis.call('GET', KEYS[1]))
+        if not tat or tat < now then
+            tat = now
+        end
+        local allowed_at = tat - tonumber(ARGV[2])
+        if now < allowed_at then
+            return allowed_at - now
+        end
+        local new_tat = tat + tonumber(ARGV[1])
+        redis.call('SET', KEYS[1], string.format('%d', new_tat), 'PX', math.ceil((new_tat - now) / 1000))
+        return -1
+    '''
+    _redis = None
+    _gcra_script = None
+
+    @classmethod
+    def gcra_script(cls):
+        '''
+        GCRA script registered on a client of the shared connection pool, created on first use.
+        '''
+        if RedisRateThrottleMixin._gcra_script is None:
+            RedisRateThrottleMixin._redis = get_redis()
+            RedisRateThrottleMixin._gcra_script = RedisRateThrottleMixin._redis.register_script(cls.GCRA_SCRIPT)
+        return RedisRateThrottleMixin._gcra_script
+
+    def allow_request(self, request, view):
+        self.wait_time = None
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        interval = self.duration * 1000000 // self.num_requests
+        try:
+            result = self.gcra_script()(keys=[self.key], args=[interval, interval * (self.num_requests - 1)])
+        except redis.RedisError:
+            return True
+        if result < 0:
+            return True
+        self.wait_time = result / 1000000
+        return self.throttle_failure()
+
+    def wait(self):
+        return self.wait_time
+
+class RedisUserRateThrottle(RedisRateThrottleMixin, UserRateThrottle):
+    '''
+    UserRateThrottle keeping its state in Redis.
+    '''
+
+class RedisAnonRateThrottle(RedisRateThrottleMixin, AnonRateThrottle):
+    '''
+    AnonRateThrottle keeping its state in Redis.
+    '''
@@ -1,33 +1,66 @@
 '''
 These views implement API endpoints for cache manager
 '''
-import io
-from django.http import FileResponse
+import mimetypes
+import redis
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import \
+    content_disposition_header, http_date, parse_etags, parse_http_date_safe, quote_etag
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework import authentication
 from rest_framework.response import Response
-from rest_framework.throttling import UserRateThrottle
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.views import APIView
 from rest_framework.decorators import \
-    api_view, permission_classes, throttle_classes
+    api_view, authentication_classes, permission_classes, throttle_classes
+from account.authentication import CachedTokenAuthentication
 from .cachelib import CacheFacade
+from .negotiation import FileContentNegotiation
+from .pagination import FileCursorPagination
+from .throttling import RedisUserRateThrottle
 
 class Storage(APIView):
     '''
     API endpionts for adding a file to cache(via POST) 
     and checking files cached by a user (via GET).
     '''
-    authentication_classes = [authentication.TokenAuthentication, authentication.SessionAuthentication]
+    authentication_classes = [CachedTokenAuthentication, authentication.SessionAuthentication]
     permission_classes = [permissions.IsAuthenticated]
-    throttle_classes = [UserRateThrottle]
+    throttle_classes = [RedisUserRateThrottle]
     parser_classes = [FormParser, MultiPartParser]
+    MAX_BATCH_FILES = 100
+    # Names of stored files, read by nginx to log uploads (see conf/nginx.conf).
+    FILENAME_HEADER = 'X-Uploaded-Filename'
 
     def post(self, request):
         '''
         Add uploaded file to cache.
+        Several files can be uploaded at once using files field instead of file.
+        With background=true, minification/convertion runs after the response is sent.
         '''
+        minify = 'minify' in request.data.keys() and request.data['minify'] == "true"
+        convert = 'convert' in request.data.keys() and request.data['convert'] == "true"
+        background = 'background' in request.data.keys() and request.data['background'] == "true"
+        cache = CacheFacade()
+        if 'files' in request.FILES.keys():
+            uploaded_files = request.FILES.getlist('files')
+            if len(uploaded_files) > self.MAX_BATCH_FILES:
+                return Response(
+                    {"errors": [f"At most {self.MAX_BATCH_FILES} files can be uploaded at once."],},
+                    status=status.HTTP_400_BAD_REQUEST
+                    )
+            store_results = cache.store_files(
+                uploaded_files, owner=request.user, convert=convert, minify=minify, background=background
+                )
+            stored_filenames = [
+                store_result['file_info']['filename'] for store_result in store_results if store_result['success']]
+            return Response({"files": [
+                dict(store_result['file_info'], success=True) if store_result['success']
+                else {"filename": str(uploaded_file), "success": False, "errors": store_result['errors']}
+                for uploaded_file, store_result in zip(uploaded_files, store_results)
+                ]}, headers={self.FILENAME_HEADER: ','.join(stored_filenames)} if stored_filenames else None)
         if 'file' in request.FILES.keys():
             uploaded_file = request.FILES['file']
         else:
@@ -35,33 +68,160 @@ class Storage(APIView):
                 {"errors": ["file field is required"],},
                 status=status.HTTP_400_BAD_REQUEST
                 )
-        minify = 'minify' in request.data.keys() and request.data['minify'] == "true"
-        convert = 'convert' in request.data.keys() and request.data['convert'] == "true"
-        cache = CacheFacade()
         store_result = cache.store_file(
-            uploaded_file, owner=request.user, convert=convert, minify=minify
+            uploaded_file, owner=request.user, convert=convert, minify=minify, background=background
             )
         if store_result['success']:
-            return Response(store_result['file_info'])
+            return Response(
+                store_result['file_info'], headers={self.FILENAME_HEADER: store_result['file_info']['filename']})
         return Response({"errors": store_result['errors']}, status=status.HTTP_400_BAD_REQUEST)
 
     def get(self, request):
         '''
-        Return a list of all cached files by the user.
+        Return a page of files cached by the user.
+        Accepts cursor, page_size, ordering and fields (comma separated) query parameters.
         '''
         cache = CacheFacade()
-        return Response(cache.list_files(request.user))
+        fields = None
+        if request.query_params.get('fields'):
+            fields = request.query_params['fields'].split(',')
+            invalid_fields = [field for field in fields if field not in CacheFacade.LIST_FIELDS]
+            if invalid_fields:
+                return Response(
+                    {"errors": [f"Invalid fields: {', '.join(invalid_fields)}"],},
+                    status=status.HTTP_400_BAD_REQUEST
+                    )
+        paginator = FileCursorPagination()
+        files = paginator.paginate_queryset(cache.file_records(request.user, fields), request, view=self)
+        result = cache.list_files(request.user, files=files, fields=fields)
+        result['next'] = paginator.get_next_link()
+        result['previous'] = paginator.get_previous_link()
+        return Response(result)
+
+def parse_range(range_header, size):
+    '''
+    Returns (start, stop) of a single byte range in Range header value for content of given size.
+    Returns None if header is to be ignored (missing, malformed or several ranges) and False if
+    range is not satisfiable.
+    '''
+    unit, _, byte_range = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in byte_range:
+        return None
+    first, separator, last = byte_range.strip().partition('-')
+    if not separator or not (first + last).isdigit():
+        return None
+    if not first:
+        # Suffix range: last bytes of content.
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size
+    start = int(first)
+    stop = size if not last else min(int(last) + 1, size)
+    if start >= size or start >= stop:
+        return False
+    return start, stop
 
-@api_view(['GET'])
+def range_precondition_holds(if_range, representation):
+    '''
+    Returns True if If-Range header value if_range matches representation, so Range applies.
+    Entity tags match only if they are strong, dates only if they are exactly Last-Modified.
+    '''
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == quote_etag(representation['etag'])
+    return representation['last_modified'] is not None \
+        and parse_http_date_safe(if_range) == representation['last_modified']
+
+@api_view(['GET', 'DELETE'])
+@authentication_classes([CachedTokenAuthentication, authentication.SessionAuthentication])
 @permission_classes([permissions.IsAuthenticated])
-@throttle_classes([UserRateThrottle,])
+@throttle_classes([RedisUserRateThrottle,])
 def get_saved_file(request, filename):
     '''
-    Return cached file.
+    Return cached file (GET) or delete it (DELETE).
+    Images are returned as their smallest variant in a format listed in Accept header
+    and css/js files precompressed with the best encoding allowed by Accept-Encoding header.
+    If-None-Match/If-Modified-Since are answered with 304 without fetching file content.
+    A single byte range of the identity (uncompressed) file can be requested with Range
+    (and If-Range) headers.
+    Large files are sent in chunks, so they are never held in memory as a whole.
+    With CONTENT_CACHE_X_ACCEL_REDIRECT set, files are sent by nginx instead.
     '''
     cache = CacheFacade()
-    file_content = cache.retrieve_file(filename, request.user)
-    if file_content:
-        return FileResponse(io.BytesIO(file_content), filename=filename)
-    else:
+    if request.method == 'DELETE':
+        if cache.delete_file(filename, request.user):
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response({}, status=status.HTTP_404_NOT_FOUND)
+    etags = [etag.removeprefix('W/').strip('"') for etag in parse_etags(request.headers.get('If-None-Match', ''))]
+    modified_since = None
+    # If-Modified-Since is ignored when If-None-Match is present.
+    if not etags and request.headers.get('If-Modified-Since'):
+        modified_since = parse_http_date_safe(request.headers['If-Modified-Since'])
+    # Byte ranges address the identity representation, so a range request is not
+    # answered with a slice of compressed content.
+    accept_encoding = '' if request.headers.get('Range') else request.headers.get('Accept-Encoding', '')
+    retrieve = cache.locate_representation if cache.offloads_retrieval() else cache.retrieve_representation
+    representation = retrieve(
+        filename,
+        request.user,
+        accept=request.headers.get('Accept', ''),
+        accept_encoding=accept_encoding,
+        etags=etags,
+        modified_since=modified_since)
+    if not representation:
         return Response({}, status=status.HTTP_404_NOT_FOUND)
+    if not representation['modified']:
+        response = HttpResponseNotModified()
+    elif 'accel_redirect' in representation:
+        # nginx sends the file with sendfile and handles Range itself.
+        response = HttpResponse(content_type=representation['content_type'] or 'application/octet-stream')
+        response['X-Accel-Redirect'] = representation['accel_redirect']
+        response['Content-Disposition'] = content_disposition_header(False, filename)
+        if representation['content_encoding'] is not None:
+            response['Content-Encoding'] = representation['content_encoding']
+    else:
+        size = representation['size']
+        byte_range = None
+        if request.headers.get('Range') and range_precondition_holds(request.headers.get('If-Range'), representation):
+            byte_range = parse_range(request.headers['Range'], size)
+        if byte_range is False:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f"bytes */{size}"
+        else:
+            start, stop = byte_range or (0, size)
+            if byte_range is None and representation['content'] is not None:
+                response = HttpResponse(representation['content'])
+            else:
+                response = StreamingHttpResponse(representation['stream'](start, stop))
+                response['Content-Length'] = stop - start
+            if byte_range is not None:
+                response.status_code = status.HTTP_206_PARTIAL_CONTENT
+                response['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+            response['Content-Type'] = representation['content_type'] \
+                or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response['Content-Disposition'] = content_disposition_header(False, filename)
+        response['Accept-Ranges'] = 'bytes'
+        if representation['content_encoding'] is not None:
+            response['Content-Encoding'] = representation['content_encoding']
+    if representation['etag'] is not None:
+        response['ETag'] = quote_etag(representation['etag'])
+    if representation['last_modified'] is not None:
+        response['Last-Modified'] = http_date(representation['last_modified'])
+    patch_cache_control(response, private=True, max_age=representation['max_age'])
+    patch_vary_headers(response, representation['vary'])
+    return response
+
+# api_view has no decorator for content negotiation, so it is set on the view class it creates.
+get_saved_file.cls.content_negotiation_class = FileContentNegotiation
+
+def export_metrics(request):
+    '''
+    Cache and pipeline metrics of all worker processes in Prometheus text format.
+    Served without authentication; nginx only lets local scrapers reach it (see conf/nginx.conf).
+    '''
+    try:
+        text = CacheFacade().export_metrics()
+    except redis.RedisError:
+        return HttpResponse("Metrics are not available.", status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
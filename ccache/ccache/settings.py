@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,9 +84,37 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Upload requests and background transform jobs write concurrently. IMMEDIATE
+        # transactions take the write lock up front and wait for it instead of failing
+        # with "database is locked".
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
+# Production deployments set CONTENT_CACHE_DB=postgresql (and POSTGRES_* variables) to use
+# PostgreSQL, whose row level locks let uploads of different users write concurrently.
+# Worker processes keep their connection open for CONN_MAX_AGE seconds; with
+# POSTGRES_POOL=true, psycopg pools connections shared by threads of a process instead.
+if os.environ.get('CONTENT_CACHE_DB') == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'ccache'),
+        'USER': os.environ.get('POSTGRES_USER', 'ccache'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+    if os.environ.get('POSTGRES_POOL') == 'true':
+        # Pooled connections are returned to the pool after each request.
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {'min_size': 2, 'max_size': 10}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -146,3 +175,69 @@ REST_FRAMEWORK = {
         'user': '60/second',
     }
 }
+
+# Redis server used by cachemanager. Clients share one connection pool per process
+# and connect lazily, so importing the project never blocks on Redis.
+CONTENT_CACHE_REDIS = {
+    'HOST': 'localhost',
+    'PORT': 6379,
+    'DB': 0,
+    # Set to e.g. '/run/redis/redis-server.sock' to connect over a unix socket instead of TCP.
+    'UNIX_SOCKET_PATH': None,
+    'MAX_CONNECTIONS': 50,
+    'POOL_TIMEOUT': 5.0,
+    'SOCKET_TIMEOUT': 1.0,
+    'SOCKET_CONNECT_TIMEOUT': 1.0,
+}
+
+# Cache backend of cachemanager, one of RedisCacheBackend, TwoTierCacheBackend
+# (in-process LRU in front of Redis), CustomCacheBackend, ShardedCacheBackend or
+# SharedMemoryCacheBackend (one arena per host in /dev/shm) in cachemanager.cachelib.
+# OPTIONS are passed to the backend, e.g. {'maxmemory': 256*1024*1024} for the in-process
+# and shared memory backends or {'backend': 'cachemanager.cachelib.RedisCacheBackend'} as L2.
+CONTENT_CACHE_BACKEND = {
+    'BACKEND': 'cachemanager.cachelib.RedisCacheBackend',
+    'OPTIONS': {},
+}
+
+# Persistent storage of uploaded files. Deduplication on disk is opt-in: the default
+# LocalStorageBackend writes one file per name, even for identical content. Use
+# 'cachemanager.storage.ContentAddressedStorageBackend' to store identical files once
+# (files stored before are not moved), or point root to a tmpfs mount
+# (e.g. '/dev/shm/content-cache/') for tests.
+CONTENT_CACHE_STORAGE = {
+    'BACKEND': 'cachemanager.storage.LocalStorageBackend',
+    'OPTIONS': {
+        'root': '/opt/content-cache/',
+    },
+}
+
+# Variants encoded in background for every stored image (formats x quality presets x widths).
+# Each web worker encodes on its own pool of WORKERS processes. None divides cores of the
+# host between web workers, whose number is read from WEB_CONCURRENCY (see setup.sh).
+CONTENT_CACHE_IMAGE_VARIANTS = {
+    'ENABLED': True,
+    'FORMATS': ['webp', 'avif'],
+    'PRESETS': {
+        'high': 80,
+        'low': 50,
+    },
+    'WIDTHS': [None, 640],
+    'WORKERS': None,
+}
+
+# Cache-Control max-age (seconds) of files served from /storage/, by file
+# extension or by file type ('text'/'image'). Responses are private to the owner.
+CONTENT_CACHE_MAX_AGE = {
+    'text': 3600,
+    'image': 86400,
+}
+
+# Internal nginx location serving root of CONTENT_CACHE_STORAGE (see conf/nginx.conf),
+# e.g. '/internal-storage/'. When set, Django only authorizes downloads and nginx sends
+# files with X-Accel-Redirect, so file content never passes through worker processes.
+CONTENT_CACHE_X_ACCEL_REDIRECT = None
+
+# Fraction of minifications/convertions whose peak memory is measured (tracemalloc).
+# Others are timed only and store no memory usage.
+CONTENT_CACHE_PROFILE_SAMPLE_RATE = 0.05
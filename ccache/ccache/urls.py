@@ -24,6 +24,7 @@ from cachemanager import views as cacheman_views
 urlpatterns = [
     path('storage/<filename>/', cacheman_views.get_saved_file, name="get_file"),
     path('storage/', cacheman_views.Storage.as_view()),
+    path('metrics', cacheman_views.export_metrics, name="metrics"),
     path('account/', account_views.AccountManager.as_view()),
     path('register/', account_views.register),
     path("api-token-auth/", authtoken_views.obtain_auth_token),
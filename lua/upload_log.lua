@@ -0,0 +1,74 @@
+-- Buffered writer of uploads.log records.
+-- Every nginx worker keeps its own open log file and record buffer. Records are
+-- written by a timer, so requests do not wait for disk writes, and they stay
+-- buffered until they are written successfully.
+local _M = {}
+
+local FLUSH_INTERVAL = 1 -- seconds
+local MAX_BUFFERED = 256 -- records written right away once buffer holds this many
+
+local path
+local file
+local buffer = {}
+
+local function open_log()
+    if not file then
+        local handle, err = io.open(path, "a")
+        if not handle then
+            ngx.log(ngx.ERR, "can not open upload log ", path, ": ", err)
+            return nil
+        end
+        handle:setvbuf("full", 64 * 1024)
+        file = handle
+    end
+    return file
+end
+
+function _M.flush()
+    if #buffer == 0 then
+        return true
+    end
+    local handle = open_log()
+    if not handle then
+        return false
+    end
+    local written, err = handle:write(table.concat(buffer))
+    if written then
+        written, err = handle:flush()
+    end
+    if not written then
+        ngx.log(ngx.ERR, "can not write upload log ", path, ": ", err)
+        -- Log file is reopened and records are written again on next flush.
+        handle:close()
+        file = nil
+        return false
+    end
+    buffer = {}
+    return true
+end
+
+local function flush_timer(premature)
+    _M.flush()
+    if premature and file then
+        file:close()
+        file = nil
+    end
+end
+
+-- Called from init_worker_by_lua_block with absolute path of uploads.log.
+function _M.init(log_path)
+    path = log_path
+    local ok, err = ngx.timer.every(FLUSH_INTERVAL, flush_timer)
+    if not ok then
+        ngx.log(ngx.ERR, "can not start upload log timer: ", err)
+    end
+end
+
+function _M.write(record)
+    buffer[#buffer + 1] = record
+    if #buffer >= MAX_BUFFERED then
+        _M.flush()
+    end
+end
+
+return _M
@@ -15,8 +15,10 @@ virtualenv cenv
 pip install --upgrade pip
 pip install -r requirements.txt
 
-# Add specified user to sudoers file so that file operations using sudo do not require providing a password
-echo "$1 ALL=(ALL) NOPASSWD: /usr/bin/mkdir , /usr/bin/mv , /usr/bin/cp , /usr/bin/rm" | (EDITOR="tee -a" visudo)
+# Storage root of uploaded files (CONTENT_CACHE_STORAGE in settings.py), owned by the gunicorn
+# service (user $1, group www-data) so that uploads are written in-process without sudo.
+# Others may only traverse and read it, so nginx can send files with X-Accel-Redirect.
+install -d -o "$1" -g www-data -m 755 /opt/content-cache
 
 # Install and configure redis
 apt-get install redis
@@ -50,13 +52,12 @@ echo "Update ALLOWED_HOSTS in $PWD/ccache/ccache/settings.py with server ip. Rem
 
 echo "[Unit]\nDescription=gunicorn socket\n\n[Socket]\nListenStream=/run/gunicorn.sock\n\n[Install]\nWantedBy=sockets.target" > /etc/systemd/system/gunicorn.socket
 
-echo "[Unit]\nDescription=gunicorn daemon\nRequires=gunicorn.socket\nAfter=network.target\n\n[Service]\nUser=$1\nGroup=www-data\nWorkingDirectory=$PWD/ccache\nExecStart=$PWD/cenv/bin/gunicorn  --access-logfile - --workers 3 --bind unix:/run/gunicorn.sock ccache.wsgi:application\n\n[Install]\nWantedBy=multi-user.target" > /etc/systemd/system/gunicorn.service
+echo "[Unit]\nDescription=gunicorn daemon\nRequires=gunicorn.socket\nAfter=network.target\n\n[Service]\nUser=$1\nGroup=www-data\nWorkingDirectory=$PWD/ccache\nEnvironment=WEB_CONCURRENCY=3\nExecStart=$PWD/cenv/bin/gunicorn  --access-logfile - --bind unix:/run/gunicorn.sock ccache.wsgi:application\n\n[Install]\nWantedBy=multi-user.target" > /etc/systemd/system/gunicorn.service
 
 systemctl start gunicorn.socket
 systemctl enable gunicorn.socket
 
 mkdir logs
-mkdir ccache/tmp
 
 touch ./logs/uploads.log
 chown nobody:nogroup ./logs/uploads.log
@@ -65,5 +66,6 @@ cd ccache
 python manage.py makemigrations
 python manage.py migrate
 python manage.py loaddata users.json
+python manage.py apply_cache_config
 
 systemctl restart gunicorn